@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import json
+import argparse
 import logging
+import os
 import asyncio
 import random
-from datetime import datetime
 from contextlib import suppress
 from typing import override
-from network import NetworkManager, Response
-from event import BaseConfig, BaseEventManager, BaseEvent
+from network import ITEM_NOT_OWNED_CODE, NetworkManager, Response, get_serializer
+from assets import SettingReader
+from event import LOOP_MONITOR, ActionPipeline, BaseEventManager, BaseEvent, EventPlan, SharedPlan
+from clock import get_clock
 from storage import Database, DiscordID
+from supervisor import ShardSupervisor
 
 def handler():
     handler = logging.StreamHandler()
@@ -18,103 +21,150 @@ def handler():
     handler.setFormatter(formatter)
     return handler
 
+def plan_answers(answers: dict[tuple[int, int], tuple[int, str, int]], level: int, question_id: int, energy: int) -> list[tuple[int, int, int, str]]:
+    """
+    Answers which ``energy`` can pay for from the current question on, as ``(level, question_id, select_id, cost)`` steps.
+
+    ``answers`` is the ``(level, question_id) -> (select_id, cost payload, energy cost)`` index of the event plan. A correct
+    answer moves on to the next question of the level, or to the first question of the next level after the last one.
+    """
+    steps = list()
+    while (level, question_id) in answers:
+        (select_id, cost, amount) = answers[(level, question_id)]
+        if amount > energy:
+            break
+        energy -= amount
+        steps.append((level, question_id, select_id, cost))
+        (level, question_id) = (level, question_id + 1) if (level, question_id + 1) in answers else (level + 1, 0)
+    return steps
+
+
 class MultiverseDatingManager(BaseEventManager):
     _logger = logging.getLogger('Clicker 2.5 Event Manager')
 
-    def __init__(self):
-        super().__init__('MultiverseEventSetting.zip')
+    def __init__(self, **kwargs):
+        super().__init__('MultiverseEventSetting.zip', **kwargs)
         self.event_id = None
         self._logger.setLevel(logging.INFO)
         if not self._logger.handlers:
             self._logger.addHandler(handler())
 
     @override
-    async def build_event_config(self):
+    def compile_event_plan(self, config: SettingReader) -> EventPlan | None:
         """
-        Download latest event setting configs from the server CDN, and build the required list for script automation.
+        Build the required lists for script automation from the latest event setting configs of the server CDN.
         """
-        config = await BaseConfig(self.config).get_dict()
-        now_ts = int(datetime.now().timestamp())
+        # cost payloads are serialized once here and sent as they are by every user instance
+        serializer = get_serializer()
+        now_ts = get_clock().timestamp()
+        event_id = None
         # Retrieve event_id
         for event in config['multiverse_dating_settings']:
             if event['timeslot_detail'][0]['end_time'] > now_ts > event['timeslot_detail'][0]['start_time']:
                 # update event_id if Multiverse Dating event is currently online
-                self.event_id = event['event_id']
-                self.end_time = event['timeslot_detail'][0]['end_time']
-
-        if self.event_id:
-            # Build reward list for each level completion
-            self.reward_list = list()
-            self.gift_list = list()
-            for level in config['multiverse_dating_level_settings']:
-                if level['event_id'] == self.event_id:
-                    if level['level'] > 0:
-                        rewards = list()
-                        for reward in level['reward_list']:
-                            del reward['config']
-                            rewards.append(json.dumps(reward))
-                        # hard coding the gift list 
-                        if level['level'] == 1:
-                            first_item = json.loads(rewards[1])['asset_id']
-                            # Build gift list for each item ID
-                            for i in range(4):
-                                self.gift_list.append(int(first_item) + i)
-                        reward_info = { 'level': level['level'], 'exp': level['exp'], 'rewards': rewards }
-                        self.reward_list.append(reward_info)
-
-            # Build machine list for collect machine
-            self.machine_list = list()
-            for upgrade in config['multiverse_dating_explore_item_settings']:
-                if upgrade['event_id'] == self.event_id:
-                    cost = dict()
-                    if upgrade['tier_cost']:
-                        cost = upgrade['tier_cost'][0]
-                        del cost['config']
-                    machine_info = { 'tier': upgrade['tier'], 'cost': json.dumps([cost]), 'max_duration': upgrade['max_duration'] }
-                    self.machine_list.append(machine_info)
-
-            # Build Q&A cost list from level 1 to 6
-            self.avg_dict = dict()
-            for qa in config['multiverse_dating_question_settings']:
-                if qa['event_id'] == self.event_id and qa['level'] > 0:
-                    payload_list = list()
-                    for q_idx, q in enumerate(qa['question']):
-                        for a_idx, a in enumerate(q['answer_list']):
-                            if a['is_true'] == 1:
-                                cost = a['cost'][0]
-                                del cost['config']
-                                payload = { 'question_id': q_idx, 'select_id': a_idx, 'cost': json.dumps([cost]) }
-                                payload_list.append(payload)
-                    self.avg_dict.update({ qa['level']: payload_list })
-        else:
-            self._logger.error(f"There's no multiverse event running right now.")
+                event_id = event['event_id']
+                end_time = event['timeslot_detail'][0]['end_time']
+
+        if not event_id:
+            return None
+        # Build reward list for each level completion
+        reward_list = list()
+        gift_list = list()
+        for level in config.rows('multiverse_dating_level_settings', event_id):
+            if level['level'] > 0:
+                rewards = list()
+                for reward in level['reward_list']:
+                    del reward['config']
+                    rewards.append(serializer.dumps(reward))
+                # hard coding the gift list 
+                if level['level'] == 1:
+                    first_item = serializer.loads(rewards[1])['asset_id']
+                    # Build gift list for each item ID
+                    for i in range(4):
+                        gift_list.append(int(first_item) + i)
+                reward_info = { 'level': level['level'], 'exp': level['exp'], 'rewards': rewards }
+                reward_list.append(reward_info)
+
+        # Build machine list for collect machine, and index it by tier
+        machine_list = list()
+        for upgrade in config.rows('multiverse_dating_explore_item_settings', event_id):
+            cost = dict()
+            if upgrade['tier_cost']:
+                cost = upgrade['tier_cost'][0]
+                del cost['config']
+            machine_info = { 'tier': upgrade['tier'], 'cost': serializer.dumps([cost]), 'max_duration': upgrade['max_duration'] }
+            machine_list.append(machine_info)
+        machines = { machine['tier']: machine for machine in machine_list }
+
+        # Build Q&A cost list from level 1 to 6, and index the answers as (level, question_id) -> (select_id, cost payload, energy cost)
+        avg_dict = dict()
+        answers = dict()
+        for qa in config.rows('multiverse_dating_question_settings', event_id):
+            if qa['level'] > 0:
+                payload_list = list()
+                for q_idx, q in enumerate(qa['question']):
+                    for a_idx, a in enumerate(q['answer_list']):
+                        if a['is_true'] == 1:
+                            cost = a['cost'][0]
+                            del cost['config']
+                            payload = { 'question_id': q_idx, 'select_id': a_idx, 'cost': serializer.dumps([cost]) }
+                            payload_list.append(payload)
+                            answers.update({ (qa['level'], q_idx): (a_idx, payload['cost'], cost['amount']) })
+                avg_dict.update({ qa['level']: payload_list })
+
+        tables = { 'reward_list': reward_list, 'gift_list': gift_list, 'machine_list': machine_list, 'machines': machines, 'avg_dict': avg_dict, 'answers': answers }
+        return EventPlan(event_id, end_time, tables)
 
     @override
     def create_user_instance(self, discord_id: DiscordID):
         #OPTIONAL: can import setting dictionaries in a setup functiom for clean code.
-        instance = MultiverseDating(discord_id, self.event_id, self.end_time, self.reward_list, self.gift_list, self.machine_list, self.avg_dict)
+        instance = MultiverseDating(discord_id, self.shared_plan)
         return instance
 
 
 class MultiverseDating(BaseEvent):
     _logger = logging.getLogger('Clicker 2.5')
 
-    def __init__(self, discord_user_id: DiscordID, event_id: int, end_time: int, reward_list, gift_list, machine_list, avg_dict):
+    def __init__(self, discord_user_id: DiscordID, shared_plan: SharedPlan):
         super().__init__()
         self._logger.setLevel(logging.INFO)
         if not self._logger.handlers:
             self._logger.addHandler(handler())
         self.discord_user_id = discord_user_id
-        self.event_id = event_id
-        self.end_time = end_time
-        self.reward_list = reward_list
-        self.gift_list = gift_list
-        self.machine_list = machine_list
-        self.avg_dict = avg_dict
+        # compiled event tables shared read-only with the manager and every other user instance, swapped by hot reload
+        self._shared_plan = shared_plan
         self.energy = 0
         self.duration = 0
         self.is_sync = False
 
+    @property
+    def plan(self) -> EventPlan:
+        return self._shared_plan.plan
+
+    @property
+    def event_id(self) -> int:
+        return self.plan.event_id
+
+    @property
+    def end_time(self) -> int:
+        return self.plan.end_time
+
+    @property
+    def reward_list(self) -> list:
+        return self.plan.tables['reward_list']
+
+    @property
+    def gift_list(self) -> list:
+        return self.plan.tables['gift_list']
+
+    @property
+    def machines(self) -> dict:
+        return self.plan.tables['machines']
+
+    @property
+    def answers(self) -> dict:
+        return self.plan.tables['answers']
+
     @override
     async def on_start(self) -> None:
         # the event manager will deal with exception.
@@ -122,45 +172,49 @@ class MultiverseDating(BaseEvent):
         self.is_sync = await self.fetch_records()
 
     @override
-    async def run_loop(self) -> None:
-        if self.is_sync:
-            while self.end_time > int(datetime.now().timestamp()):
-                if await self.is_premium():
-                    try:
-                        await super().register(self.discord_user_id)
-                        await self.claim_energy()
-                        await self.auto_dialog()
-                        await self.daily_meet()
-                        await self.automate_level_rewards()
-                    except Exception as e:
-                        self._logger.exception(f"(User: {self.discord_user_id}) encountered process exception: {e}")
-                else:
-                    await super().register(self.discord_user_id)
-                    await self.claim_energy()
-                await self.wait_until_next_update()
-
-    """ Complete event dialogues if player energy sufficient. """
+    async def tick(self) -> int | None:
+        if not self.is_sync or self.end_time <= get_clock().timestamp():
+            return None
+        if await self.is_premium():
+            try:
+                await super().register(self.discord_user_id)
+                await self.claim_energy()
+                await self.auto_dialog()
+                await self.daily_meet()
+                await self.automate_level_rewards()
+            except Exception as e:
+                self._logger.exception(f"(User: {self.discord_user_id}) encountered process exception: {e}")
+        else:
+            await super().register(self.discord_user_id)
+            await self.claim_energy()
+        return await self.schedule_next_update()
+
+    """ Complete event dialogues if player energy sufficient, the answers which can be afforded are planned before the first one is sent. """
     async def auto_dialog(self) -> None:
         if not await self.fetch_records():
             return None
-        cost = self._current_question_cost()
-        if cost:
-            while self.energy > cost:
-                if not await self.select_answer():
-                    return None
-
-    """ Complete all daily meet attempts at once """
+        steps = plan_answers(self.answers, self.dating_record['level'], self.dating_record['current_question'], self.energy)
+        for (level, question_id, select_id, cost) in steps:
+            if (self.dating_record['level'], self.dating_record['current_question']) != (level, question_id):
+                self._logger.warning(f"(User: {self.discord_user_id}) is at (Level: {self.dating_record['level']}, Question: {self.dating_record['current_question']}) instead of the planned (Level: {level}, Question: {question_id}), stopping the dialog until the next wake-up.")
+                return None
+            if not await self.select_answer(select_id, cost):
+                return None
+
+    """ Complete all daily meet attempts at once, the meets are pipelined and their records folded in submission order. """
     async def daily_meet(self) -> None:
-        meet_count = self.dating_record['meet_count']
+        meets = 10 - self.dating_record['meet_count']
         payload = { 'event_id': self.event_id }
-        for i in range(10 - meet_count):
-            resp = await self._post(self.api.multiverse_dating.meet, payload)
-            # update user record
-            self.dating_record = resp.response()['user_multiverse_dating_record']
-            if i == 0:
-                self._logger.debug(f"(User: {self.discord_user_id}) has met 1 time.")
+        pipeline = ActionPipeline(self._post)
+        for _ in range(meets):
+            pipeline.add(self.api.multiverse_dating.meet, payload)
+        for resp in await pipeline.run():
+            if resp.success():
+                # update user record
+                self._fold_record(resp.response()['user_multiverse_dating_record'])
             else:
-                self._logger.debug(f"(User: {self.discord_user_id}) has met {i+1} times.")
+                self._logger.error(f"(User: {self.discord_user_id}) failed to meet, reason: {resp.error_message()}")
+        self._logger.debug(f"(User: {self.discord_user_id}) has met {meets} times.")
 
     """ Claim energy from collect machine """
     async def claim_energy(self) -> None:
@@ -193,49 +247,57 @@ class MultiverseDating(BaseEvent):
                     match current_level:
                         case 2:
                             if self.dating_record['item_tier'] == 1:
-                                await self.upgrade(2, self.machine_list[1]['cost'])
+                                await self.upgrade(2, self.machines[2]['cost'])
                         case 4:
                             match self.dating_record['item_tier']:
                                 case 1:
-                                    await self.upgrade(2, self.machine_list[1]['cost'])
-                                    await self.upgrade(3, self.machine_list[2]['cost'])
+                                    await self.upgrade(2, self.machines[2]['cost'])
+                                    await self.upgrade(3, self.machines[3]['cost'])
                                 case 2:
-                                    await self.upgrade(3, self.machine_list[2]['cost'])
+                                    await self.upgrade(3, self.machines[3]['cost'])
                                 case _:
                                     continue
                         case 5:
                             match self.dating_record['item_tier']:
                                 case 1:
-                                    await self.upgrade(2, self.machine_list[1]['cost'])
-                                    await self.upgrade(3, self.machine_list[2]['cost'])
-                                    await self.upgrade(4, self.machine_list[3]['cost'])
+                                    await self.upgrade(2, self.machines[2]['cost'])
+                                    await self.upgrade(3, self.machines[3]['cost'])
+                                    await self.upgrade(4, self.machines[4]['cost'])
                                 case 2:
-                                    await self.upgrade(3, self.machine_list[2]['cost'])
-                                    await self.upgrade(4, self.machine_list[3]['cost'])
+                                    await self.upgrade(3, self.machines[3]['cost'])
+                                    await self.upgrade(4, self.machines[4]['cost'])
                                 case 3:
-                                    await self.upgrade(4, self.machine_list[3]['cost'])
+                                    await self.upgrade(4, self.machines[4]['cost'])
                                 case _:
                                     continue
                         case _:
                             # we use spare levels to consume remaining gifts
-                            for gift_id in self.gift_list:
-                                remains = await self.send_gift(gift_id)
-                                if remains:
-                                    for _ in range(remains):
-                                        await self.send_gift(gift_id)
-
-    """ Send gift to event hero, return remaining amount of the gift item. """
-    async def send_gift(self, item_id) -> int | None:
-        payload = { 'event_id': self.event_id, 'item_id': item_id }
-        resp = await self._post(self.api.multiverse_dating.gift, payload)
+                            await self.send_gifts()
+
+    """ Send every gift item to event hero, one of each item first to learn the remaining amounts, then all the remaining units pipelined. """
+    async def send_gifts(self) -> None:
+        pipeline = ActionPipeline(self._post)
+        for gift_id in self.gift_list:
+            pipeline.add(self.api.multiverse_dating.gift, { 'event_id': self.event_id, 'item_id': gift_id })
+        remains = [self._fold_gift(resp, gift_id) for (resp, gift_id) in zip(await pipeline.run(), self.gift_list)]
+        units = list()
+        for (gift_id, amount) in zip(self.gift_list, remains):
+            for _ in range(amount or 0):
+                pipeline.add(self.api.multiverse_dating.gift, { 'event_id': self.event_id, 'item_id': gift_id })
+                units.append(gift_id)
+        for (resp, gift_id) in zip(await pipeline.run(), units):
+            self._fold_gift(resp, gift_id)
+
+    """ Update user record from the response of a gift, return remaining amount of the gift item. """
+    def _fold_gift(self, resp: 'EventResponse', item_id) -> int | None:
         if resp.success():
             cmp_record = self.dating_record
-            self.dating_record = self.response()['user_multiverse_dating_record']
+            self._fold_record(resp.response()['user_multiverse_dating_record'])
             delta = self.dating_record['exp'] - cmp_record['exp']
             self._logger.debug(f"(User: {self.discord_user_id}) gained {delta} EXP by sending the gift.")
             remains = resp.reduced_item_list()[0]['amount']
             return remains
-        elif resp.error_code() == 11002:
+        elif resp.error_code() == ITEM_NOT_OWNED_CODE:
             self._logger.warning(f"(User: {self.discord_user_id}) does not have any gift (ID: {item_id}).")
         else:
             self._logger.error(f"(User: {self.discord_user_id}) failed to send gift, reason: {resp.error_message()}")
@@ -265,15 +327,9 @@ class MultiverseDating(BaseEvent):
         else:
             self._logger.error(f"(User: {self.discord.user_id}) failed to upgrade machine to tier {tier}, reason: {resp.error_message()}")
 
-    """ Auto complete question by current question ID, return False if something is wrong """
-    async def select_answer(self) -> bool:
+    """ Answer the current question with ``select_id`` paying the serialized ``cost``, return False if something is wrong """
+    async def select_answer(self, select_id: int, cost: str) -> bool:
         cmp_record = self.dating_record
-        cheatsheet = self.avg_dict[cmp_record['level']]
-        for qa in cheatsheet:
-            if qa['question_id'] == cmp_record['current_question']:
-                select_id = qa['select_id']
-                cost = qa['cost']
-                break
         payload = { 'event_id': self.event_id, 'select_id': select_id, 'cost': cost }
         resp = await self._post(self.api.multiverse_dating.select, payload)
         if resp.success():
@@ -311,31 +367,32 @@ class MultiverseDating(BaseEvent):
         user = await self.db.user.get_user(self.discord_user_id)
         return user.is_premium()
 
-    """ Override database CRUD to set next_update timestamp at wait until the energy reaches at 80% machine capacity """
-    async def wait_until_next_update(self) -> None:
+    """ Override database CRUD to set next_update timestamp when the energy reaches at 80% machine capacity, return the timestamp """
+    async def schedule_next_update(self) -> int:
         interval = int(self.duration * random.randint(80, 90) / 100)
-        next_update_ts = int(datetime.now().timestamp()) + interval
+        next_update_ts = get_clock().timestamp() + interval
         await self.db.user.set_next_update_timestamp(self.discord_user_id, next_update_ts)
-        self._logger.info(f"(User: {self.discord_user_id}) coroutine starts sleeping for {interval} seconds.")
-        await asyncio.sleep(interval)
-
-    def _current_question_cost(self) -> int:
-        level = self.dating_record['level']
-        if level == 0:
-            return 0
-        question_id = self.dating_record['current_question']
-        for qa in self.avg_dict[level]:
-            if qa['question_id'] == question_id:
-                return json.loads(qa['cost'])[0]['amount']
-    
+        self._logger.info(f"(User: {self.discord_user_id}) is scheduled to wake up in {interval} seconds.")
+        return next_update_ts
+
+    def _fold_record(self, record: dict) -> None:
+        """
+        Fold the record snapshot of a pipelined meet or gift into the user record, in submission order.
+
+        Concurrent actions may be answered out of order, meets and gifts only move the record forward, so an older snapshot
+        than the current one is skipped.
+        """
+        current = self.dating_record
+        if (record['level'], record['exp'], record['meet_count']) >= (current['level'], current['exp'], current['meet_count']):
+            self.dating_record = record
+
     def _update_duration(self) -> None:
         try:
-            tier = self.dating_record['item_tier']
-            for machine in self.machine_list:
-                if machine['tier'] == tier:
-                    self.duration = machine['max_duration']
-                    self._logger.debug(f"(User: {self.discord_user_id}) updated duration to {self.duration} seconds.")
-                    return None
+            machine = self.machines.get(self.dating_record['item_tier'])
+            if machine:
+                self.duration = machine['max_duration']
+                self._logger.debug(f"(User: {self.discord_user_id}) updated duration to {self.duration} seconds.")
+                return None
         except:
             self._logger.exception(f"(User: {self.discord_user_id}) has not initialised dating record yet!")
 
@@ -379,11 +436,18 @@ class EventResponse(Response):
 
 
 
-async def main():
-    manager = MultiverseDatingManager()
-    await manager.build_event_config()
-    await manager.run()
+async def main(workers=1, **kwargs):
+    if workers > 1:
+        await ShardSupervisor(MultiverseDatingManager, workers, **kwargs).run()
+    else:
+        manager = MultiverseDatingManager(**kwargs)
+        await manager.build_event_config()
+        await manager.run()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Clicker 2.5 event automation")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 1)), help="number of worker processes sharing the users")
+    parser.add_argument('--monitor-loop', action='store_true', default=LOOP_MONITOR, help="log event loop lag and the functions blocking it every minute")
+    args = parser.parse_args()
     with suppress(KeyboardInterrupt):
-        asyncio.run(main())
+        asyncio.run(main(args.workers, loop_monitor=args.monitor_loop))
@@ -1,127 +1,151 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import json
 import logging
 import asyncio
 import random
-from datetime import datetime
 from contextlib import suppress
 from typing import override
-from network import NetworkManager, Response
-from event import BaseConfig, BaseEventManager, BaseEvent
+from network import ConnectionPool, NetworkManager, Response, get_serializer
+from assets import SettingReader
+from event import BaseEventManager, BaseEvent, EventPlan, SharedPlan
+from clock import get_clock
 from storage import Database, DiscordID
 
 class SexualDatingManager(BaseEventManager):
     _logger = logging.getLogger('Clicker 2 Event Manager')
 
-    def __init__(self):
-        super().__init__('SexualDatingSetting.zip')
+    def __init__(self, **kwargs):
+        super().__init__('SexualDatingSetting.zip', **kwargs)
         self.event_id = None
         self.end_time = None
         self._logger.setLevel(logging.INFO)
 
     @override
-    async def build_event_config(self):
+    def compile_event_plan(self, config: SettingReader) -> EventPlan | None:
         """
-        Download latest event setting configs from the server CDN, and build the required list for script automation.
+        Build the required lists for script automation from the latest event setting configs of the server CDN.
         """
-        config = await BaseConfig(self.config).get_dict()
-        now_ts = int(datetime.now().timestamp())
+        # cost payloads are serialized once here and sent as they are by every user instance
+        serializer = get_serializer()
+        now_ts = get_clock().timestamp()
+        event_id = None
         # Retrieve event_id
         for event in config['sexual_dating_settings']:
             if event['timeslot_detail'][0]['end_time'] > now_ts > event['timeslot_detail'][0]['start_time']:
                 # update event_id if Multiverse Dating event is currently online
-                self.event_id = event['event_id']
-                self.end_time = event['timeslot_detail'][0]['end_time']
-
-        if self.event_id:
-            # Build avg answer dict
-            self.avg_dict = dict()
-            for chapter in config['message_detail_settings']:
-                ans_list = list()
-                chapter_id = chapter['chapter']
-                max_message_id = len(chapter['message_data']) + 1
-                for message in chapter['message_data']:
-                    if message['selection_list']:
-                        for selection in message['selection_list']:
-                            if selection['correct'] == 1:
-                                content = { 'message_id': message['id'], 'selection': selection['selection_id'], 'energy_cost': selection['energy_cost'] }
-                                ans_list.append(content)
-
-                self.avg_dict.update({ chapter_id: ans_list })
-
-            # Build machine dict for collect machine
-            self.upgrade_dict = dict()
-            for upgrade in config['explore_item_settings']:
-                if upgrade['event_id'] == self.event_id:
-                    cost = list()
-                    if upgrade['cost_list']:
-                        cost = upgrade['cost_list']
-                        del cost[0]['config']
-                    machine_info = { 'cost': json.dumps(cost), 'max_duration': upgrade['max_explore_limit'] }
-                    self.upgrade_dict.update({ upgrade['tier']: machine_info })
-
-            # Build exp dict for auto clickers
-            self.exp_dict = dict()
-            for scene in config['h_sence_settings']:
-                if scene['event_id'] == self.event_id:
-                    # extract minimum info from each chapter
-                    chapter_id = scene['chapter_id']
-                    max_exp = scene['max_exp']
-                    active = scene['active']
-                    option_dict = dict()
-                    # build option dict
-                    for op_id, option in enumerate(scene['option_detail'], 1):
-                        cost = list()
-                        if option['item_cost']:
-                            cost = option['item_cost']
-                            del cost[0]['config']
-                        detail = { 'exp': option['exp'], 'upgrade': option['exp_require'], 'cost': json.dumps(cost) } 
-                        option_dict.update({ op_id: detail })
-                    scene_record = { 'max_exp': max_exp, 'active': active, 'options': option_dict }
-                    self.exp_dict.update({ chapter_id: scene_record })
+                event_id = event['event_id']
+                end_time = event['timeslot_detail'][0]['end_time']
 
+        if not event_id:
+            return None
+        # Build avg answer dict
+        avg_dict = dict()
+        for chapter in config['message_detail_settings']:
+            ans_list = list()
+            chapter_id = chapter['chapter']
+            max_message_id = len(chapter['message_data']) + 1
+            for message in chapter['message_data']:
+                if message['selection_list']:
+                    for selection in message['selection_list']:
+                        if selection['correct'] == 1:
+                            content = { 'message_id': message['id'], 'selection': selection['selection_id'], 'energy_cost': selection['energy_cost'] }
+                            ans_list.append(content)
+
+            avg_dict.update({ chapter_id: ans_list })
+
+        # Build machine dict for collect machine
+        upgrade_dict = dict()
+        for upgrade in config.rows('explore_item_settings', event_id):
+            cost = list()
+            if upgrade['cost_list']:
+                cost = upgrade['cost_list']
+                del cost[0]['config']
+            machine_info = { 'cost': serializer.dumps(cost), 'max_duration': upgrade['max_explore_limit'] }
+            upgrade_dict.update({ upgrade['tier']: machine_info })
+
+        # Build exp dict for auto clickers
+        exp_dict = dict()
+        for scene in config.rows('h_sence_settings', event_id):
+            # extract minimum info from each chapter
+            chapter_id = scene['chapter_id']
+            max_exp = scene['max_exp']
+            active = scene['active']
+            option_dict = dict()
+            # build option dict
+            for op_id, option in enumerate(scene['option_detail'], 1):
+                cost = list()
+                if option['item_cost']:
+                    cost = option['item_cost']
+                    del cost[0]['config']
+                detail = { 'exp': option['exp'], 'upgrade': option['exp_require'], 'cost': serializer.dumps(cost) } 
+                option_dict.update({ op_id: detail })
+            scene_record = { 'max_exp': max_exp, 'active': active, 'options': option_dict }
+            exp_dict.update({ chapter_id: scene_record })
+
+        tables = { 'avg_dict': avg_dict, 'upgrade_dict': upgrade_dict, 'exp_dict': exp_dict }
+        return EventPlan(event_id, end_time, tables)
 
     @override
     def create_user_instance(self, discord_id: DiscordID):
-        return SexualDating(discord_id, self.event_id, self.end_time, self.avg_dict, self.upgrade_dict, self.exp_dict)
+        return SexualDating(discord_id, self.shared_plan)
 
 
 class SexualDating(BaseEvent):
     _logger = logging.getLogger('Clicker 2')
 
-    def __init__(self, discord_user_id: DiscordID, event_id: int, end_time: int, avg_dict: dict, upgrade_dict: dict, exp_dict: dict):
+    def __init__(self, discord_user_id: DiscordID, shared_plan: SharedPlan):
         super().__init__()
         self._logger.setLevel(logging.INFO)
         self.discord_user_id = discord_user_id
-        self.event_id = event_id
-        self.end_time = end_time
-        self.avg_dict = avg_dict
-        self.upgrade_dict = upgrade_dict
-        self.exp_dict = exp_dict
+        # compiled event tables shared read-only with the manager and every other user instance, swapped by hot reload
+        self._shared_plan = shared_plan
         self.event_record = None
         self.energy = None
         self.machine_record = None
         self.clicker_profile = None
         self.is_sync = False
 
+    @property
+    def plan(self) -> EventPlan:
+        return self._shared_plan.plan
+
+    @property
+    def event_id(self) -> int:
+        return self.plan.event_id
+
+    @property
+    def end_time(self) -> int:
+        return self.plan.end_time
+
+    @property
+    def avg_dict(self) -> dict:
+        return self.plan.tables['avg_dict']
+
+    @property
+    def upgrade_dict(self) -> dict:
+        return self.plan.tables['upgrade_dict']
+
+    @property
+    def exp_dict(self) -> dict:
+        return self.plan.tables['exp_dict']
+
     @override
     async def on_start(self) -> None:
         await super().register(self.discord_user_id)
         self.is_sync = await self.fetch_records()
 
     @override
-    async def run_loop(self) -> None:
-        if self.is_sync:
-            while self.end_time > int(datetime.now().timestamp()):
-                try:
-                    await super().register(self.discord_user_id)
-                    await self.claim_energy()
-                    if await self.is_premium():
-                            return
-                except Exception as e:
-                    self._logger.exception(f"(User: {self.discord_user_id}) encountered process exception: {e}")
-                await self.wait_until_next_update()
+    async def tick(self) -> int | None:
+        if not self.is_sync or self.end_time <= get_clock().timestamp():
+            return None
+        try:
+            await super().register(self.discord_user_id)
+            await self.claim_energy()
+            if await self.is_premium():
+                return None
+        except Exception as e:
+            self._logger.exception(f"(User: {self.discord_user_id}) encountered process exception: {e}")
+        return await self.schedule_next_update()
 
     """ Claim energy from collect machine """
     async def claim_energy(self) -> None:
@@ -166,13 +190,13 @@ class SexualDating(BaseEvent):
         user = await self.db.user.get_user(self.discord_user_id)
         return user.is_premium()
 
-    """ Override database CRUD to set next_update timestamp at wait until the energy reaches at 80% machine capacity """
-    async def wait_until_next_update(self) -> None:
+    """ Override database CRUD to set next_update timestamp when the energy reaches at 80% machine capacity, return the timestamp """
+    async def schedule_next_update(self) -> int:
         interval = int(self.duration * random.randint(80, 90) / 100)
-        next_update_ts = int(datetime.now().timestamp()) + interval
+        next_update_ts = get_clock().timestamp() + interval
         await self.db.user.set_next_update_timestamp(self.discord_user_id, next_update_ts)
-        self._logger.info(f"(User: {self.discord_user_id}) coroutine starts sleeping for {interval} seconds.")
-        await asyncio.sleep(interval)
+        self._logger.info(f"(User: {self.discord_user_id}) is scheduled to wake up in {interval} seconds.")
+        return next_update_ts
 
     def _update_duration(self) -> None:
         try:
@@ -230,8 +254,11 @@ class EventResponse(Response):
 
 async def main():
     manager = SexualDatingManager()
-    await manager.build_event_config()
-    #await manager.run()
+    try:
+        await manager.build_event_config()
+        #await manager.run()
+    finally:
+        await ConnectionPool.close()
 
 if __name__ == '__main__':
     with suppress(KeyboardInterrupt):
@@ -1,10 +1,30 @@
 # -*- coding: utf-8 -*-
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
 
 class GameAPI:
-    """ only support NTK version for now """
-    auth_url = 'https://ntk-login-api.kokmm.net'
-    data_url = 'https://ntk-zone-api.kokmm.net'
-    battle_url = 'https://ntk-zone-battle.kokmm.net'
+    """ only support NTK version for now, the hosts can be redirected (e.g. to ``mock_server.py``) by environment or ``GameAPI.configure()`` """
+    auth_url = os.environ.get('GAME_AUTH_URL', 'https://ntk-login-api.kokmm.net')
+    data_url = os.environ.get('GAME_DATA_URL', 'https://ntk-zone-api.kokmm.net')
+    battle_url = os.environ.get('GAME_BATTLE_URL', 'https://ntk-zone-battle.kokmm.net')
+    _shared = None
+
+    @classmethod
+    def configure(cls, auth_url=None, data_url=None, battle_url=None) -> None:
+        """ Point the whole client at other hosts, endpoint trees created afterwards (including the shared one) use the new URLs. """
+        cls.auth_url = auth_url or cls.auth_url
+        cls.data_url = data_url or cls.data_url
+        cls.battle_url = battle_url or cls.battle_url
+        cls._shared = None
+
+    @classmethod
+    def shared(cls):
+        """ Return the process-wide endpoint tree, the URIs are immutable strings so every caller can safely reuse it. """
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
     
     def __init__(self):
         """ A class level of King of Kinks RESTful client implementation with a collection of its APIs.
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import gc
+import glob
+import hashlib
+import io
+import logging
+import mmap
+import os
+import pickle
+import tempfile
+import threading
+import msgpack
+from collections.abc import Iterator, Mapping
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager, contextmanager, suppress
+from typing import Awaitable, Callable
+from api import GameAPI
+from clock import get_clock
+from network import CONFIG_DIR, ConnectionPool, handler
+from zipfile import ZipFile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ('AssetCache', 'AssetManifest', 'SettingReader', 'extract_setting')
+
+# directory of the decoded setting bundles shared by every process on this host, an empty string disables the cache
+ASSET_CACHE_DIR = os.environ.get("ASSET_CACHE_DIR", os.path.join(CONFIG_DIR, 'assets'))
+# seconds a fetched asset manifest is reused before it is requested again
+MANIFEST_TTL = int(os.environ.get("MANIFEST_TTL", 60))
+# bumped whenever the decoded form changes, entries of another format are never loaded
+CACHE_FORMAT = 2
+
+
+_gc_lock = threading.Lock()
+# number of tables being decoded by any thread, and whether the cyclic GC was enabled before the first one started
+_gc_pauses = 0
+_gc_was_enabled = False
+
+
+@contextmanager
+def _gc_paused():
+    """ Pause the cyclic GC until every thread decoding a table has finished, then restore its previous state. """
+    global _gc_pauses, _gc_was_enabled
+    with _gc_lock:
+        if not _gc_pauses:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_pauses -= 1
+            if not _gc_pauses and _gc_was_enabled:
+                gc.enable()
+
+
+def extract_setting(content: bytes, config: str) -> bytes:
+    """ Unzip the msgpack ``.byte`` member of a downloaded setting bundle in memory, e.g. ``MultiverseEventSetting.byte`` """
+    with ZipFile(io.BytesIO(content), 'r') as zipref:
+        return zipref.read(config.replace('.zip', '.byte'))
+
+
+class _BufferReader:
+    """ Minimal file object over a buffer, so that an ``Unpacker`` copies one ``read_size`` chunk at a time out of an mmap """
+    __slots__ = ('_view', '_pos')
+
+    def __init__(self, view: memoryview, pos=0):
+        self._view = view
+        self._pos = pos
+
+    def read(self, n=-1) -> bytes:
+        end = len(self._view) if n < 0 else min(self._pos + n, len(self._view))
+        chunk = bytes(self._view[self._pos:end])
+        self._pos = end
+        return chunk
+
+
+class SettingReader(Mapping):
+    """
+    Read-only mapping of the tables of a msgpack setting bundle, decoded lazily from ``buffer``, e.g. an mmap of the cache.
+
+    Building the reader only skips over the top-level map to record the offset of every table, a table is decoded when
+    it is looked up, and ``rows`` drops the rows of other events while streaming so that they are never kept. Every
+    lookup decodes new objects, which callers are free to modify. Rows are decoded one by one with the cyclic GC paused,
+    since a single ``msgpack.unpackb`` holds the GIL until the whole bundle is decoded and full collections over the newly
+    decoded containers hold it for longer and longer.
+    """
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._offsets: dict[str, int] = dict()
+        unpacker = self._unpacker(0)
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            self._offsets.update({ key: unpacker.tell() })
+            unpacker.skip()
+
+    def __reduce__(self):
+        # sent to worker processes as plain bytes, an mmap cannot be pickled
+        return (SettingReader, (bytes(self._view),))
+
+    def __getitem__(self, key: str):
+        return self.rows(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def rows(self, key: str, event_id: int | None = None):
+        """
+        Decode table ``key``, keeping only the rows whose ``event_id`` matches if given.
+
+        Once the ``event_id`` of a row turns out to be another event, the rest of the row is skipped without being decoded.
+        """
+        unpacker = self._unpacker(self._offsets[key])
+        try:
+            rows = unpacker.read_array_header()
+        except ValueError:
+            # not a table, the header has not been consumed
+            return unpacker.unpack()
+        with _gc_paused():
+            if event_id is None:
+                return [unpacker.unpack() for _ in range(rows)]
+            return [row for row in (self._read_row(unpacker, event_id) for _ in range(rows)) if row is not None]
+
+    def to_dict(self, *keys: str) -> dict:
+        """ Decode the tables ``keys``, every table if none is given """
+        return { key: self[key] for key in keys or self }
+
+    def _unpacker(self, offset: int) -> msgpack.Unpacker:
+        return msgpack.Unpacker(_BufferReader(self._view, offset), raw=False, strict_map_key=False, max_buffer_size=max(len(self._view) - offset, 1024 ** 2))
+
+    @staticmethod
+    def _read_row(unpacker: msgpack.Unpacker, event_id: int) -> dict | None:
+        try:
+            fields = unpacker.read_map_header()
+        except ValueError:
+            # not a row, the value has not been consumed
+            unpacker.skip()
+            return None
+        row = dict()
+        for i in range(fields):
+            key = unpacker.unpack()
+            value = unpacker.unpack()
+            if key == 'event_id' and value != event_id:
+                for _ in range(2 * (fields - i - 1)):
+                    unpacker.skip()
+                return None
+            row.update({ key: value })
+        return row
+
+
+class AssetManifest:
+    """
+    Process-wide index of the asset manifest of the game, ``filename -> netpath`` of every setting bundle.
+
+    Every ``BaseConfig`` looks its bundle up here, so managers of several events started together share one manifest
+    request: concurrent callers await the same request and a manifest younger than ``ttl`` seconds is reused. ``refresh``
+    polls it again, with ``If-None-Match`` once the server has sent an ``ETag``, and returns the bundles which changed.
+    """
+    _logger = logging.getLogger('AssetManifest')
+    _shared: 'AssetManifest | None' = None
+
+    @classmethod
+    def shared(cls) -> 'AssetManifest':
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def __init__(self, ttl=MANIFEST_TTL):
+        self.ttl = ttl
+        self.download_url: str | None = None
+        self.index: dict[str, str] = dict()
+        # clock timestamp of the latest successful request, None until the manifest has been fetched
+        self.fetched_at: float | None = None
+        self._etag: str | None = None
+        self._refreshing: asyncio.Task | None = None
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            self._logger.addHandler(handler())
+
+    @property
+    def asset_uri(self) -> str:
+        return f"{GameAPI.data_url}/api/system/assets?asset_v=0&device_type=web"
+
+    async def netpath(self, filename: str, max_age: float | None = None) -> str | None:
+        """ Netpath of the latest patch of ``filename`` from a manifest at most ``max_age`` seconds old, ``ttl`` if not given """
+        max_age = self.ttl if max_age is None else max_age
+        if self.fetched_at is None or get_clock().now() - self.fetched_at >= max_age:
+            await self.refresh()
+        return self.index.get(filename)
+
+    def url(self, netpath: str) -> str:
+        return f"{self.download_url}{netpath}"
+
+    async def refresh(self) -> set[str]:
+        """ Request the manifest again and return the filenames which are new or point to a new patch """
+        task = self._refreshing
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = self._refreshing = asyncio.ensure_future(self._fetch())
+        # a cancelled caller must not cancel the request the other callers are waiting for
+        return await asyncio.shield(task)
+
+    async def _fetch(self) -> set[str]:
+        uri = self.asset_uri
+        headers = { 'If-None-Match': self._etag } if self._etag else None
+        try:
+            async with ConnectionPool.session(uri).get(uri, headers=headers) as resp:
+                if resp.status == 304:
+                    self.fetched_at = get_clock().now()
+                    return set()
+                body = await resp.json()
+                etag = resp.headers.get('ETag')
+            download_url = body['response']['download_url']
+            index = { metadata[0]: metadata[1] for metadata in body['response']['assets']['asset_patchs'] }
+        except Exception as e:
+            self._logger.exception(f"Failed to download asset list from {uri}, exception: {e}")
+            return set()
+        changed = set(filename for filename, netpath in index.items() if self.index.get(filename) != netpath)
+        (self.download_url, self.index, self._etag) = (download_url, index, etag)
+        self.fetched_at = get_clock().now()
+        return changed
+
+
+class AssetCache:
+    """
+    On-disk cache of extracted setting bundles keyed by their CDN ``netpath``, e.g. ``<version>/MultiverseEventSetting.zip``.
+
+    The netpath changes with every asset patch, so a bundle is only downloaded and unzipped once per patch and every later
+    start memory-maps the extracted msgpack file into a ``SettingReader`` instead, sharing its pages between processes. Entries are written to a temporary file and renamed into place, and a miss is
+    filled under an exclusive ``flock`` on ``<config>.lock``, so managers of several processes sharing the directory
+    download a new patch once. Storing a patch evicts the entries of the older patches of the same bundle. Objects derived
+    from a patch, such as the ``EventPlan`` of a manager, are pickled next to it with ``store_object``.
+    """
+    _logger = logging.getLogger('AssetCache')
+    _shared: 'AssetCache | None' = None
+
+    @classmethod
+    def shared(cls) -> 'AssetCache':
+        """ Return the process-wide cache of ``ASSET_CACHE_DIR`` """
+        if cls._shared is None:
+            cls._shared = cls(ASSET_CACHE_DIR)
+        return cls._shared
+
+    def __init__(self, directory: str, lock_poll=0.05):
+        self.directory = directory
+        # seconds between two attempts to take the lock of a bundle another process is filling
+        self.lock_poll = lock_poll
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            self._logger.addHandler(handler())
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def path(self, config: str, netpath: str, suffix='.byte') -> str:
+        digest = hashlib.sha1(netpath.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f"{self._stem(config)}-{CACHE_FORMAT}-{digest}{suffix}")
+
+    def load(self, config: str, netpath: str) -> SettingReader | None:
+        """ Memory-mapped setting of ``netpath``, ``None`` if it is not cached or the entry cannot be read """
+        try:
+            with open(self.path(config, netpath), 'rb') as f:
+                # the mapping outlives the file descriptor
+                return SettingReader(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self._logger.warning(f"Dropping unreadable cache entry of {netpath}, exception: {e}")
+            return None
+
+    def load_object(self, name: str, key: str):
+        """ Object pickled by ``store_object``, e.g. an ``EventPlan`` compiled from a bundle, ``None`` if it is not cached """
+        if not self.enabled:
+            return None
+        try:
+            with open(self.path(name, key, '.pickle'), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self._logger.warning(f"Dropping unreadable cache entry of {key}, exception: {e}")
+            return None
+
+    def store_object(self, name: str, key: str, obj) -> None:
+        if self.enabled:
+            self.store(name, key, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), '.pickle')
+
+    def store(self, config: str, netpath: str, data: bytes, suffix='.byte') -> None:
+        """ Atomically write the entry of ``netpath`` and evict the entries of the other patches of ``config`` """
+        path = self.path(config, netpath, suffix)
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.directory, prefix=f".{self._stem(config)}-", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        for stale in glob.glob(os.path.join(glob.escape(self.directory), f"{glob.escape(self._stem(config))}-*")):
+            if stale != path:
+                # readers which have already opened a stale entry keep reading it, another process may have evicted it first
+                with suppress(FileNotFoundError):
+                    os.unlink(stale)
+                    self._logger.info(f"Evicted {os.path.basename(stale)}")
+
+    async def fetch(self, config: str, netpath: str, download: Callable[[], Awaitable[bytes | None]], executor: Executor | None = None) -> SettingReader | None:
+        """
+        Setting of ``netpath``, awaiting ``download()`` for the extracted bundle and caching it on a miss.
+
+        Loading and storing an entry run on ``executor``, ``None`` is returned if the download failed.
+        """
+        loop = asyncio.get_running_loop()
+        if not self.enabled:
+            data = await download()
+            return None if data is None else await loop.run_in_executor(executor, SettingReader, data)
+        setting = await loop.run_in_executor(executor, self.load, config, netpath)
+        if setting is not None:
+            return setting
+        async with self.lock(config):
+            # another process may have filled it while we were waiting for the lock
+            setting = await loop.run_in_executor(executor, self.load, config, netpath)
+            if setting is not None:
+                return setting
+            data = await download()
+            if data is None:
+                return None
+            try:
+                await loop.run_in_executor(executor, self.store, config, netpath, data)
+            except OSError as e:
+                self._logger.warning(f"Failed to cache {netpath}, exception: {e}")
+            setting = await loop.run_in_executor(executor, self.load, config, netpath)
+            return setting if setting is not None else await loop.run_in_executor(executor, SettingReader, data)
+
+    @asynccontextmanager
+    async def lock(self, config: str):
+        """ Exclusive lock of the entries of ``config`` across processes, polled so that the event loop is never blocked """
+        if fcntl is None or not self.enabled:
+            yield
+            return
+        with open(os.path.join(self.directory, f"{self._stem(config)}.lock"), 'a+b') as f:
+            while True:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(self.lock_poll)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _stem(config: str) -> str:
+        return os.path.splitext(config)[0]
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the per-user memory footprint of ``MultiverseDating`` instances, with and without the shared flyweights.
+
+The instances are handed to a ``Scheduler`` and run their first tick, as ``BaseEventManager`` does on a cold start.
+
+Usage: python3 -m benchmarks.footprint [--users N]
+"""
+import argparse
+import asyncio
+import gc
+import os
+import tempfile
+import tracemalloc
+
+os.environ.setdefault('LOCAL_STORAGE', os.path.join(tempfile.gettempdir(), 'kok_footprint.json'))
+os.environ.setdefault('CONFIG_DIR', os.path.join(tempfile.gettempdir(), 'kok_config'))
+os.environ.setdefault('PASSWORD', '')
+
+from clock import get_clock
+from event import BaseEvent, Scheduler
+from storage import DiscordID
+
+
+class FootprintEvent(BaseEvent):
+    """ Minimal event carrying the same per-user state as ``MultiverseDating`` without any event logic. """
+    def __init__(self, discord_user_id, shared):
+        super().__init__(shared=shared)
+        self.discord_user_id = discord_user_id
+        self.energy = 0
+        self.duration = 0
+        self.is_sync = False
+
+    async def on_start(self):
+        ...
+
+    async def tick(self):
+        return None
+
+
+def storage_handle(db):
+    """ Handle the user table is stored through, the JSON storage of the TinyDB backend or the SQLite connection. """
+    return getattr(db, 'storage_type', None) or db.connection
+
+
+async def run_first_ticks(scheduler: Scheduler) -> None:
+    runner = asyncio.create_task(scheduler.run())
+    try:
+        while scheduler.due or scheduler.next_due() is not None:
+            await asyncio.sleep(0.01)
+    finally:
+        runner.cancel()
+
+
+async def measure(users: int, shared: bool) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    scheduler = Scheduler()
+    now_ts = get_clock().timestamp()
+    for i in range(users):
+        discord_id = DiscordID(100000000000000000 + i)
+        scheduler.insert(discord_id, FootprintEvent(discord_id, shared), now_ts)
+    await run_first_ticks(scheduler)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    storages = len(set(id(storage_handle(scheduler.cancel(discord_id).db)) for discord_id in list(scheduler)))
+    return { 'shared': shared, 'users': users, 'bytes_per_user': allocated // users, 'storage_handles': storages }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+    for shared in (False, True):
+        result = asyncio.run(measure(args.users, shared))
+        print(f"shared={result['shared']!s:<5} users={result['users']} bytes/user={result['bytes_per_user']} storage handles={result['storage_handles']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the standard library JSON codec against ``ujson`` on the bodies the event scripts exchange with the game.
+
+Response shapes follow ``mock_server.py``: a ``multiverse_dating/records`` body carrying ``--dialogs`` dialog records,
+an ``explore/claim`` body, and the cost payloads ``build_event_config`` pre-serializes from the setting bundle.
+
+Usage: python3 -m benchmarks.serializer [--dialogs 300] [--number 2000]
+"""
+import argparse
+import os
+import tempfile
+import timeit
+
+os.environ.setdefault('LOCAL_STORAGE', os.path.join(tempfile.gettempdir(), 'kok_serializer.json'))
+os.environ.setdefault('CONFIG_DIR', os.path.join(tempfile.gettempdir(), 'kok_config'))
+os.environ.setdefault('PASSWORD', '')
+
+from mock_server import ENERGY_ID, EVENT_ID, build_setting_bundles
+from network import Serializer, UJSONSerializer, ujson
+
+
+def records_body(dialogs: int) -> dict:
+    record = { 'event_id': EVENT_ID, 'level': 3, 'exp': 420, 'current_question': 2, 'item_tier': 2, 'meet_count': 4, 'claim_reward_level': [1, 2], 'last_claim_time': 1700000000 }
+    dialog_records = [
+        { 'event_id': EVENT_ID, 'level': i // 5 + 1, 'question_id': i % 5, 'select_id': i % 3, 'is_true': 1, 'create_time': 1700000000 + i, 'update_time': 1700000000 + i }
+        for i in range(dialogs)
+    ]
+    return { 'success': True, 'error_code': 0, 'error_message': None, 'response': { 'user_multiverse_dating_records': [record], 'user_multiverse_dating_dialog_records': dialog_records } }
+
+
+def claim_body() -> dict:
+    record = records_body(0)['response']['user_multiverse_dating_records'][0]
+    return {
+        'success': True, 'error_code': 0, 'error_message': None,
+        'response': { 'user_multiverse_dating_record': record, 'asset_return': [{ 'asset_type': 6, 'asset_id': ENERGY_ID, 'amount': 90 }] },
+        'updated_item_list': [{ 'asset_type': 6, 'asset_id': ENERGY_ID, 'amount': 1290 }],
+    }
+
+
+def cost_payloads() -> list:
+    setting = build_setting_bundles(1700000000)['MultiverseEventSetting.zip']
+    return [[answer['cost'][0]] for qa in setting['multiverse_dating_question_settings'] for q in qa['question'] for answer in q['answer_list']]
+
+
+def measure(serializer: Serializer, number: int, dialogs: int) -> dict[str, float]:
+    """ Microseconds per call of each operation """
+    stdlib = Serializer()
+    records = stdlib.dumps(records_body(dialogs)).encode()
+    claim = stdlib.dumps(claim_body()).encode()
+    body = records_body(dialogs)
+    costs = cost_payloads()
+    cases = {
+        'loads records': lambda: serializer.loads(records),
+        'loads claim': lambda: serializer.loads(claim),
+        'dumps costs': lambda: [serializer.dumps(cost) for cost in costs],
+        'dumps records (indent=2)': lambda: serializer.dumps(body, indent=2),
+    }
+    return { name: timeit.timeit(case, number=number) / number * 1e6 for name, case in cases.items() }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dialogs', type=int, default=300, help="dialog records in the records response")
+    parser.add_argument('--number', type=int, default=2000, help="calls per operation")
+    args = parser.parse_args()
+    serializers = [Serializer()] + ([UJSONSerializer()] if ujson else [])
+    results = { serializer.name: measure(serializer, args.number, args.dialogs) for serializer in serializers }
+    print(f"{'operation':<28}" + ''.join(f"{name + ' (us)':>14}" for name in results) + (f"{'speed-up':>10}" if len(results) > 1 else ''))
+    for case in results['json']:
+        timings = [result[case] for result in results.values()]
+        speedup = f"{timings[0] / timings[1]:>9.1f}x" if len(timings) > 1 else ''
+        print(f"{case:<28}" + ''.join(f"{timing:>14.2f}" for timing in timings) + speedup)
+
+
+if __name__ == '__main__':
+    main()
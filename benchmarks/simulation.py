@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replay a whole event in simulated time against an in-process ``mock_server.py``.
+
+The process-wide clock is replaced by a ``clock.SimulatedClock``, so the manager, the scheduler, the storage and the mock
+server all share one virtual clock which jumps straight to the next deadline whenever no tick is running. The report
+holds the simulated span, the wall time it took, the request volume per endpoint and per simulated hour, and is saved as
+JSON to profile scheduling and request volume over the lifetime of an event.
+
+Usage: python3 -m benchmarks.simulation [--users 1000] [--days 7] [--output result.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import Counter
+from benchmarks.throughput import EVENTS, seed_users
+
+import aiohttp
+from api import GameAPI
+from clock import SimulatedClock, set_clock
+from mock_server import MockGameServer
+from network import ConnectionPool
+
+
+class VolumeRecorder:
+    """ ``aiohttp.TraceConfig`` counting requests by path and by simulated hour """
+    def __init__(self, clock: SimulatedClock):
+        self.clock = clock
+        self.start = clock.timestamp()
+        self.paths = Counter()
+        self.hours = Counter()
+        self.trace = aiohttp.TraceConfig()
+        self.trace.on_request_end.append(self._on_end)
+
+    async def _on_end(self, session, context, params):
+        self.paths[params.url.path] += 1
+        self.hours[(self.clock.timestamp() - self.start) // 3600] += 1
+
+
+async def run(args) -> dict:
+    clock = SimulatedClock()
+    set_clock(clock)
+    server = MockGameServer(latency=args.latency, error_rate=args.error_rate)
+    GameAPI.configure(*await server.start(port=args.port))
+    recorder = VolumeRecorder(clock)
+    ConnectionPool.trace_configs.append(recorder.trace)
+    try:
+        (module_name, manager_name) = EVENTS[args.event]
+        module = __import__(module_name)
+        await seed_users(args.users)
+        manager = getattr(module, manager_name)(concurrency=args.concurrency, workers=args.workers, interval=args.interval)
+        await manager.build_event_config()
+        if args.days:
+            manager.end_time = min(manager.end_time, recorder.start + int(args.days * 86400))
+        start = time.perf_counter()
+        await manager.run()
+        elapsed = time.perf_counter() - start
+    finally:
+        await ConnectionPool.close()
+        await server.stop()
+    hours = [recorder.hours[hour] for hour in range(max(recorder.hours, default=-1) + 1)]
+    return {
+        'timestamp': int(time.time()),
+        'parameters': vars(args),
+        'users': args.users,
+        'simulated_seconds': clock.timestamp() - recorder.start,
+        'wall_seconds': elapsed,
+        'clock_jumps': clock.jumps,
+        'requests': sum(hours),
+        'requests_per_path': dict(recorder.paths.most_common()),
+        'requests_per_hour': hours,
+        'peak_requests_per_hour': max(hours, default=0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--event', choices=EVENTS, default='multiverse')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--days', type=float, default=None, help="simulated days to replay, the whole event if not set")
+    parser.add_argument('--concurrency', type=int, default=20, help="cold start concurrency of the manager")
+    parser.add_argument('--workers', type=int, default=10, help="scheduler workers of the manager")
+    parser.add_argument('--interval', type=int, default=300, help="seconds between two user table scans of the manager")
+    parser.add_argument('--port', type=int, default=18180)
+    parser.add_argument('--latency', type=float, default=0.0, help="mean latency of the mock server in real seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--output', default=None, help="path of the JSON report, defaults to simulation-<event>-<users>-<timestamp>.json")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    result = asyncio.run(run(args))
+    output = args.output or f"simulation-{args.event}-{args.users}-{result['timestamp']}.json"
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps({ key: value for key, value in result.items() if key not in ('parameters', 'requests_per_hour') }, indent=2))
+    print(f"Saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
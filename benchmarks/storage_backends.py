@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the TinyDB JSON and SQLite (WAL) storage backends on the UserTable operations used by the event loop.
+
+Usage: python3 -m benchmarks.storage_backends [--users 1000 10000 100000] [--ops 20]
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault('LOCAL_STORAGE', os.path.join(tempfile.gettempdir(), 'kok_storage.json'))
+os.environ.setdefault('CONFIG_DIR', os.path.join(tempfile.gettempdir(), 'kok_config'))
+os.environ.setdefault('PASSWORD', '')
+
+from storage import Database, DiscordID, SQLiteDatabase, UserDocument, USER_FIELDS
+
+
+def synthetic_users(count: int) -> list[UserDocument]:
+    users = list()
+    for i in range(count):
+        user = dict.fromkeys(USER_FIELDS)
+        user.update({ 'nutaku_id': 1000000 + i, 'user_id': 1010000000000 + i, 'premium': i % 10 == 0, 'bot': False, 'session_id': 'f' * 40, 'socket_token': 'f' * 40, 'create_time': 0, 'last_update': 0, 'last_session_update': 0, 'next_update': random.randint(0, 2 * int(time.time())) })
+        users.append(UserDocument(user, DiscordID(100000000000000000 + i)))
+    return users
+
+
+async def seed(backend: str, path: str, users: list[UserDocument]):
+    if backend == 'json':
+        db = Database(path)
+        await db.user.insert_multiple(users)
+    else:
+        db = SQLiteDatabase(path)
+        await db.user.insert_documents(users)
+    return db
+
+
+async def timed(ops: int, func) -> float:
+    """ Return the mean duration of ``func`` in milliseconds. """
+    start = time.perf_counter()
+    for _ in range(ops):
+        await func()
+    return (time.perf_counter() - start) * 1000 / ops
+
+
+async def run(backend: str, count: int, ops: int) -> dict:
+    users = synthetic_users(count)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'users.json' if backend == 'json' else 'users.sqlite')
+        db = await seed(backend, path, users)
+        keys = [doc.doc_id for doc in random.sample(users, ops)]
+        pick = iter(keys * 3).__next__
+        result = {
+            'get_user': await timed(ops, lambda: db.user.get_user(pick())),
+            'set_next_update_timestamp': await timed(ops, lambda: db.user.set_next_update_timestamp(pick(), 0)),
+            'update_session_id': await timed(ops, lambda: db.user.update_session_id(pick(), 'e' * 40)),
+            'get_next_update_users': await timed(max(ops // 10, 1), db.user.get_next_update_users),
+        }
+        if backend == 'sqlite':
+            db.close()
+        return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--ops', type=int, default=20)
+    args = parser.parse_args()
+    print(f"{'backend':<8}{'users':>8}  " + "".join(f"{name:>28}" for name in ('get_user', 'set_next_update_timestamp', 'update_session_id', 'get_next_update_users')))
+    for count in args.users:
+        for backend in ('json', 'sqlite'):
+            result = await run(backend, count, args.ops)
+            print(f"{backend:<8}{count:>8}  " + "".join(f"{value:>25.3f} ms" for value in result.values()))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
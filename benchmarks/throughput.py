@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput benchmark of an event manager against ``mock_server.py``.
+
+N synthetic users are seeded into a fresh SQLite ``UserTable``, then the full manager path runs: ``build_event_config``,
+``_start_new_instances`` for every user, and ``--ticks`` rounds in which every user is due at once. The report holds
+requests/sec, request latency percentiles, event loop lag, RSS per user and cold-start time, and is saved as JSON.
+
+Usage: python3 -m benchmarks.throughput [--users 1000] [--ticks 3] [--latency 0.02] [--output result.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# removed once the benchmark has finished, or at exit
+WORKDIR = tempfile.TemporaryDirectory(prefix='kok_throughput_')
+os.environ['LOCAL_STORAGE'] = os.path.join(WORKDIR.name, 'users.sqlite')
+os.environ.setdefault('CONFIG_DIR', os.path.join(WORKDIR.name, 'config'))
+os.environ.setdefault('PASSWORD', '')
+
+import aiohttp
+from api import GameAPI
+from network import ConnectionPool
+from storage import DiscordID, SQLiteDatabase, UserDocument, USER_FIELDS, LOCAL_STORAGE
+
+MOCK_SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mock_server.py')
+EVENTS = {
+    'multiverse': ('MultiverseDating', 'MultiverseDatingManager'),
+    'sexual': ('SexualDating', 'SexualDatingManager'),
+}
+
+
+def percentiles(samples: list[float]) -> dict:
+    if len(samples) < 2:
+        return { 'p50': samples[0] if samples else 0.0, 'p95': samples[0] if samples else 0.0, 'p99': samples[0] if samples else 0.0, 'max': max(samples, default=0.0) }
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return { 'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98], 'max': max(samples) }
+
+
+def rss_kb() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+class RequestRecorder:
+    """ ``aiohttp.TraceConfig`` collecting the latency of every request sent through ``ConnectionPool`` """
+    def __init__(self):
+        self.latencies: list[float] = list()
+        self.failures = 0
+        self.trace = aiohttp.TraceConfig()
+        self.trace.on_request_start.append(self._on_start)
+        self.trace.on_request_end.append(self._on_end)
+        self.trace.on_request_exception.append(self._on_exception)
+
+    async def _on_start(self, session, context, params):
+        context.start = time.perf_counter()
+
+    async def _on_end(self, session, context, params):
+        self.latencies.append((time.perf_counter() - context.start) * 1000)
+
+    async def _on_exception(self, session, context, params):
+        self.failures += 1
+
+
+class LoopLagSampler:
+    """ Measure how late the event loop wakes up a coroutine sleeping for ``interval`` seconds. """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lags: list[float] = list()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(loop.time() - start - self.interval, 0) * 1000)
+
+
+async def start_mock_server(args) -> tuple[subprocess.Popen, tuple[str, str, str]]:
+    """ Run ``mock_server.py`` in its own process so that its CPU time does not distort the client measurements. """
+    command = [sys.executable, MOCK_SERVER, '--port', str(args.port), '--latency', str(args.latency), '--error-rate', str(args.error_rate), '--time-scale', str(args.time_scale)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = await asyncio.to_thread(process.stdout.readline)
+    urls = dict(item.split('=', 1) for item in line.split())
+    return process, (urls['GAME_AUTH_URL'], urls['GAME_DATA_URL'], urls['GAME_BATTLE_URL'])
+
+
+async def seed_users(count: int) -> list[DiscordID]:
+    users = list()
+    for i in range(count):
+        user = dict.fromkeys(USER_FIELDS)
+        user.update({ 'nutaku_id': 1000000 + i, 'user_id': 1010000000000 + i, 'premium': True, 'bot': False, 'create_time': 0, 'last_update': 0, 'last_session_update': 0, 'next_update': 0 })
+        users.append(UserDocument(user, DiscordID(100000000000000000 + i)))
+    db = SQLiteDatabase(LOCAL_STORAGE)
+    await db.user.insert_documents(users)
+    db.close()
+    return [user.doc_id for user in users]
+
+
+async def wait_for_round(scheduler, round_ts: int) -> None:
+    """ Wait until every scheduled user has finished a tick started at or after ``round_ts``. """
+    while True:
+        next_ts = scheduler.next_due()
+        if not scheduler.due and (next_ts is None or next_ts > round_ts):
+            return None
+        await asyncio.sleep(0.05)
+
+
+async def run(args) -> dict:
+    server, urls = await start_mock_server(args)
+    GameAPI.configure(*urls)
+    recorder = RequestRecorder()
+    ConnectionPool.trace_configs.append(recorder.trace)
+    sampler = LoopLagSampler()
+    sampling = asyncio.create_task(sampler.run())
+    try:
+        (module_name, manager_name) = EVENTS[args.event]
+        module = __import__(module_name)
+        users = await seed_users(args.users)
+        baseline_rss = rss_kb()
+        manager = getattr(module, manager_name)(concurrency=args.concurrency, workers=args.workers)
+        await manager.build_event_config()
+        scheduler = asyncio.create_task(manager._scheduler.run())
+        start = time.perf_counter()
+        await manager._start_new_instances(users)
+        # the first round is the immediate tick which follows every insert
+        round_ts = int(time.time())
+        await wait_for_round(manager._scheduler, round_ts)
+        for _ in range(args.ticks - 1):
+            round_ts = int(time.time())
+            for discord_id in manager._running_users:
+                manager._scheduler.reschedule(discord_id, round_ts)
+            await wait_for_round(manager._scheduler, round_ts)
+        elapsed = time.perf_counter() - start
+        rss_per_user = (rss_kb() - baseline_rss) / max(len(manager._running_users), 1)
+        scheduler.cancel()
+        await manager.user.flush()
+    finally:
+        sampling.cancel()
+        await ConnectionPool.close()
+        server.terminate()
+        server.wait()
+    return {
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'users': args.users,
+        'running_users': len(manager._running_users),
+        'cold_start_seconds': manager.cold_start_time,
+        'elapsed_seconds': elapsed,
+        'requests': len(recorder.latencies),
+        'request_failures': recorder.failures,
+        'requests_per_second': len(recorder.latencies) / elapsed,
+        'request_latency_ms': percentiles(recorder.latencies),
+        'loop_lag_ms': percentiles(sampler.lags),
+        'rss_per_user_kb': rss_per_user,
+    }
+
+
+def compare(result: dict, baseline: dict) -> None:
+    for key in ('cold_start_seconds', 'requests_per_second', 'rss_per_user_kb'):
+        print(f"{key:<24}{baseline[key]:>12.2f} -> {result[key]:>12.2f}")
+    for group in ('request_latency_ms', 'loop_lag_ms'):
+        for key in ('p50', 'p95', 'p99'):
+            print(f"{group + '.' + key:<24}{baseline[group][key]:>12.2f} -> {result[group][key]:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--event', choices=EVENTS, default='multiverse')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--ticks', type=int, default=3, help="number of rounds in which every user runs one tick")
+    parser.add_argument('--concurrency', type=int, default=20, help="cold start concurrency of the manager")
+    parser.add_argument('--workers', type=int, default=10, help="scheduler workers of the manager")
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=0.02, help="mean latency of the mock server in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--time-scale', type=float, default=3600.0, help="energy accrual speed-up of the mock server")
+    parser.add_argument('--output', default=None, help="path of the JSON report, defaults to throughput-<event>-<users>-<timestamp>.json")
+    parser.add_argument('--compare', default=None, help="JSON report of a previous run to compare against")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    with WORKDIR:
+        result = asyncio.run(run(args))
+    output = args.output or f"throughput-{args.event}-{args.users}-{result['timestamp']}.json"
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps({ key: value for key, value in result.items() if key != 'parameters' }, indent=2))
+    print(f"Saved to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
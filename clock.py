@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+
+__all__ = ('Clock', 'SimulatedClock', 'get_clock', 'set_clock')
+
+
+class Clock:
+    """
+    Wall clock used for every event deadline: ``end_time`` checks, wake-up timestamps and storage timestamps.
+
+    Work which must finish before time moves on (a running tick, a cold start round) is wrapped in ``busy()``,
+    which only matters for ``SimulatedClock``.
+    """
+    def now(self) -> float:
+        return time.time()
+
+    def timestamp(self) -> int:
+        return int(self.now())
+
+    async def sleep(self, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+
+    async def wait(self, event: asyncio.Event, timeout: float | None = None) -> bool:
+        """ Wait until ``event`` is set or ``timeout`` seconds have passed, return whether the event was set. """
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def acquire(self) -> None:
+        pass
+
+    def release(self) -> None:
+        pass
+
+    @contextmanager
+    def busy(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class SimulatedClock(Clock):
+    """
+    Virtual clock which jumps straight to the next deadline once nothing is busy.
+
+    Time only advances when every coroutine is either sleeping on this clock or idle, e.g. the scheduler waiting for the
+    next due user while no tick is running, so a week-long event is replayed as fast as the ticks themselves run.
+    Network I/O, including the latency of ``mock_server.py``, still takes real time but happens at a frozen clock.
+    """
+    def __init__(self, start: float | None = None, settle=10):
+        self._now = time.time() if start is None else start
+        # number of loop iterations to wait for woken up coroutines to acquire the clock before the next jump
+        self._settle = settle
+        self._holds = 0
+        self._sleepers: list[tuple[float, int, asyncio.Future]] = list()
+        self._seq = itertools.count()
+        self._changed: asyncio.Event | None = None
+        self._advancer: asyncio.Task | None = None
+        # number of jumps and total simulated seconds skipped
+        self.jumps = 0
+        self.skipped = 0.0
+
+    def now(self) -> float:
+        return self._now
+
+    async def sleep(self, seconds: float) -> None:
+        future = self._schedule(seconds)
+        try:
+            await future
+        finally:
+            future.cancel()
+
+    async def wait(self, event: asyncio.Event, timeout: float | None = None) -> bool:
+        if event.is_set():
+            return True
+        waiter = asyncio.ensure_future(event.wait())
+        timer = self._schedule(timeout) if timeout is not None else None
+        try:
+            await asyncio.wait([waiter, timer] if timer else [waiter], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            if timer:
+                timer.cancel()
+        return event.is_set()
+
+    def acquire(self) -> None:
+        self._holds += 1
+
+    def release(self) -> None:
+        self._holds -= 1
+        if not self._holds:
+            self._notify()
+
+    def _schedule(self, seconds: float) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self._now + max(seconds, 0), next(self._seq), future))
+        self._notify()
+        return future
+
+    def _notify(self) -> None:
+        if self._advancer is None or self._advancer.done():
+            self._changed = asyncio.Event()
+            self._advancer = asyncio.create_task(self._advance())
+        self._changed.set()
+
+    async def _advance(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            # give woken up coroutines a chance to acquire the clock or go back to sleep first
+            for _ in range(self._settle):
+                await asyncio.sleep(0)
+            if self._changed.is_set() or self._holds:
+                continue
+            while self._sleepers and self._sleepers[0][2].done():
+                heapq.heappop(self._sleepers)
+            if not self._sleepers:
+                continue
+            deadline = self._sleepers[0][0]
+            if deadline > self._now:
+                self.jumps += 1
+                self.skipped += deadline - self._now
+                self._now = deadline
+            while self._sleepers and self._sleepers[0][0] <= self._now:
+                (_, _, future) = heapq.heappop(self._sleepers)
+                if not future.done():
+                    future.set_result(None)
+            self._changed.set()
+
+
+_clock = Clock()
+
+
+def get_clock() -> Clock:
+    return _clock
+
+
+def set_clock(clock: Clock) -> None:
+    """ Replace the process-wide clock, e.g. with a ``SimulatedClock`` before any event manager is started. """
+    global _clock
+    _clock = clock
@@ -2,65 +2,120 @@
 import json
 import logging
 import os
-import io
-import msgpack
 import asyncio
-import aiohttp
-from zipfile import ZipFile
-from datetime import datetime
+import hashlib
+import heapq
+import itertools
+import time
+from concurrent.futures import Executor
+from contextlib import suppress
 from abc import abstractmethod
-from typing import Coroutine
-from network import NetworkManager, CONFIG_DIR
-from storage import Database, DiscordID, LOCAL_STORAGE
+from typing import Awaitable, Callable
+from assets import AssetCache, AssetManifest, SettingReader, extract_setting
+from clock import get_clock
+from metrics import Metrics
+from monitor import LoopMonitor
+from network import ConnectionPool, NetworkManager
+from storage import DiscordID, LOCAL_STORAGE, get_database
+
+__all__ = ('Action', 'ActionPipeline', 'BaseConfig', 'BaseEvent', 'BaseEventManager', 'EventPlan', 'Scheduler', 'SharedPlan', 'shard_of')
+
+# local port of the Prometheus metrics endpoint, shard N of a sharded manager listens on METRICS_PORT + N, 0 disables it
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# 1 runs a ``LoopMonitor`` next to every event manager, logging loop lag and blocking functions every minute
+LOOP_MONITOR = os.environ.get("LOOP_MONITOR", "0") == "1"
+# seconds between two checks of the asset manifest for a new patch of the running event setting, 0 disables hot reload
+RELOAD_INTERVAL = int(os.environ.get("RELOAD_INTERVAL", 600))
+# requests a user keeps in flight while running a batch of independent actions, 1 sends them one after another
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", 4))
+# bumped whenever the plan compiled by an event manager changes, cached plans of another format are compiled again
+PLAN_FORMAT = 2
+
+
+def shard_of(discord_id: DiscordID, shards: int) -> int:
+    """ Stable shard index of a user, snowflake IDs are hashed first since their low bits are mostly a sequence number. """
+    digest = hashlib.blake2b(str(discord_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
 
-__all__ = ('BaseConfig', 'BaseEvent', 'BaseEventManager')
 
 class BaseConfig:
+    """
+    Setting bundle ``config`` of the asset CDN, e.g. ``MultiverseEventSetting.zip``, located by ``AssetManifest.shared()``.
+
+    The bundle is unzipped on ``executor``, the loop's default thread pool if not given, so that a large bundle does not
+    stall the running users, and read as a ``SettingReader`` which only decodes the tables looked up. Extracted bundles
+    are kept in ``cache``, ``AssetCache.shared()`` if not given, and only downloaded again once the asset manifest points
+    to a new patch.
+    """
     _logger = logging.getLogger('EventConfig')
-    asset_uri = 'https://ntk-zone-api.kokmm.net/api/system/assets?asset_v=0&device_type=web'
 
-    def __init__(self, config: str):
+    def __init__(self, config: str, executor: Executor | None = None, cache: AssetCache | None = None):
         self._config = config
+        self._executor = executor
+        self._cache = cache or AssetCache.shared()
 
-    async def _get_asset_list(self) -> list:
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(self.asset_uri) as resp:
-                    body = await resp.json()
-                    self.download_url = body['response']['download_url']
-                    return body['response']['assets']['asset_patchs']
-            except Exception as e:
-                self._logger.exception(f"Failed to download asset list from {self.asset_uri}, exception: {e}")
-
-    async def get_dict(self) -> dict | None:
-        netpath = None
-        asset_list = await self._get_asset_list()
-        for metadata in asset_list:
-            if metadata[0] == self._config:
-                netpath = metadata[1]
-                asset_url = f"{self.download_url}{netpath}"
-                async with aiohttp.ClientSession() as session:
-                    try:
-                        async with session.get(asset_url) as resp:
-                            assert resp.status == 200
-                            content = await resp.read()
-                            bytestream = io.BytesIO(content)
-                            filename = self._config.replace('.zip', '.byte')
-                            full_path = os.path.join(CONFIG_DIR, filename)
-                            with ZipFile(bytestream, 'r') as zipref:
-                                zipref.extractall(CONFIG_DIR)
-                                with open(full_path, 'br') as f:
-                                    setting_dict = msgpack.unpackb(f.read(), raw=False, strict_map_key=False)
-                                    return setting_dict
-                    except Exception as e:
-                        self._logger.exception(f"Failed to download (Filename: {self._config}) from {asset_url}, exception: {e}")
+    @classmethod
+    async def get_dicts(cls, *configs: str, executor: Executor | None = None, cache: AssetCache | None = None) -> dict[str, SettingReader | None]:
+        """ Download and read several setting bundles concurrently, they share a single manifest request """
+        settings = await asyncio.gather(*[cls(config, executor, cache).get_dict() for config in configs])
+        return dict(zip(configs, settings))
+
+    async def get_dict(self) -> SettingReader | None:
+        netpath = await AssetManifest.shared().netpath(self._config)
+        if netpath is not None:
+            setting = await self._cache.fetch(self._config, netpath, lambda: self._download(netpath), self._executor)
+            if setting is not None:
+                return setting
         self._logger.error(f"Could not find config file with the name {self._config}")
         return None
 
+    async def _download(self, netpath: str) -> bytes | None:
+        asset_url = AssetManifest.shared().url(netpath)
+        try:
+            async with ConnectionPool.session(asset_url).get(asset_url) as resp:
+                assert resp.status == 200
+                content = await resp.read()
+            return await asyncio.get_running_loop().run_in_executor(self._executor, extract_setting, content, self._config)
+        except Exception as e:
+            self._logger.exception(f"Failed to download (Filename: {self._config}) from {asset_url}, exception: {e}")
+            return None
+
+
+class EventPlan:
+    """
+    Tables of the running event compiled from a setting bundle by ``BaseEventManager.compile_event_plan``.
+
+    The plan is cached next to the bundle it was compiled from, ``version`` being the bundle netpath, so later starts and
+    the workers of a sharded manager load it with a single unpickle. Its tables are shared read-only by every user instance.
+    """
+    __slots__ = ('event_id', 'end_time', 'tables', 'version')
+
+    def __init__(self, event_id: int, end_time: int, tables: dict, version: str | None = None):
+        self.event_id = event_id
+        self.end_time = end_time
+        self.tables = tables
+        self.version = version
+
+    def __repr__(self) -> str:
+        return f"EventPlan(event_id={self.event_id}, end_time={self.end_time}, version={self.version})"
+
+
+class SharedPlan:
+    """
+    Current ``EventPlan`` of a manager, referenced by every user instance it creates.
+
+    A hot reload replaces ``plan`` with a single assignment, so every instance sees the new tables from its next lookup
+    while its own session and event records are kept.
+    """
+    __slots__ = ('plan',)
+
+    def __init__(self, plan: EventPlan | None = None):
+        self.plan = plan
+
 
 class BaseEvent(NetworkManager):
-    def __init__(self, *, filepath=LOCAL_STORAGE):
-        super().__init__(filepath)
+    def __init__(self, *, filepath=LOCAL_STORAGE, shared=True):
+        super().__init__(filepath, shared)
 
     @abstractmethod
     async def on_start(self) -> None:
@@ -72,30 +127,305 @@ class BaseEvent(NetworkManager):
         raise NotImplementedError()
 
     @abstractmethod
-    async def run_loop(self) -> None:
+    async def tick(self) -> int | None:
         """
-        This is where you put automation services after awaiting ``self.on_start()``
+        This is where you put automation services after awaiting ``self.on_start()``, one call runs a single wake-up.
+
+        NOTE: It must return the timestamp of the next wake-up, or ``None`` once the user has nothing left to do.
         """
         raise NotImplementedError()
 
+    async def run_loop(self) -> None:
+        """
+        Run ``self.tick()`` on a dedicated coroutine until it returns ``None``, sleeping in between wake-ups.
+        The ``Scheduler`` replaces this loop for instances managed by ``BaseEventManager``.
+        """
+        while True:
+            self.reset_retry_budget()
+            if (next_update_ts := await self.tick()) is None:
+                return None
+            await get_clock().sleep(max(next_update_ts - get_clock().timestamp(), 0))
+
+
+class Action:
+    """ A request of an ``ActionPipeline``, sent once every action it comes ``after`` has been answered. """
+    __slots__ = ('api_name', 'payload', 'after')
+
+    def __init__(self, api_name, payload: dict, after: tuple['Action', ...] = ()):
+        self.api_name = api_name
+        self.payload = payload
+        self.after = after
+
+
+class ActionPipeline:
+    """
+    Batch of game actions of one user, sent with at most ``depth`` requests in flight.
+
+    Actions are independent unless they are added ``after`` others, e.g. a machine upgrade after the level claim which
+    grants its materials. ``run`` returns the responses in submission order, so that the record snapshots they carry
+    are folded back in the order the actions were described. Snapshots of concurrent actions may be answered out of
+    order by the server, records which matter afterwards should be fetched again.
+    """
+    def __init__(self, send: Callable[..., Awaitable], depth=PIPELINE_DEPTH):
+        self._send = send
+        self._depth = max(depth, 1)
+        self._actions: list[Action] = list()
+
+    def __len__(self) -> int:
+        return len(self._actions)
+
+    def add(self, api_name, payload: dict, after: tuple[Action, ...] = ()) -> Action:
+        action = Action(api_name, payload, after)
+        self._actions.append(action)
+        return action
+
+    async def run(self) -> list:
+        """ Send every action added since the last run, return their responses in submission order. """
+        (actions, self._actions) = (self._actions, list())
+        semaphore = asyncio.Semaphore(self._depth)
+        answered = { action: asyncio.Event() for action in actions }
+        responses = [None] * len(actions)
+
+        async def send(index: int, action: Action) -> None:
+            for previous in action.after:
+                await answered[previous].wait()
+            async with semaphore:
+                responses[index] = await self._send(action.api_name, action.payload)
+            answered[action].set()
+
+        async with asyncio.TaskGroup() as group:
+            for index, action in enumerate(actions):
+                group.create_task(send(index, action))
+        return responses
+
+
+class Scheduler:
+    """
+    Central deadline scheduler for user instances.
+
+    Due times are kept in a min-heap and due users are dispatched to a bounded pool of workers, each running a single
+    ``BaseEvent.tick()`` before the user is pushed back with the returned timestamp. Cancelled or rescheduled entries
+    are left in the heap and skipped once popped, so every operation costs O(log n).
+
+    Due times are read from ``clock.get_clock()``, and a dispatched user holds the clock until its tick has finished,
+    so that a ``SimulatedClock`` only jumps to the next deadline once the workers are idle.
+    """
+    _logger = logging.getLogger('Scheduler')
+
+    def __init__(self, workers=10, retry_delay=300):
+        self._workers = workers
+        self._retry_delay = retry_delay
+        self._heap: list[tuple[int, int, DiscordID]] = list()
+        # the only valid (due, seq) heap entry of each scheduled user
+        self._entries: dict[DiscordID, tuple[int, int]] = dict()
+        self._instances: dict[DiscordID, BaseEvent] = dict()
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+        self._queue: asyncio.Queue[DiscordID] = asyncio.Queue(maxsize=workers)
+        self._busy = 0
+
+    def __contains__(self, discord_id: DiscordID) -> bool:
+        return discord_id in self._instances
+
+    def __iter__(self):
+        return iter(self._instances)
 
-class BaseEventManager(Database):
-    _logger: logging.getLogger(__name__)
-    _running_users: set[DiscordID] = set()
-    _coroutines: dict[DiscordID, Coroutine] = dict()
+    def __len__(self) -> int:
+        return len(self._instances)
+
+    @property
+    def due(self) -> int:
+        """ Number of users which are waiting for a worker or running a tick right now. """
+        return self._queue.qsize() + self._busy
+
+    def insert(self, discord_id: DiscordID, instance: BaseEvent, due_ts: int) -> None:
+        """ Schedule ``instance`` to run its first tick at ``due_ts``, replacing any instance already scheduled for the user. """
+        self._instances.update({ discord_id: instance })
+        self.reschedule(discord_id, due_ts)
+
+    def reschedule(self, discord_id: DiscordID, due_ts: int) -> None:
+        if discord_id not in self._instances:
+            return None
+        entry = (due_ts, next(self._seq))
+        self._entries.update({ discord_id: entry })
+        heapq.heappush(self._heap, (*entry, discord_id))
+        self._changed.set()
+
+    def next_due(self) -> int | None:
+        """ Return the earliest due time of the scheduled users, or None if no user is waiting for its next tick. """
+        while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][:2]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def cancel(self, discord_id: DiscordID) -> BaseEvent | None:
+        """ Unregister the user, a tick which is already running finishes but is not scheduled again. """
+        self._entries.pop(discord_id, None)
+        return self._instances.pop(discord_id, None)
+
+    async def run(self) -> None:
+        """ Dispatch due users to the workers until cancelled. """
+        workers = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+        clock = get_clock()
+        try:
+            while True:
+                self._changed.clear()
+                now_ts = clock.timestamp()
+                while self._heap and self._heap[0][0] <= now_ts:
+                    (due_ts, seq, discord_id) = heapq.heappop(self._heap)
+                    if self._entries.get(discord_id) == (due_ts, seq):
+                        del self._entries[discord_id]
+                        # the clock stands still until the worker has finished the tick
+                        clock.acquire()
+                        await self._queue.put(discord_id)
+                timeout = self._heap[0][0] - now_ts if self._heap else None
+                await clock.wait(self._changed, timeout)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _worker(self) -> None:
+        clock = get_clock()
+        while True:
+            discord_id = await self._queue.get()
+            instance = self._instances.get(discord_id)
+            if instance is None:
+                clock.release()
+                continue
+            self._busy += 1
+            try:
+                instance.reset_retry_budget()
+                next_update_ts = await instance.tick()
+            except Exception as e:
+                self._logger.exception(f"(User: {discord_id}) failed to run the scheduled tick, exception: {e}")
+                next_update_ts = clock.timestamp() + self._retry_delay
+            finally:
+                self._busy -= 1
+                clock.release()
+            # the user may have been cancelled or replaced while the tick was running,
+            # a finished user stays registered without a due time so that it is not started again
+            if self._instances.get(discord_id) is instance and discord_id not in self._entries and next_update_ts is not None:
+                self.reschedule(discord_id, next_update_ts)
+
+
+class BaseEventManager:
+    _logger = logging.getLogger('EventManager')
     
-    def __init__(self, config: str, filepath=LOCAL_STORAGE, interval=300):
-        super().__init__(filepath)
+    def __init__(self, config: str, filepath=LOCAL_STORAGE, interval=300, workers=10, concurrency=20, shard: tuple[int, int] | None = None, metrics_port=METRICS_PORT, loop_monitor=LOOP_MONITOR, reload_interval=RELOAD_INTERVAL):
+        self.db = get_database(filepath)
+        self.user = self.db.user
         self.config = config
         self._interval = interval
+        self._scheduler = Scheduler(workers)
+        # maximum number of ``on_start()`` running at the same time
+        self._concurrency = concurrency
+        # (processed, total) users of the latest ``_start_new_instances`` round, and its duration in seconds
+        self.cold_start_progress = (0, 0)
+        self.cold_start_time = 0.0
+        # (index, count) of the user partition served by this manager, every user if not set
+        self._shard = shard
+        self._metrics_port = metrics_port
+        self._loop_monitor = loop_monitor
+        self._reload_interval = reload_interval
+        # plan of the running event shared with the user instances, and the number of plans swapped in by hot reload
+        self.shared_plan = SharedPlan()
+        self.plan_reloads = 0
+        self._register_gauges()
+
+    @property
+    def plan(self) -> EventPlan | None:
+        return self.shared_plan.plan
+
+    @property
+    def _running_users(self) -> set[DiscordID]:
+        return set(self._scheduler)
     
+    @staticmethod
+    async def build_event_configs(*managers: 'BaseEventManager') -> None:
+        """
+        Build the plans of several managers started together, their setting bundles are downloaded concurrently
+        """
+        settings = await BaseConfig.get_dicts(*set(manager.config for manager in managers))
+        await asyncio.gather(*[manager.build_event_config(settings[manager.config]) for manager in managers])
+
+    async def build_event_config(self, config: SettingReader | None = None) -> None:
+        """
+        Load the plan of the running event, compiled from ``config`` if the setting bundle was downloaded already
+        """
+        plan = await self.load_event_plan(config)
+        if plan is None:
+            self._logger.error(f"There's no event of {self.config} running right now.")
+            return None
+        self.apply_event_plan(plan)
+
     @abstractmethod
-    async def build_event_config(self):
+    def compile_event_plan(self, config: SettingReader) -> EventPlan | None:
         """
-        Build a minimal infotainment for customised event automation
+        Build a minimal infotainment for customised event automation from the setting bundle, ``None`` if no event is running.
+
+        NOTE: It runs on an executor thread and must not touch the manager, look the tables of the running event up with
+        ``config.rows(table, event_id)``, rows of other events are then never decoded.
         """
         raise NotImplementedError()
 
+    def apply_event_plan(self, plan: EventPlan) -> None:
+        self.shared_plan.plan = plan
+        self.event_id = plan.event_id
+        self.end_time = plan.end_time
+
+    async def reload_event_plan(self) -> bool:
+        """
+        Compile the plan of the latest patch in the background and swap it in for every running user, return whether it was.
+
+        A patch which schedules another event is not applied, this manager keeps serving the running event until it ends.
+        """
+        plan = await self.load_event_plan()
+        if plan is None:
+            self._logger.warning(f"Could not build the plan of the latest {self.config} patch, keeping {self.plan}.")
+            return False
+        if plan.event_id != self.event_id:
+            self._logger.warning(f"The latest {self.config} patch runs event {plan.event_id} instead of {self.event_id}, keeping {self.plan}.")
+            return False
+        self.apply_event_plan(plan)
+        self.plan_reloads += 1
+        self._logger.info(f"Reloaded {plan} for {len(self._scheduler)} running users.")
+        return True
+
+    async def load_event_plan(self, config: SettingReader | None = None) -> EventPlan | None:
+        """
+        Plan of the running event, loaded from ``AssetCache`` when it was compiled from the latest patch already.
+
+        A cached plan of an event which has ended is compiled again, the same patch may schedule the next event.
+        """
+        loop = asyncio.get_running_loop()
+        if config is not None:
+            plan = await loop.run_in_executor(None, self.compile_event_plan, config)
+            if plan is not None:
+                # the bundle was downloaded from the current manifest entry, which the asset watcher compares the plan to
+                plan.version = await AssetManifest.shared().netpath(self.config)
+            return plan
+        netpath = await AssetManifest.shared().netpath(self.config)
+        if netpath is None:
+            return None
+        cache = AssetCache.shared()
+        name = type(self).__name__
+        key = f"{netpath}#plan{PLAN_FORMAT}"
+        async with cache.lock(name):
+            plan = await loop.run_in_executor(None, cache.load_object, name, key)
+            if plan is not None and plan.end_time > get_clock().timestamp():
+                return plan
+            setting = await BaseConfig(self.config).get_dict()
+            if setting is None:
+                return None
+            plan = await loop.run_in_executor(None, self.compile_event_plan, setting)
+            if plan is not None:
+                plan.version = netpath
+                try:
+                    await loop.run_in_executor(None, cache.store_object, name, key, plan)
+                except OSError as e:
+                    self._logger.warning(f"Failed to cache the plan of {netpath}, exception: {e}")
+            return plan
+
     @abstractmethod
     def create_user_instance(self, discord_id: DiscordID) -> BaseEvent:
         """
@@ -105,66 +435,115 @@ class BaseEventManager(Database):
         """
         raise NotImplementedError()
 
-    async def run(self, semaphore=asyncio.Semaphore(5)):
+    async def run(self):
         """
-        Main entry for all customised EventManager coroutines
+        Main entry for all customised EventManager coroutines, queued user updates are committed and the pooled connections are released on exit.
         """
-        while self.end_time > int(datetime.now().timestamp()):
-            await self._premium_pass(semaphore)
-            # give premium users more time to run event tasks
-            await asyncio.sleep(10)
-            (new_users, delete_users) = await self._maintain_users()
-            await self._start_new_instances(new_users, semaphore)
-            self._delete_running_instances(delete_users)
-            # sleep for (default=60) seconds
-            await asyncio.sleep(self._interval)
+        clock = get_clock()
+        if self._metrics_port:
+            await Metrics.serve(port=self._metrics_port + (self._shard[0] if self._shard else 0))
+        scheduler = asyncio.create_task(self._scheduler.run())
+        monitor = asyncio.create_task(LoopMonitor().run()) if self._loop_monitor else None
+        watcher = asyncio.create_task(self._watch_assets()) if self._reload_interval else None
+        try:
+            while self.end_time > clock.timestamp():
+                with clock.busy():
+                    await self._premium_pass()
+                # give premium users more time to run event tasks
+                await clock.sleep(10)
+                with clock.busy():
+                    (new_users, delete_users) = await self._maintain_users()
+                    await self._start_new_instances(new_users)
+                    self._delete_running_instances(delete_users)
+                # sleep for (default=60) seconds
+                await clock.sleep(self._interval)
+        finally:
+            # running ticks must be done with the table and the pooled sessions before they are flushed and closed
+            for task in (scheduler, watcher, monitor):
+                if task:
+                    task.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await task
+            self._delete_running_instances(self._running_users)
+            await self.user.flush()
+            await ConnectionPool.close()
+            await Metrics.stop()
 
-    async def _premium_pass(self, semaphore) -> None:
+    async def _watch_assets(self) -> None:
+        """ Reload the event plan whenever the asset manifest points to another patch of ``config`` than the plan's. """
+        clock = get_clock()
+        manifest = AssetManifest.shared()
+        while True:
+            await clock.sleep(self._reload_interval)
+            with clock.busy():
+                try:
+                    netpath = await manifest.netpath(self.config, max_age=self._reload_interval)
+                    if netpath is not None and self.plan is not None and netpath != self.plan.version:
+                        self._logger.info(f"Found a new patch {netpath} of {self.config}.")
+                        await self.reload_event_plan()
+                except Exception as e:
+                    self._logger.exception(f"Failed to check {self.config} for a new patch, exception: {e}")
+
+    async def _premium_pass(self) -> None:
         """
         Initialise ``self._running_users`` hash set with premium subscribers and with isolated run time on startup.
         """
         if self._running_users:
             return None
         premium_users = await self.user.get_premium_users()
-        sync_ids = set(map(lambda doc: doc.doc_id, premium_users))
-        await self._start_new_instances(sync_ids, semaphore)
+        sync_ids = set(doc.doc_id for doc in premium_users if self._in_shard(doc.doc_id))
+        await self._start_new_instances(sync_ids)
 
-    async def _start_new_instances(self, new_users: list[DiscordID], semaphore) -> None:
+    async def _start_new_instances(self, new_users: list[DiscordID]) -> None:
         """
-        Create and start running user coroutines by ``asyncio.create_task``.
-        Ff the event ``on_start()`` failed, drop the instance and wait for next ``self._interval``
+        Create user instances concurrently, at most ``self._concurrency`` at once, and hand them over to ``self._scheduler``
+        with an immediate first tick. If the event ``on_start()`` failed, drop the instance and wait for next ``self._interval``
         """
-        for discord_id in new_users:
+        if not new_users:
+            return None
+        total = len(new_users)
+        # log progress at every 10% of the round
+        step = max(total // 10, 1)
+        semaphore = asyncio.Semaphore(self._concurrency)
+        processed = failed = 0
+        start_time = time.perf_counter()
+        self.cold_start_progress = (0, total)
+
+        async def start(discord_id: DiscordID) -> None:
+            nonlocal processed, failed
             async with semaphore:
                 try:
                     new_event = self.create_user_instance(discord_id)
                     await new_event.on_start()
-                    new_instance = asyncio.create_task(new_event.run_loop())
-                    # append corountine with matched DiscordID
-                    self._running_users.add(discord_id)
-                    if discord_id not in self._coroutines.keys():
-                        new_record = { discord_id: new_instance }
-                        self._coroutines.update(new_record)
+                    if discord_id not in self._scheduler:
+                        self._scheduler.insert(discord_id, new_event, get_clock().timestamp())
                 except Exception as e:
+                    failed += 1
                     self._logger.exception(f"(User: {discord_id}) failed to launch the instance on cold start, exception: {e}")
+                finally:
+                    processed += 1
+                    self.cold_start_progress = (processed, total)
+                    if processed % step == 0 or processed == total:
+                        self._logger.info(f"Cold start progress: {processed}/{total} users ({failed} failed)")
+
+        await asyncio.gather(*(start(discord_id) for discord_id in new_users))
+        self.cold_start_time = time.perf_counter() - start_time
+        self._logger.info(f"Cold start of {total} users finished in {self.cold_start_time:.2f} seconds ({failed} failed)")
 
     def _delete_running_instances(self, delete_users: list[DiscordID]) -> None:
         """
-        Cancel running coroutines matched by DiscordID, then delete entry from ``self._running_users``
+        Remove the users matched by DiscordID from ``self._scheduler``
         """
         for discord_id in delete_users:
-            self._running_users.discard(discord_id)
-            if discord_id in self._coroutines.keys():
-                on_cancel_event = self._coroutines.pop(discord_id)
-                on_cancel_event.cancel()
-                    
+            self._scheduler.cancel(discord_id)
+
     async def _maintain_users(self) -> (set[DiscordID], set[DiscordID]):
         """
         Maintain local hash set of running instances by comparing to table users, returns a tuple of new and deleted user sets
         """
         new_users = delete_users = set()
         from_table = await self.user.get_all_users()
-        sync_ids = set(map(lambda doc: doc.doc_id, from_table))
+        sync_ids = set(doc.doc_id for doc in from_table if self._in_shard(doc.doc_id))
         if self._running_users:
             new_users = sync_ids.difference(self._running_users)
             delete_users = self._running_users.difference(sync_ids)
@@ -174,3 +553,16 @@ class BaseEventManager(Database):
         else:
             new_users = sync_ids
         return (new_users, delete_users)
+
+    def _register_gauges(self) -> None:
+        labels = { 'event': self.config, 'shard': self._shard[0] if self._shard else 0 }
+        Metrics.gauge('kok_scheduler_running_users', "Users registered in the scheduler.", lambda: len(self._scheduler), **labels)
+        Metrics.gauge('kok_scheduler_due_users', "Users waiting for a worker or running a tick.", lambda: self._scheduler.due, **labels)
+        Metrics.gauge('kok_scheduler_workers', "Scheduler workers.", lambda: self._scheduler._workers, **labels)
+        Metrics.gauge('kok_cold_start_processed_users', "Users launched or failed in the latest cold start round.", lambda: self.cold_start_progress[0], **labels)
+        Metrics.gauge('kok_cold_start_users', "Users of the latest cold start round.", lambda: self.cold_start_progress[1], **labels)
+        Metrics.gauge('kok_cold_start_seconds', "Duration of the latest finished cold start round.", lambda: self.cold_start_time, **labels)
+        Metrics.gauge('kok_event_plan_reloads_total', "Event plans swapped in by hot reload.", lambda: self.plan_reloads, counter=True, **labels)
+
+    def _in_shard(self, discord_id: DiscordID) -> bool:
+        return self._shard is None or shard_of(discord_id, self._shard[1]) == self._shard[0]
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import bisect
+import logging
+from collections import Counter
+from typing import Callable
+from aiohttp import web
+
+__all__ = ('Histogram', 'Metrics')
+
+# upper bounds in seconds of the request latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last slot counts the observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """ ``(le, count)`` pairs in Prometheus order, ending with ``+Inf`` """
+        pairs = list()
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            pairs.append((f"{bound:g}", total))
+        pairs.append(('+Inf', self.count))
+        return pairs
+
+
+class EndpointStats:
+    __slots__ = ('requests', 'errors', 'bytes_in', 'bytes_out', 'latency')
+
+    def __init__(self):
+        self.requests = 0
+        # error_code -> number of failed requests
+        self.errors = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+
+
+class Metrics:
+    """
+    Process-wide request counters by endpoint path and registered gauges, rendered in the Prometheus text format.
+
+    ``NetworkManager`` records every request with ``observe_request``, event managers and rate limiters register gauges
+    which are read when the metrics are rendered. ``serve`` exposes them on ``http://<host>:<port>/metrics``.
+    """
+    _logger = logging.getLogger('Metrics')
+    _endpoints: dict[tuple[str, str], EndpointStats] = dict()
+    # name -> (help, type, { labels: read })
+    _gauges: dict[str, tuple[str, str, dict[tuple[tuple[str, str], ...], Callable[[], float]]]] = dict()
+    _runner: web.AppRunner | None = None
+
+    @classmethod
+    def observe_request(cls, method: str, path: str, latency: float, bytes_out: int, bytes_in: int, error_code: int | None) -> None:
+        stats = cls._endpoints.get((method, path))
+        if stats is None:
+            stats = cls._endpoints.setdefault((method, path), EndpointStats())
+        stats.requests += 1
+        stats.bytes_out += bytes_out
+        stats.bytes_in += bytes_in
+        stats.latency.observe(latency)
+        if error_code is not None:
+            stats.errors[error_code] += 1
+
+    @classmethod
+    def gauge(cls, name: str, help: str, read: Callable[[], float], counter=False, **labels) -> None:
+        """ Register ``read`` as the value of ``name`` with ``labels``, replacing a callback registered with the same labels. """
+        (_, _, series) = cls._gauges.setdefault(name, (help, 'counter' if counter else 'gauge', dict()))
+        series.update({ tuple(sorted((key, str(value)) for key, value in labels.items())): read })
+
+    @classmethod
+    def remove_gauges(cls, **labels) -> None:
+        """ Drop every gauge series carrying all of ``labels``, e.g. those of a manager which has finished. """
+        wanted = set((key, str(value)) for key, value in labels.items())
+        for (_, _, series) in cls._gauges.values():
+            for key in [key for key in series if wanted.issubset(key)]:
+                del series[key]
+
+    @classmethod
+    def render(cls) -> str:
+        lines = list()
+        endpoints = sorted(cls._endpoints.items())
+        lines += ['# HELP kok_requests_total Requests sent to the game servers.', '# TYPE kok_requests_total counter']
+        lines += [f'kok_requests_total{{method="{method}",path="{path}"}} {stats.requests}' for (method, path), stats in endpoints]
+        lines += ['# HELP kok_request_errors_total Failed requests by game error_code, -1 for requests without an answer.', '# TYPE kok_request_errors_total counter']
+        for (method, path), stats in endpoints:
+            lines += [f'kok_request_errors_total{{method="{method}",path="{path}",error_code="{code}"}} {count}' for code, count in sorted(stats.errors.items())]
+        lines += ['# HELP kok_request_bytes_sent_total Request body bytes sent.', '# TYPE kok_request_bytes_sent_total counter']
+        lines += [f'kok_request_bytes_sent_total{{method="{method}",path="{path}"}} {stats.bytes_out}' for (method, path), stats in endpoints]
+        lines += ['# HELP kok_request_bytes_received_total Response body bytes received.', '# TYPE kok_request_bytes_received_total counter']
+        lines += [f'kok_request_bytes_received_total{{method="{method}",path="{path}"}} {stats.bytes_in}' for (method, path), stats in endpoints]
+        lines += ['# HELP kok_request_duration_seconds Request latency including rate limiting.', '# TYPE kok_request_duration_seconds histogram']
+        for (method, path), stats in endpoints:
+            labels = f'method="{method}",path="{path}"'
+            lines += [f'kok_request_duration_seconds_bucket{{{labels},le="{le}"}} {count}' for le, count in stats.latency.cumulative()]
+            lines += [f'kok_request_duration_seconds_sum{{{labels}}} {stats.latency.sum}', f'kok_request_duration_seconds_count{{{labels}}} {stats.latency.count}']
+        for name, (help, kind, series) in sorted(cls._gauges.items()):
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+            for labels, read in series.items():
+                label_str = ','.join(f'{key}="{value}"' for key, value in labels)
+                try:
+                    lines.append(f'{name}{{{label_str}}} {read()}' if label_str else f'{name} {read()}')
+                except Exception as e:
+                    cls._logger.warning(f"Failed to read {name}{{{label_str}}}, exception: {e}")
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    async def serve(cls, host='127.0.0.1', port=9100) -> None:
+        """ Serve ``render()`` on ``/metrics`` until ``stop()`` """
+        if cls._runner is not None:
+            return None
+        app = web.Application()
+        app.router.add_get('/metrics', cls._handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        cls._runner = runner
+        cls._logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    @classmethod
+    async def stop(cls) -> None:
+        runner, cls._runner = cls._runner, None
+        if runner is not None:
+            await runner.cleanup()
+
+    @classmethod
+    async def _handle(cls, request: web.Request) -> web.Response:
+        return web.Response(text=cls.render(), headers={ 'Content-Type': 'text/plain; version=0.0.4; charset=utf-8' })
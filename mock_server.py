@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the King of Kinks game servers, for load and regression testing of the event automation.
+
+The auth, data and battle hosts of ``api.GameAPI`` are served on three consecutive ports, and the asset manifest serves
+a synthetic setting bundle for both the Clicker 2 (``SexualDatingSetting.zip``) and Clicker 2.5
+(``MultiverseEventSetting.zip``) events. Every player is provisioned on first login and keeps its own event state:
+energy accrues by machine tier, dialog answers advance the question and level, level rewards grant gifts and upgrade
+materials, and the daily meet attempts are restored at midnight UTC of the clock.
+
+Known gaps against the real servers:
+    - ``sexual_dating/claim`` and ``sexual_dating/reset`` are not served, the event scripts never call them.
+    - Clicker 2.5 levels advance by completing the dialog of a level only, the EXP of ``LEVELS`` is shipped in the
+      setting bundle but EXP gained from meets, gifts and answers never levels up a player on its own.
+
+Usage: python3 mock_server.py [--port 8080] [--latency 0.05] [--error-rate 0.01] [--time-scale 60]
+then point the client at it with ``GAME_AUTH_URL=http://127.0.0.1:8081 GAME_DATA_URL=http://127.0.0.1:8080 GAME_BATTLE_URL=http://127.0.0.1:8082``
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import random
+import secrets
+import msgpack
+from collections import Counter
+from zipfile import ZipFile
+from aiohttp import web
+from clock import Clock, get_clock
+
+__all__ = ('MockGameServer', 'SESSION_ERROR_CODE')
+
+# error codes returned by the mock, set SESSION_ERROR_CODES to SESSION_ERROR_CODE to exercise re-logins
+SESSION_ERROR_CODE = 10003
+ITEM_NOT_OWNED_CODE = 11002
+INVALID_REQUEST_CODE = 10000
+SERVER_BUSY_CODE = 10500
+
+EVENT_ID = 1
+ENERGY_ID = '2000001'
+MATERIAL_ID = '2000002'
+GIFT_IDS = ('2000011', '2000012', '2000013', '2000014')
+# machine tier -> (energy per hour, seconds until the machine is full, upgrade cost)
+TIERS = { 1: (60, 3600, 0), 2: (90, 5400, 1), 3: (120, 7200, 2), 4: (150, 10800, 3) }
+# level -> (questions, energy cost per answer, exp required to reach the next level, only shipped in the setting bundle)
+LEVELS = { level: (5, 25 * level, 100 * level) for level in range(1, 7) }
+LEVEL_REWARDS = { 1: [(MATERIAL_ID, 0), (GIFT_IDS[0], 2)], 2: [(MATERIAL_ID, 1), (GIFT_IDS[1], 2)], 3: [(GIFT_IDS[2], 3)], 4: [(MATERIAL_ID, 2), (GIFT_IDS[3], 3)], 5: [(MATERIAL_ID, 3)], 6: [(GIFT_IDS[0], 5)] }
+MAX_MEET = 10
+
+
+def _asset(asset_id: str, amount: int, asset_type=6) -> dict:
+    return { 'asset_type': asset_type, 'asset_id': asset_id, 'amount': amount }
+
+
+def _config(asset: dict) -> dict:
+    """ The setting bundle carries an extra ``config`` key in every cost and reward, which the client strips. """
+    return dict(asset, config={})
+
+
+def _correct_answer(level: int, question_id: int) -> int:
+    return (level + question_id) % 3
+
+
+def build_setting_bundles(now_ts: int) -> dict[str, dict]:
+    """ Return the synthetic setting dictionaries by zip filename, with an event running from a day ago until a week from now. """
+    timeslot = [{ 'start_time': now_ts - 86400, 'end_time': now_ts + 7 * 86400 }]
+    multiverse = {
+        'multiverse_dating_settings': [{ 'event_id': EVENT_ID, 'timeslot_detail': timeslot }],
+        'multiverse_dating_level_settings': [{ 'event_id': EVENT_ID, 'level': 0, 'exp': 0, 'reward_list': [] }] + [
+            { 'event_id': EVENT_ID, 'level': level, 'exp': LEVELS[level][2], 'reward_list': [_config(_asset(asset_id, amount)) for (asset_id, amount) in rewards] }
+            for level, rewards in LEVEL_REWARDS.items()
+        ],
+        'multiverse_dating_explore_item_settings': [
+            { 'event_id': EVENT_ID, 'tier': tier, 'tier_cost': [_config(_asset(MATERIAL_ID, cost))] if cost else [], 'max_duration': duration }
+            for tier, (_, duration, cost) in TIERS.items()
+        ],
+        'multiverse_dating_question_settings': [
+            { 'event_id': EVENT_ID, 'level': level, 'question': [
+                { 'answer_list': [{ 'is_true': int(a_idx == _correct_answer(level, q_idx)), 'cost': [_config(_asset(ENERGY_ID, cost))] } for a_idx in range(3)] }
+                for q_idx in range(questions)
+            ] }
+            for level, (questions, cost, _) in LEVELS.items()
+        ],
+    }
+    sexual = {
+        'sexual_dating_settings': [{ 'event_id': EVENT_ID, 'timeslot_detail': timeslot }],
+        'message_detail_settings': [
+            { 'chapter': chapter, 'message_data': [
+                { 'id': message_id, 'selection_list': [{ 'selection_id': selection, 'correct': int(selection == 1), 'energy_cost': 10 } for selection in range(1, 4)] if message_id % 2 else [] }
+                for message_id in range(1, 11)
+            ] }
+            for chapter in range(1, 6)
+        ],
+        'explore_item_settings': [
+            { 'event_id': EVENT_ID, 'tier': tier, 'cost_list': [_config(_asset(MATERIAL_ID, cost))] if cost else [], 'max_explore_limit': duration }
+            for tier, (_, duration, cost) in TIERS.items()
+        ],
+        'h_sence_settings': [
+            { 'event_id': EVENT_ID, 'chapter_id': chapter, 'max_exp': 1000, 'active': 1, 'option_detail': [
+                { 'exp': 10 * op_id, 'exp_require': 100 * op_id, 'item_cost': [_config(_asset(ENERGY_ID, 5 * op_id))] }
+                for op_id in range(1, 5)
+            ] }
+            for chapter in range(1, 6)
+        ],
+    }
+    return { 'MultiverseEventSetting.zip': multiverse, 'SexualDatingSetting.zip': sexual }
+
+
+def pack_bundle(filename: str, setting: dict) -> bytes:
+    """ Zip the msgpack encoded setting the way the CDN ships it, e.g. ``MultiverseEventSetting.zip`` holding ``MultiverseEventSetting.byte`` """
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w') as zipref:
+        zipref.writestr(filename.replace('.zip', '.byte'), msgpack.packb(setting, use_bin_type=True))
+    return buffer.getvalue()
+
+
+class Player:
+    """ Server-side state of one player """
+    def __init__(self, nutaku_id: int, prefix: int, now: float):
+        self.nutaku_id = nutaku_id
+        self.user_id = int(f"{prefix}{nutaku_id % 10 ** 10:010d}")
+        self.name = f"Player{nutaku_id}"
+        self.session_id = None
+        self.session_time = 0.0
+        self.items = Counter({ ENERGY_ID: 0 })
+        self.multiverse = { 'event_id': EVENT_ID, 'level': 1, 'exp': 0, 'current_question': 0, 'item_tier': 1, 'meet_count': 0, 'claim_reward_level': [], 'last_claim_time': now }
+        # day number of the latest meet attempt, the attempts are restored on the next day
+        self.meet_day = 0
+        self.sexual = { 'event_id': EVENT_ID, 'chapter_id': 1, 'message_id': 0, 'exp': 0 }
+        self.sexual_machine = { 'event_id': EVENT_ID, 'tier': 1, 'last_claim_time': now }
+
+    def me(self) -> dict:
+        return { 'user_id': str(self.user_id), 'display_name': self.name, 'last_login_time': int(self.session_time) }
+
+
+class MockGameServer:
+    """
+    aiohttp application emulating the game servers.
+
+    ``latency`` (mean seconds, exponentially distributed) and ``error_rate`` (probability of a server busy answer) apply to
+    every request, ``time_scale`` speeds up energy accrual, and ``session_ttl`` expires sessions after that many seconds.
+    Game time is read from ``clock``, the process-wide clock by default, so an in-process server follows a ``SimulatedClock``.
+    """
+    _logger = logging.getLogger('MockGameServer')
+
+    def __init__(self, latency=0.0, error_rate=0.0, time_scale=1.0, session_ttl=None, clock: Clock | None = None):
+        self.clock = clock or get_clock()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.time_scale = time_scale
+        self.session_ttl = session_ttl
+        self.players: dict[int, Player] = dict()
+        self.accounts: dict[int, Player] = dict()
+        self.stats = Counter()
+        self.bundles = { filename: pack_bundle(filename, setting) for filename, setting in build_setting_bundles(self.clock.timestamp()).items() }
+        self.versions = { filename: hashlib.sha1(content).hexdigest()[:12] for filename, content in self.bundles.items() }
+        self._runner: web.AppRunner | None = None
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.router.add_routes([
+            web.post('/api/auth/login/game_account', self.login_game_account),
+            web.post('/api/auth/login/user', self.login_user),
+            web.get('/api/user/info', self.user_info),
+            web.get('/api/system/assets', self.assets),
+            web.get('/assets/{version}/{filename}', self.download),
+            web.get('/api/multiverse_dating/records', self.multiverse_records),
+            web.post('/api/multiverse_dating/view/avg', self.multiverse_view_avg),
+            web.post('/api/multiverse_dating/explore/claim', self.multiverse_claim),
+            web.post('/api/multiverse_dating/explore/upgrade', self.multiverse_upgrade),
+            web.post('/api/multiverse_dating/meet', self.multiverse_meet),
+            web.post('/api/multiverse_dating/gift', self.multiverse_gift),
+            web.post('/api/multiverse_dating/level/claim', self.multiverse_level_claim),
+            web.post('/api/multiverse_dating/select', self.multiverse_select),
+            web.get('/api/sexual_dating/records', self.sexual_records),
+            web.post('/api/sexual_dating/claimItemExplore', self.sexual_claim),
+            web.post('/api/sexual_dating/upgradeExploreItemTier', self.sexual_upgrade),
+            web.post('/api/sexual_dating/saveMessage', self.sexual_save_message),
+            web.post('/api/sexual_dating/choose', self.sexual_choose),
+            web.post('/api/sexual_dating/option/click', self.sexual_click),
+        ])
+
+    async def start(self, host='127.0.0.1', port=8080) -> tuple[str, str, str]:
+        """ Serve the data, auth and battle hosts on ``port``, ``port + 1`` and ``port + 2``, return their base URLs in ``GameAPI.configure`` order. """
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        for offset in range(3):
+            await web.TCPSite(self._runner, host, port + offset).start()
+        self.base_url = f"http://{host}:{port}"
+        return (f"http://{host}:{port + 1}", self.base_url, f"http://{host}:{port + 2}")
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        self.stats[request.path] += 1
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return self._error(SERVER_BUSY_CODE, "Server is busy, please try again later.")
+        return await handler(request)
+
+    """ Auth """
+    async def login_game_account(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        nutaku_id = int(form['login_id'])
+        player = self.accounts.get(nutaku_id)
+        session_id = secrets.token_hex(20)
+        if player:
+            player.session_id = session_id
+        return self._ok({ 'session_id': session_id, 'account_id': nutaku_id })
+
+    async def login_user(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        nutaku_id = int(form['account_id'])
+        player = self.accounts.get(nutaku_id)
+        if player is None:
+            player = Player(nutaku_id, int(form['server_prefix']), self._now())
+            self.accounts.update({ nutaku_id: player })
+            self.players.update({ player.user_id: player })
+        player.session_id = form['session_id']
+        player.session_time = self.clock.now()
+        return self._ok({ 'socket_token': secrets.token_hex(20) }, me=player.me())
+
+    async def user_info(self, request: web.Request) -> web.Response:
+        player = self._authorise(request)
+        if isinstance(player, web.Response):
+            return player
+        return self._ok({}, me=player.me())
+
+    """ Assets """
+    async def assets(self, request: web.Request) -> web.Response:
+        patches = [[filename, f"{version}/{filename}"] for filename, version in self.versions.items()]
+        etag = '"' + hashlib.sha1(repr(patches).encode()).hexdigest()[:12] + '"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={ 'ETag': etag })
+        response = self._ok({ 'download_url': f"{self.base_url}/assets/", 'assets': { 'asset_patchs': patches } })
+        response.headers['ETag'] = etag
+        return response
+
+    async def download(self, request: web.Request) -> web.Response:
+        filename = request.match_info['filename']
+        if self.versions.get(filename) != request.match_info['version']:
+            return web.Response(status=404)
+        return web.Response(body=self.bundles[filename], content_type='application/zip')
+
+    """ Clicker 2.5 """
+    async def multiverse_records(self, request: web.Request) -> web.Response:
+        player = self._authorise(request)
+        if isinstance(player, web.Response):
+            return player
+        self._restore_meets(player)
+        return self._ok({ 'user_multiverse_dating_records': [player.multiverse], 'user_multiverse_dating_dialog_records': [] })
+
+    async def multiverse_view_avg(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        return self._ok({ 'user_multiverse_dating_record': player.multiverse })
+
+    async def multiverse_claim(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        record = player.multiverse
+        (per_hour, duration, _) = TIERS[record['item_tier']]
+        now = self._now()
+        elapsed = min(now - record['last_claim_time'], duration)
+        amount = int(elapsed * per_hour / 3600)
+        record['last_claim_time'] = now
+        player.items[ENERGY_ID] += amount
+        return self._ok({ 'user_multiverse_dating_record': record, 'asset_return': [_asset(ENERGY_ID, amount)] }, updated_item_list=[_asset(ENERGY_ID, player.items[ENERGY_ID])])
+
+    async def multiverse_upgrade(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        record = player.multiverse
+        tier = int(request['form']['tier'])
+        if tier != record['item_tier'] + 1 or tier not in TIERS:
+            return self._error(INVALID_REQUEST_CODE, f"Cannot upgrade from tier {record['item_tier']} to tier {tier}.")
+        cost = TIERS[tier][2]
+        if player.items[MATERIAL_ID] < cost:
+            return self._error(ITEM_NOT_OWNED_CODE, "Not enough upgrade materials.")
+        player.items[MATERIAL_ID] -= cost
+        record['item_tier'] = tier
+        return self._ok({ 'user_multiverse_dating_record': record }, reduced_item_list=[_asset(MATERIAL_ID, player.items[MATERIAL_ID])])
+
+    async def multiverse_meet(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        self._restore_meets(player)
+        record = player.multiverse
+        if record['meet_count'] >= MAX_MEET:
+            return self._error(INVALID_REQUEST_CODE, "No meet attempts left today.")
+        record['meet_count'] += 1
+        player.meet_day = self.clock.timestamp() // 86400
+        self._gain_exp(record, 5)
+        return self._ok({ 'user_multiverse_dating_record': record })
+
+    async def multiverse_gift(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        item_id = request['form']['item_id']
+        if player.items[item_id] <= 0:
+            return self._error(ITEM_NOT_OWNED_CODE, f"Item {item_id} is not owned.")
+        player.items[item_id] -= 1
+        self._gain_exp(player.multiverse, 20)
+        return self._ok({ 'user_multiverse_dating_record': player.multiverse }, reduced_item_list=[_asset(item_id, player.items[item_id])])
+
+    async def multiverse_level_claim(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        record = player.multiverse
+        level = int(request['form']['level'])
+        if level > record['level'] or level in record['claim_reward_level'] or level not in LEVEL_REWARDS:
+            return self._error(INVALID_REQUEST_CODE, f"Level {level} rewards are not claimable.")
+        record['claim_reward_level'].append(level)
+        rewards = [_asset(asset_id, amount) for (asset_id, amount) in LEVEL_REWARDS[level] if amount]
+        for reward in rewards:
+            player.items[reward['asset_id']] += reward['amount']
+        return self._ok({ 'user_multiverse_dating_record': record, 'asset_return': rewards })
+
+    async def multiverse_select(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        record = player.multiverse
+        if record['level'] not in LEVELS:
+            return self._error(INVALID_REQUEST_CODE, "Every dialog has been completed.")
+        (questions, cost, _) = LEVELS[record['level']]
+        if player.items[ENERGY_ID] < cost:
+            return self._error(ITEM_NOT_OWNED_CODE, "Not enough energy.")
+        player.items[ENERGY_ID] -= cost
+        if int(request['form']['select_id']) == _correct_answer(record['level'], record['current_question']):
+            record['current_question'] += 1
+            self._gain_exp(record, 10)
+            if record['current_question'] >= questions:
+                record['current_question'] = 0
+                record['level'] += 1
+        return self._ok({ 'user_multiverse_dating_record': record }, reduced_item_list=[_asset(ENERGY_ID, player.items[ENERGY_ID])])
+
+    """ Clicker 2 """
+    async def sexual_records(self, request: web.Request) -> web.Response:
+        player = self._authorise(request)
+        if isinstance(player, web.Response):
+            return player
+        return self._ok(self._sexual_state(player))
+
+    async def sexual_claim(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        machine = player.sexual_machine
+        (per_hour, duration, _) = TIERS[machine['tier']]
+        now = self._now()
+        amount = int(min(now - machine['last_claim_time'], duration) * per_hour / 3600)
+        machine['last_claim_time'] = now
+        player.items[ENERGY_ID] += amount
+        return self._ok(self._sexual_state(player), updated_item_list=[_asset(ENERGY_ID, amount)])
+
+    async def sexual_upgrade(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        machine = player.sexual_machine
+        tier = int(request['form']['tier'])
+        if tier != machine['tier'] + 1 or tier not in TIERS:
+            return self._error(INVALID_REQUEST_CODE, f"Cannot upgrade from tier {machine['tier']} to tier {tier}.")
+        if player.items[MATERIAL_ID] < TIERS[tier][2]:
+            return self._error(ITEM_NOT_OWNED_CODE, "Not enough upgrade materials.")
+        player.items[MATERIAL_ID] -= TIERS[tier][2]
+        machine['tier'] = tier
+        return self._ok(self._sexual_state(player))
+
+    async def sexual_save_message(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        player.sexual['message_id'] = int(request['form']['message_id'])
+        return self._ok(self._sexual_state(player))
+
+    async def sexual_choose(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        if player.items[ENERGY_ID] < 10:
+            return self._error(ITEM_NOT_OWNED_CODE, "Not enough energy.")
+        player.items[ENERGY_ID] -= 10
+        player.sexual['message_id'] = int(request['form']['message_id'])
+        return self._ok(self._sexual_state(player))
+
+    async def sexual_click(self, request: web.Request) -> web.Response:
+        player = await self._authorise_post(request)
+        if isinstance(player, web.Response):
+            return player
+        amount = int(request['form']['amount'])
+        cost = sum(item['amount'] for item in json.loads(request['form']['cost']))
+        if player.items[ENERGY_ID] < cost:
+            return self._error(ITEM_NOT_OWNED_CODE, "Not enough energy.")
+        player.items[ENERGY_ID] -= cost
+        player.sexual['exp'] += amount
+        return self._ok(self._sexual_state(player), reduced_item_list=[_asset(ENERGY_ID, player.items[ENERGY_ID])])
+
+    def _sexual_state(self, player: Player) -> dict:
+        return { 'user_record': player.sexual, 'user_energy': { 'energy': player.items[ENERGY_ID] }, 'user_explore_item_record': player.sexual_machine }
+
+    def _restore_meets(self, player: Player) -> None:
+        if self.clock.timestamp() // 86400 > player.meet_day:
+            player.multiverse['meet_count'] = 0
+
+    def _gain_exp(self, record: dict, exp: int) -> None:
+        record['exp'] += exp
+
+    def _authorise(self, request: web.Request) -> Player | web.Response:
+        query = request.query
+        player = self.players.get(int(query.get('user_id') or 0))
+        if player is None or player.session_id != query.get('session_id'):
+            return self._error(SESSION_ERROR_CODE, "Invalid session, please log in again.")
+        if self.session_ttl and self.clock.now() - player.session_time > self.session_ttl:
+            return self._error(SESSION_ERROR_CODE, "Session has expired, please log in again.")
+        return player
+
+    async def _authorise_post(self, request: web.Request) -> Player | web.Response:
+        request['form'] = await request.post()
+        return self._authorise(request)
+
+    def _now(self) -> float:
+        """ Game time for energy accrual, running ``time_scale`` times faster than the wall clock. """
+        return self.clock.now() * self.time_scale
+
+    def _ok(self, response: dict, **extra) -> web.Response:
+        body = { 'success': True, 'error_code': 0, 'error_message': None, 'response': response }
+        body.update(extra)
+        return web.json_response(body)
+
+    def _error(self, code: int, message: str) -> web.Response:
+        return web.json_response({ 'success': False, 'error_code': code, 'error_message': message })
+
+
+async def main(args):
+    server = MockGameServer(args.latency, args.error_rate, args.time_scale, args.session_ttl)
+    (auth_url, data_url, battle_url) = await server.start(args.host, args.port)
+    print(f"GAME_AUTH_URL={auth_url} GAME_DATA_URL={data_url} GAME_BATTLE_URL={battle_url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local King of Kinks mock server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080, help="data host port, the auth and battle hosts listen on the next two ports")
+    parser.add_argument('--latency', type=float, default=0.0, help="mean response latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="probability of answering with a server busy error")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="speed-up of energy accrual against the wall clock")
+    parser.add_argument('--session-ttl', type=float, default=None, help="seconds until a session expires")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
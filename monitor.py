@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from metrics import Metrics
+from network import handler
+
+__all__ = ('LoopMonitor',)
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class LoopMonitor:
+    """
+    Event loop lag sampler with a slow-callback profiler.
+
+    A coroutine sleeps ``interval`` seconds in a loop and records how late it wakes up. A watchdog thread checks its
+    heartbeat every ``threshold / 2`` seconds; once the loop has not come back for ``threshold`` seconds it samples the
+    stack of the loop thread and charges the time to the function responsible, named by its innermost frame inside this
+    project (e.g. ``event.BaseConfig.get_dict``) followed by the innermost frame overall (e.g. ``zipfile.ZipFile.extractall``).
+    A summary of the lag percentiles and the slowest functions is logged every ``report_interval`` seconds.
+    """
+    _logger = logging.getLogger('LoopMonitor')
+
+    def __init__(self, interval=0.1, threshold=0.1, report_interval=60, top=5):
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.top = top
+        self._lags: list[float] = list()
+        # responsible function -> [stalls, blocked seconds, heartbeat of its latest stall], guarded by ``_lock`` since the watchdog writes it
+        self._blocked: dict[str, list] = dict()
+        self._lock = threading.Lock()
+        self._beat = time.monotonic()
+        self._thread_id: int | None = None
+        self._stopped = threading.Event()
+        # lag percentiles of the latest summary, and total seconds the loop has been seen blocked
+        self.lag = { 'p50': 0.0, 'p99': 0.0, 'max': 0.0 }
+        self.blocked_seconds = 0.0
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            self._logger.addHandler(handler())
+        for quantile in self.lag:
+            Metrics.gauge('kok_loop_lag_seconds', "Event loop lag of the latest summary.", lambda quantile=quantile: self.lag[quantile], quantile=quantile)
+        Metrics.gauge('kok_loop_blocked_seconds_total', "Seconds the event loop has been blocked for longer than the threshold.", lambda: self.blocked_seconds, counter=True)
+
+    async def run(self) -> None:
+        """ Sample the loop lag until cancelled, a last summary is logged on exit. """
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        watchdog = threading.Thread(target=self._watch, name='LoopMonitor', daemon=True)
+        watchdog.start()
+        next_report = self._beat + self.report_interval
+        try:
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self._beat = now = time.monotonic()
+                self._lags.append(max(now - start - self.interval, 0.0))
+                if now >= next_report:
+                    self.report()
+                    next_report = now + self.report_interval
+        finally:
+            self._stopped.set()
+            self.report()
+
+    def summary(self) -> dict:
+        """ Lag percentiles in seconds since the last summary, and the slowest functions as ``(name, stalls, seconds)`` """
+        lags = sorted(self._lags)
+        self._lags = list()
+        if lags:
+            self.lag = { 'p50': lags[len(lags) // 2], 'p99': lags[min(int(len(lags) * 0.99), len(lags) - 1)], 'max': lags[-1] }
+        with self._lock:
+            blocked = sorted(((name, stalls, seconds) for name, (stalls, seconds, _) in self._blocked.items()), key=lambda item: item[2], reverse=True)
+            self._blocked = dict()
+        return { 'samples': len(lags), 'lag': dict(self.lag), 'blocked': blocked[:self.top] }
+
+    def report(self) -> None:
+        summary = self.summary()
+        if not summary['samples']:
+            return None
+        lag = summary['lag']
+        self._logger.info(f"Loop lag over {summary['samples']} samples: p50 {lag['p50'] * 1000:.1f} ms, p99 {lag['p99'] * 1000:.1f} ms, max {lag['max'] * 1000:.1f} ms")
+        for (name, stalls, seconds) in summary['blocked']:
+            self._logger.info(f"Blocked {seconds:.2f} seconds in {stalls} stalls by {name}")
+
+    def _watch(self) -> None:
+        period = self.threshold / 2
+        while not self._stopped.wait(period):
+            beat = self._beat
+            if time.monotonic() - beat - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            name = self._culprit(frame)
+            with self._lock:
+                entry = self._blocked.setdefault(name, [0, 0.0, None])
+                # samples taken before the loop has woken up again belong to the same stall
+                entry[0] += beat != entry[2]
+                entry[1] += period
+                entry[2] = beat
+                self.blocked_seconds += period
+
+    @staticmethod
+    def _culprit(frame) -> str:
+        leaf = LoopMonitor._frame_name(frame)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if filename.startswith(ROOT_DIR) and filename != __file__ and 'site-packages' not in filename:
+                owner = LoopMonitor._frame_name(frame)
+                return owner if owner == leaf else f"{owner} -> {leaf}"
+            frame = frame.f_back
+        return leaf
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+        return f"{module}.{frame.f_code.co_qualname}"
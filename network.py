@@ -4,15 +4,97 @@ import json
 import logging
 import os
 import asyncio
+import time
+import random
+import functools
 import aiohttp
+from urllib.parse import urlencode
+from yarl import URL
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
 from zipfile import ZipFile
 from api import GameAPI
-from storage import Database, DiscordID, LOCAL_STORAGE
+from metrics import Metrics
+from storage import DiscordID, LOCAL_STORAGE, get_database
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 load_dotenv()
 CONFIG_DIR = os.environ["CONFIG_DIR"]
 PASSWORD = os.environ["PASSWORD"]
+# seconds before a stored session is considered stale and a new login is required
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 21600))
+# comma separated game error codes which indicate an invalid session, e.g. SESSION_ERROR_CODES="10001,10002"
+SESSION_ERROR_CODES = frozenset(int(code) for code in os.environ.get("SESSION_ERROR_CODES", "").split(",") if code.strip())
+# comma separated game error codes which indicate an overloaded server, they shrink the concurrency limit like HTTP 429/5xx
+THROTTLE_ERROR_CODES = frozenset(int(code) for code in os.environ.get("THROTTLE_ERROR_CODES", "").split(",") if code.strip())
+# JSON codec of request and response bodies, "ujson" (default when installed) or "json"
+JSON_BACKEND = os.environ.get("JSON_BACKEND", "ujson" if ujson else "json")
+# comma separated requests per second by endpoint family, e.g. RATE_LIMITS="auth_url=50,data_url=500"
+RATE_LIMITS = { name.strip(): float(rate) for (name, rate) in (item.split("=") for item in os.environ.get("RATE_LIMITS", "").split(",") if item.strip()) }
+# comma separated game error codes of transient failures which are worth sending again after a backoff
+RETRY_ERROR_CODES = frozenset(int(code) for code in os.environ.get("RETRY_ERROR_CODES", "").split(",") if code.strip())
+# attempts per request after the first one, and retries per user wake-up shared by all its requests
+RETRY_ATTEMPTS = int(os.environ.get("RETRY_ATTEMPTS", 4))
+RETRY_BUDGET = int(os.environ.get("RETRY_BUDGET", 20))
+# the n-th retry waits a random delay of up to RETRY_BASE_DELAY * 2^n seconds, capped at RETRY_MAX_DELAY
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 0.5))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 8))
+
+# error_code of a request which got no answer from the game, e.g. a timeout or a broken connection
+NETWORK_ERROR_CODE = -1
+# error_code of a request which never left, the connection to the game could not be opened
+CONNECT_ERROR_CODE = -2
+ITEM_NOT_OWNED_CODE = 11002
+RETRY, RELOGIN, GIVE_UP = 'retry', 'relogin', 'give_up'
+FORM_HEADERS = { 'Content-Type': 'application/x-www-form-urlencoded' }
+# game error_code -> what to do with a failed request, any other code is handed to the caller as it is
+# NOTE: a request which got no answer may have been applied, so ``NETWORK_ERROR_CODE`` is only retried for idempotent requests
+ERROR_ACTIONS = {
+    NETWORK_ERROR_CODE: RETRY,
+    CONNECT_ERROR_CODE: RETRY,
+    ITEM_NOT_OWNED_CODE: GIVE_UP,
+    **{ code: RETRY for code in THROTTLE_ERROR_CODES | RETRY_ERROR_CODES },
+    **{ code: RELOGIN for code in SESSION_ERROR_CODES },
+}
+
+class Serializer:
+    """ Standard library JSON codec, the interface of every serializer used by ``NetworkManager`` and the event config builders. """
+    name = 'json'
+
+    def loads(self, s: str | bytes):
+        return json.loads(s)
+
+    def dumps(self, obj, indent=None) -> str:
+        return json.dumps(obj, indent=indent, ensure_ascii=False)
+
+
+class UJSONSerializer(Serializer):
+    """ ``ujson`` codec, 1.5-2x faster than the standard library at decoding the game responses and more at encoding. """
+    name = 'ujson'
+
+    def loads(self, s: str | bytes):
+        return ujson.loads(s)
+
+    def dumps(self, obj, indent=None) -> str:
+        return ujson.dumps(obj, indent=indent or 0, ensure_ascii=False, escape_forward_slashes=False)
+
+
+_serializer = UJSONSerializer() if JSON_BACKEND == 'ujson' and ujson else Serializer()
+
+
+def get_serializer() -> Serializer:
+    return _serializer
+
+
+def set_serializer(serializer: Serializer) -> None:
+    global _serializer
+    _serializer = serializer
+
 
 def handler():
     handler = logging.StreamHandler()
@@ -22,46 +104,360 @@ def handler():
     return handler
 
 
+class ConnectionPool:
+    """
+    Process-wide keep-alive connection pool, holding one ``aiohttp.ClientSession`` per remote host.
+
+    Each ``GameAPI`` host gets its own connection limit so that a burst on ``data_url`` cannot starve logins on ``auth_url``,
+    any other host (e.g. the asset CDN) falls back to ``default_limit``. Sessions are created lazily inside the running event loop
+    and must be released with ``ConnectionPool.close()`` before the loop exits.
+    """
+    _logger = logging.getLogger('ConnectionPool')
+    _sessions: dict[str, aiohttp.ClientSession] = dict()
+    # maximum simultaneous connections, keyed by ``GameAPI`` attribute name
+    host_limits = { 'auth_url': 10, 'data_url': 100, 'battle_url': 20 }
+    default_limit = 10
+    dns_cache_ttl = 300
+    keepalive_timeout = 30
+    request_timeout = 30
+    # ``aiohttp.TraceConfig`` hooks attached to sessions opened afterwards, e.g. to time requests in benchmarks
+    trace_configs: list[aiohttp.TraceConfig] = list()
+
+    @classmethod
+    def session(cls, url: str) -> aiohttp.ClientSession:
+        """ Return the pooled session of the host which serves ``url``, create one if the host has not been visited yet. """
+        origin = str(URL(url).origin())
+        session = cls._sessions.get(origin)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=cls._host_limit(origin),
+                use_dns_cache=True,
+                ttl_dns_cache=cls.dns_cache_ttl,
+                keepalive_timeout=cls.keepalive_timeout,
+            )
+            session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=cls.request_timeout), trace_configs=cls.trace_configs or None)
+            cls._sessions.update({ origin: session })
+            cls._logger.debug(f"Opened connection pool to {origin} (limit: {connector.limit})")
+        return session
+
+    @classmethod
+    async def close(cls) -> None:
+        """ Close every pooled session and its underlying connections. """
+        sessions = list(cls._sessions.values())
+        cls._sessions.clear()
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+
+    @classmethod
+    def _host_limit(cls, origin: str) -> int:
+        return cls.host_limits.get(endpoint_family(origin), cls.default_limit)
+
+
+def endpoint_family(url: str) -> str:
+    """ Name of the ``GameAPI`` host attribute serving ``url``, e.g. ``data_url``, or ``default`` for any other host. """
+    return _endpoint_family(URL(url).origin(), GameAPI.auth_url, GameAPI.data_url, GameAPI.battle_url)
+
+
+@functools.lru_cache(maxsize=256)
+def endpoint_path(url: str) -> str:
+    """ Path of an endpoint URL, the key of its request metrics, e.g. ``/api/multiverse_dating/explore/claim`` """
+    return URL(url).path
+
+
+@functools.lru_cache(maxsize=32)
+def _endpoint_family(origin: URL, auth_url: str, data_url: str, battle_url: str) -> str:
+    for name, url in (('auth_url', auth_url), ('data_url', data_url), ('battle_url', battle_url)):
+        if URL(url).origin() == origin:
+            return name
+    return 'default'
+
+
+class AdaptiveLimiter:
+    """
+    Token bucket and AIMD concurrency limit of one endpoint family.
+
+    Every request first waits for a free slot below ``limit``, then for a token of the bucket refilled at ``rate`` per second.
+    The limit grows by one per window of successful requests and is multiplied by ``backoff`` when a request fails, is
+    rejected as overloaded, or takes longer than ``latency_target`` seconds, at most once per round trip.
+    """
+    _logger = logging.getLogger('AdaptiveLimiter')
+
+    def __init__(self, name: str, rate: float, max_limit: int, min_limit=1, latency_target=2.0, backoff=0.5):
+        if not rate > 0:
+            raise ValueError(f"({name}) rate must be a positive number of requests per second, got {rate}")
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError(f"({name}) concurrency limits must satisfy 1 <= min_limit <= max_limit, got {min_limit} and {max_limit}")
+        self.name = name
+        self.rate = rate
+        self.burst = max(rate, 1.0)
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        # exponentially weighted moving average of the request latency in seconds
+        self.latency = 0.0
+        self.requests = 0
+        self.overloads = 0
+        # seconds spent waiting for a token, summed over every request
+        self.throttled = 0.0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def request(self):
+        """ Hold a slot for one request, set ``overloaded`` on the yielded ``Ticket`` if the server pushed back. """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        ticket = Ticket()
+        try:
+            await self._take_token()
+            start = time.monotonic()
+            try:
+                yield ticket
+            except Exception:
+                ticket.overloaded = True
+                raise
+            finally:
+                self._complete(time.monotonic() - start, ticket.overloaded)
+        finally:
+            self.in_flight -= 1
+            async with self._condition:
+                self._condition.notify(max(int(self.limit) - self.in_flight, 0))
+
+    async def _take_token(self) -> None:
+        # tokens are reserved ahead, a negative balance is the queue of requests waiting for the bucket to refill
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate) - 1
+        self._updated = now
+        if self._tokens < 0:
+            delay = -self._tokens / self.rate
+            self.throttled += delay
+            await asyncio.sleep(delay)
+
+    def _complete(self, latency: float, overloaded: bool) -> None:
+        self.requests += 1
+        self.latency = latency if self.requests == 1 else 0.9 * self.latency + 0.1 * latency
+        if overloaded or latency > self.latency_target:
+            self.overloads += overloaded
+            now = time.monotonic()
+            # requests in flight saw the same congestion, only the first of them shrinks the limit
+            if now - self._last_decrease > max(self.latency, latency):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_decrease = now
+                self._logger.debug(f"({self.name}) concurrency limit decreased to {int(self.limit)} (latency: {latency:.3f}s, overloaded: {overloaded})")
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def metrics(self) -> dict:
+        return {
+            'rate': self.rate,
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'latency': self.latency,
+            'requests': self.requests,
+            'overloads': self.overloads,
+            'throttled_seconds': self.throttled,
+        }
+
+
+class Ticket:
+    __slots__ = ('overloaded',)
+
+    def __init__(self):
+        self.overloaded = False
+
+
+class RateLimiter:
+    """
+    Process-wide ``AdaptiveLimiter`` per endpoint family, applied to every request sent by ``NetworkManager.get``/``post``.
+
+    The concurrency limit of a family never exceeds the connection limit of its ``ConnectionPool`` host, rates default to
+    ``host_rates`` and are overridden by ``RATE_LIMITS``.
+    """
+    _limiters: dict[str, AdaptiveLimiter] = dict()
+    # requests per second, keyed by ``GameAPI`` attribute name
+    host_rates = { 'auth_url': 50.0, 'data_url': 500.0, 'battle_url': 50.0 }
+    default_rate = 50.0
+
+    @classmethod
+    def of(cls, url: str) -> AdaptiveLimiter:
+        name = endpoint_family(url)
+        limiter = cls._limiters.get(name)
+        if limiter is None:
+            rate = RATE_LIMITS.get(name, cls.host_rates.get(name, cls.default_rate))
+            limiter = AdaptiveLimiter(name, rate, ConnectionPool.host_limits.get(name, ConnectionPool.default_limit))
+            cls._limiters.update({ name: limiter })
+            Metrics.gauge('kok_rate_limit_rate', "Requests per second allowed by the token bucket.", lambda: limiter.rate, family=name)
+            Metrics.gauge('kok_rate_limit_concurrency', "Current adaptive concurrency limit.", lambda: int(limiter.limit), family=name)
+            Metrics.gauge('kok_rate_limit_in_flight', "Requests in flight.", lambda: limiter.in_flight, family=name)
+            Metrics.gauge('kok_rate_limit_overloads_total', "Requests rejected as overloaded.", lambda: limiter.overloads, counter=True, family=name)
+            Metrics.gauge('kok_rate_limit_throttled_seconds_total', "Seconds spent waiting for the token bucket.", lambda: limiter.throttled, counter=True, family=name)
+        return limiter
+
+    @classmethod
+    def metrics(cls) -> dict[str, dict]:
+        """ Current rate, concurrency limit and counters of every endpoint family which has sent a request. """
+        return { name: limiter.metrics() for name, limiter in cls._limiters.items() }
+
+
+class Credentials:
+    """
+    Immutable credentials of one user session, with the query strings of every request variant rendered up front.
+
+    A request URI is the endpoint followed by ``query``, ``event_query(event_id)`` or ``battle_query(battle_id)``,
+    the scoped variants are rendered once per event or battle ID and reused afterwards.
+    """
+    __slots__ = ('user_id', 'prefix', 'session_id', 'guild_id', 'query', '_battle_suffix', '_event_queries', '_battle_queries')
+
+    def __init__(self, user_id: int, prefix: int, session_id: str, guild_id: int | None = None):
+        self.user_id = user_id
+        self.prefix = prefix
+        self.session_id = session_id
+        self.guild_id = guild_id
+        self.query = f"user_id={user_id}&session_id={session_id}&server_prefix={prefix}"
+        self._battle_suffix = f"&serverPrefix={prefix}"
+        self._event_queries: dict[int, str] = dict()
+        self._battle_queries: dict[int, str] = dict()
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name) and not name.startswith('_'):
+            raise AttributeError(f"Credentials are immutable, cannot set {name}")
+        super().__setattr__(name, value)
+
+    def event_query(self, event_id: int) -> str:
+        query = self._event_queries.get(event_id)
+        if query is None:
+            query = self._event_queries.setdefault(event_id, f"event_id={event_id}&{self.query}")
+        return query
+
+    def battle_query(self, battle_id: int) -> str:
+        query = self._battle_queries.get(battle_id)
+        if query is None:
+            query = self._battle_queries.setdefault(battle_id, f"{self.query}&battleId={battle_id}{self._battle_suffix}")
+        return query
+
+
+class SessionManager:
+    """
+    Process-wide bookkeeping of user sessions.
+
+    A stored session is trusted until ``SESSION_TTL`` seconds after its last update, or until a request fails with one of
+    ``SESSION_ERROR_CODES``. Concurrent logins for the same Discord ID are collapsed into a single in-flight request.
+    The ``Credentials`` of a session are built from the storage once and dropped whenever the session changes.
+    """
+    _logins: dict[DiscordID, asyncio.Task] = dict()
+    _expired: set[DiscordID] = set()
+    _credentials: dict[DiscordID, Credentials] = dict()
+    # bumped whenever the session changes, credentials read from the storage meanwhile are not cached
+    _generations: dict[DiscordID, int] = dict()
+
+    @classmethod
+    def is_expired(cls, discord_user_id: DiscordID) -> bool:
+        return discord_user_id in cls._expired
+
+    @classmethod
+    def invalidate(cls, discord_user_id: DiscordID) -> None:
+        """ Mark the stored session as unusable, the next ``register()`` will log in again. """
+        cls._expired.add(discord_user_id)
+        cls._forget(discord_user_id)
+
+    @classmethod
+    def renew(cls, discord_user_id: DiscordID) -> None:
+        cls._expired.discard(discord_user_id)
+        cls._forget(discord_user_id)
+
+    @classmethod
+    def credentials(cls, discord_user_id: DiscordID) -> Credentials | None:
+        return cls._credentials.get(discord_user_id)
+
+    @classmethod
+    def generation(cls, discord_user_id: DiscordID) -> int:
+        return cls._generations.get(discord_user_id, 0)
+
+    @classmethod
+    def remember(cls, discord_user_id: DiscordID, credentials: Credentials, generation: int) -> None:
+        """ Cache ``credentials`` read from the storage at ``generation``, unless the session has changed since. """
+        if discord_user_id not in cls._expired and cls.generation(discord_user_id) == generation:
+            cls._credentials.update({ discord_user_id: credentials })
+
+    @classmethod
+    def _forget(cls, discord_user_id: DiscordID) -> None:
+        cls._credentials.pop(discord_user_id, None)
+        cls._generations.update({ discord_user_id: cls.generation(discord_user_id) + 1 })
+
+    @classmethod
+    async def single_flight(cls, discord_user_id: DiscordID, login: Callable[[DiscordID], Awaitable[None]]) -> None:
+        """ Run ``login`` unless a login for the same user is already in flight, in which case wait for that one instead. """
+        task = cls._logins.get(discord_user_id)
+        if task is None:
+            task = asyncio.create_task(login(discord_user_id))
+            cls._logins.update({ discord_user_id: task })
+            task.add_done_callback(lambda _: cls._logins.pop(discord_user_id, None))
+        # a cancelled waiter must not cancel the login shared with other waiters
+        await asyncio.shield(task)
+
+
 class NetworkManager:
     _logger = logging.getLogger('NetworkManager')
 
-    def __init__(self, filepath=LOCAL_STORAGE):
-        self.api = GameAPI()
-        self.db = Database(filepath)
+    def __init__(self, filepath=LOCAL_STORAGE, shared=True):
+        """
+        If ``shared`` is set, the endpoint tree and the storage backend are the process-wide flyweights,
+        otherwise each instance builds its own ``GameAPI`` and storage backend (see ``storage.get_database``).
+        """
+        self.api = GameAPI.shared() if shared else GameAPI()
+        self.db = get_database(filepath, shared)
+        # retries left until the next ``reset_retry_budget()``
+        self.retry_budget = RETRY_BUDGET
         self._logger.setLevel(logging.INFO)
         if not self._logger.handlers:
             self._logger.addHandler(handler())
         if not os.path.exists(CONFIG_DIR):
             os.mkdir(CONFIG_DIR)
 
-    """ Log into the game by user's nutaku ID and update user database session. If session ID is given, bypass the login request."""
-    async def register(self, discord_user_id: DiscordID, session_id=None) -> None:
-        user = await self.db.user.get_user(discord_user_id)
-        user_id = user.get_user_id()
-        prefix = user.get_prefix()
+    """ Log into the game by user's nutaku ID and update user database session. If session ID is given, bypass the login request.
+    The stored session is reused while it is fresh, unless ``force`` is set or a request has reported it as expired. """
+    async def register(self, discord_user_id: DiscordID, session_id=None, force=False) -> None:
         if session_id:
-            me = await self._get_async(self.api.user.info, user_id, session_id, prefix).me()
+            user = await self.db.user.get_user(discord_user_id)
+            user_id = user.get_user_id()
+            prefix = user.get_prefix()
+            me = (await self._get_async(self.api.user.info, Credentials(user_id, prefix, session_id))).me()
             if user.get_name():
                 await self.db.user.update_session_id(discord_user_id, session_id)
             else:
-                await self.db.user.update_user(discord_user_id, int(me['user_id']), me['display_name'], session_id, socket_token, int(me['last_login_time']))
+                await self.db.user.update_user(discord_user_id, int(me['user_id']), me['display_name'], session_id, user.get_socket_token(), int(me['last_login_time']))
+            SessionManager.renew(discord_user_id)
             self._logger.debug(f"(User: {discord_user_id}) has updated new session_id ({session_id})")
+        elif force or SessionManager.is_expired(discord_user_id) or not await self.db.user.verify_socket_token(discord_user_id, SESSION_TTL):
+            await SessionManager.single_flight(discord_user_id, self._relogin)
         else:
-            nutaku_id = user.get_nutaku_id()
-            info = await self.login(discord_user_id, nutaku_id, prefix)
-            if info:
-                await self.db.user.update_user(discord_user_id, int(info['user_id']), info['name'], info['session_id'], info['socket_token'], int(info['last_login_time']))
-                self._logger.debug(f"(User: {discord_user_id}) has updated new session_id ({info['session_id']})")
-        # ensure that the new session has flushed into disk
-        await asyncio.sleep(1)
+            self._logger.debug(f"(User: {discord_user_id}) reuses the stored session.")
+
+    """ Replace the stored session with a new login, concurrent callers are collapsed by ``SessionManager.single_flight``. """
+    async def _relogin(self, discord_user_id: DiscordID) -> None:
+        user = await self.db.user.get_user(discord_user_id)
+        info = await self.login(discord_user_id, user.get_nutaku_id(), user.get_prefix())
+        if info:
+            await self.db.user.update_user(discord_user_id, int(info['user_id']), info['name'], info['session_id'], info['socket_token'], int(info['last_login_time']))
+            SessionManager.renew(discord_user_id)
+            self._logger.debug(f"(User: {discord_user_id}) has updated new session_id ({info['session_id']})")
+        # ensure that the new session has been committed to the storage
+        await self.db.user.flush()
 
     """ Send asynchronous POST login request and return player credentials on success. """
     async def login(self, discord_user_id: DiscordID, nutaku_id: int, prefix: int) -> dict | None:
-        acc = await self._post_async(self.api.auth.login.game_account, { "login_id": nutaku_id, "login_type": 0, "access_token": "", "pw": nutaku_id }, require_login=False)
+        acc = await self._send_with_retry(lambda: self._post_async(self.api.auth.login.game_account, { "login_id": nutaku_id, "login_type": 0, "access_token": "", "pw": nutaku_id }, require_login=False), discord_user_id, relogin=False)
         if acc.success():
             session_id = acc.response()['session_id']
             account_id = acc.response()['account_id']
-            user = await self._post_async(self.api.auth.login.user, { "server_prefix": prefix, "account_id": account_id, "session_id": session_id }, nutaku_id=nutaku_id, require_login=False)
+            user = await self._send_with_retry(lambda: self._post_async(self.api.auth.login.user, { "server_prefix": prefix, "account_id": account_id, "session_id": session_id }, nutaku_id=nutaku_id, require_login=False), discord_user_id, relogin=False)
             if user.success():
                 me = user.me()
                 return { 'user_id': me['user_id'], 'name': me['display_name'], 'session_id': session_id, 'socket_token': user.response()['socket_token'], 'last_login_time': me['last_login_time'] }
@@ -72,54 +468,78 @@ class NetworkManager:
         return None
 
     """ Send asynchronous GET request by providing the API name and discord user ID. """
-    async def get(self, api_name: GameAPI, discord_user_id: DiscordID, q=None, event_id=None, battle_id=None) -> dict | None:
-        uri = await self._fetch_uri(discord_user_id)
-        user_id = uri['user_id']
-        session_id = uri['session_id']
-        prefix = uri['prefix']
-        return await self._get_async(api_name, user_id, session_id, prefix, q, event_id, battle_id)
-
-    """ Send asynchronous POST request by providing the API name and discord user ID. """
-    async def post(self, api_name: GameAPI, payload: dict, discord_user_id: DiscordID, nutaku_id=None, require_login=True) -> dict | None:
-        uri = await self._fetch_uri(discord_user_id, require_login)
-        user_id = uri['user_id']
-        session_id = uri['session_id']
-        prefix = uri['prefix']
-        return await self._post_async(api_name, payload, user_id, prefix, session_id, nutaku_id, require_login)
-
-    """ Async GET request builder. """
-    async def _get_async(self, api_name, user_id, session_id, prefix, q=None, event_id=None, battle_id=None) -> dict | None:
+    async def get(self, api_name: GameAPI, discord_user_id: DiscordID, q=None, event_id=None, battle_id=None, relogin=True) -> 'Response':
+        async def send() -> Response:
+            credentials = await self._fetch_credentials(discord_user_id)
+            return await self._get_async(api_name, credentials, q, event_id, battle_id)
+        return await self._send_with_retry(send, discord_user_id, relogin)
+
+    """ Send asynchronous POST request by providing the API name and discord user ID. A game action which got no answer is not
+    sent again since it may have been applied, the caller should fetch the records again instead. """
+    async def post(self, api_name: GameAPI, payload: dict, discord_user_id: DiscordID, nutaku_id=None, require_login=True, relogin=True) -> 'Response':
+        async def send() -> Response:
+            credentials = await self._fetch_credentials(discord_user_id) if require_login else None
+            return await self._post_async(api_name, payload, credentials, nutaku_id, require_login)
+        # logins only issue a new session, so they are safe to send again
+        return await self._send_with_retry(send, discord_user_id, require_login and relogin, idempotent=not require_login)
+
+    """ Start a new wake-up with a full retry budget, called by the scheduler before every ``tick()``. """
+    def reset_retry_budget(self) -> None:
+        self.retry_budget = RETRY_BUDGET
+
+    """ Send the request built by ``send`` until it succeeds or ``ERROR_ACTIONS`` gives up. Transient failures are retried with
+    exponential backoff and full jitter, at most ``RETRY_ATTEMPTS`` times and while the wake-up has ``retry_budget`` left, an
+    invalid session is renewed once. The last response is returned, a request which never got an answer as ``NETWORK_ERROR_CODE``,
+    which is only sent again if the request is ``idempotent``. """
+    async def _send_with_retry(self, send: Callable[[], Awaitable['Response']], discord_user_id: DiscordID, relogin=True, idempotent=True) -> 'Response':
+        attempt = 0
+        while True:
+            resp = await send()
+            if resp.success():
+                return resp
+            action = ERROR_ACTIONS.get(resp.error_code(), GIVE_UP)
+            if resp.error_code() == NETWORK_ERROR_CODE and not idempotent:
+                return resp
+            if action == RELOGIN and relogin:
+                relogin = False
+                if await self._renew_expired_session(resp, discord_user_id):
+                    continue
+            if action != RETRY or attempt >= RETRY_ATTEMPTS or self.retry_budget <= 0:
+                return resp
+            self.retry_budget -= 1
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            attempt += 1
+            self._logger.debug(f"(User: {discord_user_id}) retrying in {delay:.2f} seconds (Code: {resp.error_code()}, attempt: {attempt}/{RETRY_ATTEMPTS})")
+            # real time even under a simulated clock, the wake-up holds the clock until it has finished
+            await asyncio.sleep(delay)
+
+    """ Log in again after the response has reported an invalid session, return True if the request should be sent once more. """
+    async def _renew_expired_session(self, resp: 'Response', discord_user_id: DiscordID) -> bool:
+        self._logger.info(f"(User: {discord_user_id}) session has expired (Code: {resp.error_code()}), logging in again.")
+        SessionManager.invalidate(discord_user_id)
+        await self.register(discord_user_id)
+        return not SessionManager.is_expired(discord_user_id)
+
+    """ Async GET request builder, the URI is the endpoint followed by one of the pre-rendered ``Credentials`` query strings. """
+    async def _get_async(self, api_name, credentials: Credentials, q=None, event_id=None, battle_id=None) -> 'Response':
         if q and api_name == self.api.user.friend.search:
-            uri = "{}q={}&user_id={}&session_id={}&server_prefix={}".format(api_name, q, user_id, session_id, prefix)
+            uri = "{}q={}&{}".format(api_name, q, credentials.query)
         elif event_id:
-            uri = "{}event_id={}&user_id={}&session_id={}&server_prefix={}".format(api_name, event_id, user_id, session_id, prefix)
+            uri = api_name + credentials.event_query(event_id)
         elif battle_id:
-            uri = "{}user_id={}&session_id={}&server_prefix={}&battleId={}&serverPrefix={}".format(api_name, user_id, session_id, prefix, battle_id, prefix)
+            uri = api_name + credentials.battle_query(battle_id)
         else:
-            uri = "{}user_id={}&session_id={}&server_prefix={}".format(api_name, user_id, session_id, prefix)
-        async with aiohttp.ClientSession() as session:
+            uri = api_name + credentials.query
+        if self._logger.isEnabledFor(logging.DEBUG):
             self._logger.debug(f"(User: {self.discord_user_id}) is sending GET request to {uri}")
-            try:
-                async with session.get(uri) as resp:
-                    body = await resp.json()
-                    return Response(body)
-            except Exception as e:
-                self._logger.exception(f"GET request error: {e}")
-                return None
+        return await self._request('GET', api_name, uri)
 
     """ Async POST request builder. """
-    async def _post_async(self, api_name, payload, user_id=None, prefix=None, session_id=None, nutaku_id=None, require_login=True) -> dict | None:
+    async def _post_async(self, api_name, payload, credentials: Credentials | None = None, nutaku_id=None, require_login=True) -> 'Response':
         if require_login:
-            async with aiohttp.ClientSession() as session:
-                uri = "{}user_id={}&session_id={}&server_prefix={}".format(api_name, user_id, session_id, prefix)
+            uri = api_name + credentials.query
+            if self._logger.isEnabledFor(logging.DEBUG):
                 self._logger.debug(f"(User: {self.discord_user_id}) is sending POST request to {uri} with payload {payload}")
-                try:
-                    async with session.post(uri, data=payload) as resp:
-                        body = await resp.json()
-                        return Response(body)
-                except Exception as e:
-                    self._logger.exception(f"POST request error: {e}")
-                    return None
         else:
             match api_name:
                 case self.api.auth.login.game_account:
@@ -128,40 +548,59 @@ class NetworkManager:
                     uri = "{}nutaku_id={}".format(api_name, nutaku_id)
                 case _:
                     self._logger.error(f"(API): {api_name}) requires user session.")
-                    return None
-            async with aiohttp.ClientSession() as session:
-                try:
-                    async with session.post(uri, data=payload) as resp:
-                        body = await resp.json()
-                        return Response(body)
-                except Exception as e:
-                    self._logger.exception(f"POST request error: {e}")
-                    return None
-
-    async def _fetch_uri(self, discord_user_id: DiscordID, require_login=True) -> dict:
+                    return Response.failure(None, f"{api_name} requires user session.")
+        return await self._request('POST', api_name, uri, urlencode(payload, doseq=True).encode())
+
+    """ Send the request through the rate limiter of its endpoint family and record it in ``Metrics`` by endpoint path. """
+    async def _request(self, method: str, api_name: str, uri: str, data: bytes | None = None) -> 'Response':
+        start = time.perf_counter()
+        body = b''
+        error_code = NETWORK_ERROR_CODE
+        try:
+            async with RateLimiter.of(api_name).request() as ticket:
+                async with ConnectionPool.session(api_name).request(method, uri, data=data, headers=FORM_HEADERS if data is not None else None) as resp:
+                    ticket.overloaded = resp.status == 429 or resp.status >= 500
+                    body = await resp.read()
+                    response = Response(_serializer.loads(body))
+                    error_code = response.error_code()
+                    ticket.overloaded |= error_code in THROTTLE_ERROR_CODES
+                    return response
+        except aiohttp.ClientConnectorError as e:
+            self._logger.error(f"{method} request error: {e!r}")
+            error_code = CONNECT_ERROR_CODE
+            return Response.failure(CONNECT_ERROR_CODE, repr(e))
+        except Exception as e:
+            self._logger.error(f"{method} request error: {e!r}")
+            return Response.failure(NETWORK_ERROR_CODE, repr(e))
+        finally:
+            Metrics.observe_request(method, endpoint_path(api_name), time.perf_counter() - start, len(data) if data else 0, len(body), error_code)
+
+    """ Return the cached ``Credentials`` of the current session, they are read from the storage once per session. """
+    async def _fetch_credentials(self, discord_user_id: DiscordID) -> Credentials:
+        credentials = SessionManager.credentials(discord_user_id)
+        if credentials is not None:
+            return credentials
+        # a login may renew the session while the storage is read
+        generation = SessionManager.generation(discord_user_id)
         user = await self.db.user.get_user(discord_user_id)
-        user_id = user.get_user_id()
-        prefix = user.get_prefix()
-        if require_login:
-            session_id = user.get_session_id()
-            if session_id:
-                guild_id = user.get_guild_id()
-                #TODO: URI Class
-                uri = { 'user_id': user_id, 'prefix': prefix, 'session_id': session_id, 'guild_id': guild_id }
-                return uri
-            else:
-                self._logger.exception(f"(User: {discord_user_id}) has not logged into server yet!")
-                raise TypeError
-        else:
-            nutaku_id = user.get_nutaku_id()
-            uri = { 'nutaku_id': nutaku_id, 'user_id': user_id, 'prefix': prefix }
-            return uri
+        session_id = user.get_session_id()
+        if not session_id:
+            self._logger.error(f"(User: {discord_user_id}) has not logged into server yet!")
+            raise TypeError(f"(User: {discord_user_id}) has no session")
+        credentials = Credentials(user.get_user_id(), user.get_prefix(), session_id, user.get_guild_id())
+        SessionManager.remember(discord_user_id, credentials, generation)
+        return credentials
 
 
 class Response(dict):
     def __init__(self, body):
         self.body = body
 
+    @classmethod
+    def failure(cls, error_code: int | None, error_message: str) -> 'Response':
+        """ Failed response built locally, e.g. for a request which got no answer from the game. """
+        return cls({ 'success': False, 'error_code': error_code, 'error_message': error_message })
+
     def success(self) -> bool:
         return self.body['success']
     
@@ -187,5 +626,5 @@ class Response(dict):
             return None
 
     def __str__(self) -> str:
-        fmt = json.dumps(self.body, indent=2, ensure_ascii=False)
+        fmt = _serializer.dumps(self.body, indent=2)
         return f"{fmt}"
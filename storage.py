@@ -1,17 +1,52 @@
 import json
 import os
+import sqlite3
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from typing import Mapping
 import logging
-from datetime import datetime
+from clock import get_clock
 from asynctinydb import TinyDB, Query, BaseID, BaseDocument, JSONStorage
 from asynctinydb.table import Table
 
-__all__ = ('DiscordID', 'UserDocument', 'Database')
+__all__ = ('DiscordID', 'UserDocument', 'Database', 'SQLiteDatabase', 'WriteBehindUserTable', 'get_database')
 
 load_dotenv()
 LOCAL_STORAGE = os.environ["LOCAL_STORAGE"]
 RECORD = Query()
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+# seconds between two group commits of the write-behind queue, 0 disables the write-behind cache
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 5))
+# number of dirty documents which triggers a group commit before the interval elapses
+FLUSH_THRESHOLD = int(os.environ.get("FLUSH_THRESHOLD", 100))
+# seconds a cached document is trusted before it is read again, bounds staleness against writers in other processes
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 60))
+USER_FIELDS = ('nutaku_id', 'user_id', 'guild_id', 'name', 'premium', 'bot', 'session_id', 'socket_token', 'create_time', 'last_update', 'last_session_update', 'next_update')
+
+
+_databases: dict[str, 'Database | SQLiteDatabase'] = dict()
+
+
+def get_database(filepath=LOCAL_STORAGE, shared=True):
+    """
+    Return the storage backend for ``filepath``: SQLite for ``SQLITE_SUFFIXES`` files, otherwise TinyDB JSON.
+
+    If ``shared`` is set, the process-wide instance bound to ``filepath`` is returned and its user table sits behind
+    a ``WriteBehindUserTable`` (unless ``FLUSH_INTERVAL`` is 0), so that all callers share one cache and one storage handle.
+    """
+    backend = SQLiteDatabase if filepath.endswith(SQLITE_SUFFIXES) else Database
+    if not shared:
+        return backend(filepath)
+    key = os.path.abspath(filepath)
+    if key not in _databases:
+        db = backend(filepath)
+        if FLUSH_INTERVAL > 0:
+            db.user = WriteBehindUserTable(db.user)
+        _databases.update({ key: db })
+    return _databases[key]
 
 
 """ Using Discord ID as BaseID for all database tables """
@@ -222,16 +257,364 @@ class Database(TinyDB):
             new_ts = self._get_current_timestamp()
             await self.update({ 'last_update': new_ts, 'next_update': next_ts }, doc_ids=[key])
 
+        async def update_many(self, changes: dict[DiscordID, dict]) -> None:
+            """ Apply a set of field updates per document with a single read and write of the storage. """
+            await self.update(lambda doc: doc.update(changes[doc.doc_id]), doc_ids=list(changes))
+
+        async def flush(self) -> None:
+            """ Every write is committed to the storage immediately, there is nothing to flush. """
+            ...
+
         async def verify_socket_token(self, key: DiscordID, since_sec=21600) -> bool:
+            """ Return True if the user holds a session which was updated within the last ``since_sec`` seconds. """
             user_info = await self.get_user(key)
             new_ts = self._get_current_timestamp()
-            return since_sec > (new_ts - user_info['last_session_update'])
+            return bool(user_info['session_id']) and since_sec > (new_ts - user_info['last_session_update'])
 
         async def remove_user(self, key: DiscordID):
-            await self.remove(doc_id=key)
+            await self.remove(doc_ids=[key])
 
         async def remove_user_by_user_id(self, user_id: int):
             await self.remove(RECORD.user_id == user_id)
 
         def _get_current_timestamp(self) -> int:
-            return int(datetime.now().timestamp())
+            return get_clock().timestamp()
+
+
+""" SQLite (WAL) storage with the same UserTable API as the TinyDB backend. Every statement runs on a dedicated thread,
+so a write waiting for the lock of another process sharing the file does not block the event loop. """
+class SQLiteDatabase:
+    def __init__(self, filepath=LOCAL_STORAGE):
+        # autocommit mode, every statement outside of an explicit transaction is committed immediately
+        self.connection = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # a single thread owns the connection, which also serialises the transactions of this process
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self.user = self.UserTable(self.connection, self._executor)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self.connection.close()
+
+    async def migrate_from_json(self, json_path: str) -> int:
+        """ Copy every user document from a TinyDB JSON storage into this database, return the number of migrated users. """
+        users = await Database(json_path).user.get_all_users()
+        await self.user.insert_documents(users)
+        return len(users)
+
+    class UserTable:
+        _logger = logging.getLogger("usertable")
+
+        def __init__(self, connection: sqlite3.Connection, executor: ThreadPoolExecutor):
+            self._connection = connection
+            self._executor = executor
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS user (
+                    discord_id INTEGER PRIMARY KEY,
+                    nutaku_id INTEGER,
+                    user_id INTEGER,
+                    guild_id INTEGER,
+                    name TEXT,
+                    premium INTEGER NOT NULL DEFAULT 0,
+                    bot INTEGER NOT NULL DEFAULT 0,
+                    session_id TEXT,
+                    socket_token TEXT,
+                    create_time INTEGER NOT NULL,
+                    last_update INTEGER NOT NULL,
+                    last_session_update INTEGER NOT NULL DEFAULT 0,
+                    next_update INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS user_premium ON user (premium);
+                CREATE INDEX IF NOT EXISTS user_next_update ON user (next_update);
+                CREATE INDEX IF NOT EXISTS user_user_id ON user (user_id);
+            """)
+
+        async def create(self, key: DiscordID, user_id: int, nutaku_id: int = None, premium=False, bot=False):
+            new_ts = self._get_current_timestamp()
+            try:
+                assert len(str(user_id)) == 13
+                user = { 'nutaku_id': nutaku_id, 'user_id': user_id, 'guild_id': None, 'name': None, 'premium': premium, 'bot': bot, 'session_id': None, 'socket_token': None, 'create_time': new_ts, 'last_update': new_ts, 'last_session_update': 0, 'next_update': 0 }
+                await self.insert_documents([UserDocument(user, key)], replace=False)
+            except Exception as e:
+                self._logger.exception(f"{e}")
+
+        async def insert_documents(self, documents: list[UserDocument], replace=True) -> None:
+            """ Insert many documents in a single transaction, existing documents are overwritten if ``replace`` is set. """
+            verb = "INSERT OR REPLACE" if replace else "INSERT"
+            columns = ", ".join(('discord_id',) + USER_FIELDS)
+            placeholders = ", ".join("?" * (len(USER_FIELDS) + 1))
+            rows = [(int(doc.doc_id), *(doc.get(field) for field in USER_FIELDS)) for doc in documents]
+            await self._run(self._insert, f"{verb} INTO user ({columns}) VALUES ({placeholders})", rows)
+
+        async def get_user(self, key: DiscordID) -> UserDocument:
+            users = await self._run(self._select, "SELECT * FROM user WHERE discord_id = ?", (int(key),))
+            if not users:
+                raise KeyError(f"(User: {key}) does not exist.")
+            return users[0]
+
+        async def get_all_users(self) -> list[UserDocument]:
+            return await self._run(self._select, "SELECT * FROM user")
+
+        async def get_premium_users(self) -> list[UserDocument]:
+            return await self._run(self._select, "SELECT * FROM user WHERE premium = 1")
+
+        async def get_regular_users(self) -> list[UserDocument]:
+            return await self._run(self._select, "SELECT * FROM user WHERE premium = 0")
+
+        async def get_next_update_users(self) -> list[UserDocument]:
+            new_ts = self._get_current_timestamp()
+            return await self._run(self._select, "SELECT * FROM user WHERE next_update <= ?", (new_ts,))
+
+        async def update_user(self, key: DiscordID, user_id: int, name: str, session_id: str, socket_token: str, server_time: int) -> None:
+            new_ts = self._get_current_timestamp()
+            await self._run(self._update, key, { 'user_id': user_id, 'name': name, 'session_id': session_id, 'socket_token': socket_token, 'last_update': new_ts, 'last_session_update': server_time })
+
+        async def update_nutaku_id(self, key: DiscordID, nutaku_id: int) -> None:
+            new_ts = self._get_current_timestamp()
+            await self._run(self._update, key, { 'nutaku_id': nutaku_id, 'last_update': new_ts })
+
+        async def update_user_id(self, key: DiscordID, user_id: int) -> None:
+            new_ts = self._get_current_timestamp()
+            await self._run(self._update, key, { 'user_id': user_id, 'last_update': new_ts })
+
+        async def update_guild_id(self, key: DiscordID, guild_id: int) -> None:
+            new_ts = self._get_current_timestamp()
+            await self._run(self._update, key, { 'guild_id': guild_id, 'last_update': new_ts })
+
+        async def update_session_id(self, key: DiscordID, session_id: str) -> None:
+            new_ts = self._get_current_timestamp()
+            await self._run(self._update, key, { 'session_id': session_id, 'last_update': new_ts, 'last_session_update': new_ts })
+
+        async def set_premium(self, key: DiscordID) -> None:
+            new_ts = self._get_current_timestamp()
+            await self._run(self._update, key, { 'premium': True, 'last_update': new_ts })
+
+        async def set_regular(self, key: DiscordID) -> None:
+            new_ts = self._get_current_timestamp()
+            await self._run(self._update, key, { 'premium': False, 'last_update': new_ts })
+
+        async def set_next_update_timestamp(self, key: DiscordID, next_ts: int) -> None:
+            new_ts = self._get_current_timestamp()
+            await self._run(self._update, key, { 'last_update': new_ts, 'next_update': next_ts })
+
+        async def update_many(self, changes: dict[DiscordID, dict]) -> None:
+            """ Apply a set of field updates per document in a single transaction. """
+            await self._run(self._update_many, changes)
+
+        async def flush(self) -> None:
+            """ Every write is committed to the storage immediately, there is nothing to flush. """
+            ...
+
+        async def verify_socket_token(self, key: DiscordID, since_sec=21600) -> bool:
+            """ Return True if the user holds a session which was updated within the last ``since_sec`` seconds. """
+            user_info = await self.get_user(key)
+            new_ts = self._get_current_timestamp()
+            return bool(user_info['session_id']) and since_sec > (new_ts - user_info['last_session_update'])
+
+        async def remove_user(self, key: DiscordID):
+            await self._run(self._connection.execute, "DELETE FROM user WHERE discord_id = ?", (int(key),))
+
+        async def remove_user_by_user_id(self, user_id: int):
+            await self._run(self._connection.execute, "DELETE FROM user WHERE user_id = ?", (user_id,))
+
+        async def _run(self, function, *args):
+            """ Run a blocking call of the connection on its own thread. """
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+        def _insert(self, sql: str, rows: list[tuple]) -> None:
+            with self._transaction():
+                self._connection.executemany(sql, rows)
+
+        def _update_many(self, changes: dict[DiscordID, dict]) -> None:
+            with self._transaction():
+                for key, fields in changes.items():
+                    self._update(key, fields)
+
+        @contextmanager
+        def _transaction(self):
+            """ Commit the statements of the block together, or none of them if it raises. The connection is in autocommit mode,
+            in which ``with connection:`` does not open a transaction. """
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+        def _update(self, key: DiscordID, fields: dict) -> None:
+            assignments = ", ".join(f"{field} = ?" for field in fields)
+            self._connection.execute(f"UPDATE user SET {assignments} WHERE discord_id = ?", (*fields.values(), int(key)))
+
+        def _select(self, sql: str, params=()) -> list[UserDocument]:
+            return list(self._to_document(row) for row in self._connection.execute(sql, params))
+
+        def _to_document(self, row: sqlite3.Row) -> UserDocument:
+            user = { field: row[field] for field in USER_FIELDS }
+            user['premium'] = bool(user['premium'])
+            user['bot'] = bool(user['bot'])
+            return UserDocument(user, DiscordID(row['discord_id']))
+
+        def _get_current_timestamp(self) -> int:
+            return get_clock().timestamp()
+
+
+""" Read cache and write-behind queue in front of any UserTable backend """
+class WriteBehindUserTable:
+    """
+    Serve ``get_user`` from an in-memory cache and queue field updates instead of writing them one by one.
+
+    Updates to the same document are coalesced and committed together by ``update_many`` every ``flush_interval`` seconds,
+    or as soon as ``flush_threshold`` documents are dirty. Queries over many users and structural changes (create, remove)
+    flush the queue first, so they always observe every prior update. Call ``flush()`` before shutting down, or whenever
+    an update must be durable before continuing.
+    """
+    _logger = logging.getLogger("usertable")
+
+    def __init__(self, table, flush_interval=FLUSH_INTERVAL, flush_threshold=FLUSH_THRESHOLD, cache_ttl=CACHE_TTL):
+        self._table = table
+        self._flush_interval = flush_interval
+        self._flush_threshold = flush_threshold
+        self._cache_ttl = cache_ttl
+        # DiscordID -> (cached monotonic time, document)
+        self._cache: dict[DiscordID, tuple[float, UserDocument]] = dict()
+        self._dirty: dict[DiscordID, dict] = dict()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._flusher: asyncio.Task | None = None
+
+    async def create(self, key: DiscordID, user_id: int, nutaku_id: int = None, premium=False, bot=False):
+        await self.flush()
+        self._cache.pop(key, None)
+        await self._table.create(key, user_id, nutaku_id, premium, bot)
+
+    async def get_user(self, key: DiscordID) -> UserDocument:
+        cached = self._cache.get(key)
+        if cached is None or time.monotonic() - cached[0] > self._cache_ttl:
+            user = await self._table.get_user(key)
+            # pending updates are newer than the stored document
+            user.update(self._dirty.get(key, {}))
+            cached = (time.monotonic(), user)
+            self._cache.update({ key: cached })
+        user = cached[1]
+        return UserDocument(user, user.doc_id)
+
+    async def get_all_users(self) -> list[UserDocument]:
+        await self.flush()
+        return await self._table.get_all_users()
+
+    async def get_premium_users(self) -> list[UserDocument]:
+        await self.flush()
+        return await self._table.get_premium_users()
+
+    async def get_regular_users(self) -> list[UserDocument]:
+        await self.flush()
+        return await self._table.get_regular_users()
+
+    async def get_next_update_users(self) -> list[UserDocument]:
+        await self.flush()
+        return await self._table.get_next_update_users()
+
+    async def update_user(self, key: DiscordID, user_id: int, name: str, session_id: str, socket_token: str, server_time: int) -> None:
+        new_ts = self._get_current_timestamp()
+        self._queue(key, { 'user_id': user_id, 'name': name, 'session_id': session_id, 'socket_token': socket_token, 'last_update': new_ts, 'last_session_update': server_time })
+
+    async def update_nutaku_id(self, key: DiscordID, nutaku_id: int) -> None:
+        new_ts = self._get_current_timestamp()
+        self._queue(key, { 'nutaku_id': nutaku_id, 'last_update': new_ts })
+
+    async def update_user_id(self, key: DiscordID, user_id: int) -> None:
+        new_ts = self._get_current_timestamp()
+        self._queue(key, { 'user_id': user_id, 'last_update': new_ts })
+
+    async def update_guild_id(self, key: DiscordID, guild_id: int) -> None:
+        new_ts = self._get_current_timestamp()
+        self._queue(key, { 'guild_id': guild_id, 'last_update': new_ts })
+
+    async def update_session_id(self, key: DiscordID, session_id: str) -> None:
+        new_ts = self._get_current_timestamp()
+        self._queue(key, { 'session_id': session_id, 'last_update': new_ts, 'last_session_update': new_ts })
+
+    async def set_premium(self, key: DiscordID) -> None:
+        new_ts = self._get_current_timestamp()
+        self._queue(key, { 'premium': True, 'last_update': new_ts })
+
+    async def set_regular(self, key: DiscordID) -> None:
+        new_ts = self._get_current_timestamp()
+        self._queue(key, { 'premium': False, 'last_update': new_ts })
+
+    async def set_next_update_timestamp(self, key: DiscordID, next_ts: int) -> None:
+        new_ts = self._get_current_timestamp()
+        self._queue(key, { 'last_update': new_ts, 'next_update': next_ts })
+
+    async def verify_socket_token(self, key: DiscordID, since_sec=21600) -> bool:
+        """ Return True if the user holds a session which was updated within the last ``since_sec`` seconds. """
+        user_info = await self.get_user(key)
+        new_ts = self._get_current_timestamp()
+        return bool(user_info['session_id']) and since_sec > (new_ts - user_info['last_session_update'])
+
+    async def remove_user(self, key: DiscordID):
+        await self.flush()
+        self._cache.pop(key, None)
+        await self._table.remove_user(key)
+
+    async def remove_user_by_user_id(self, user_id: int):
+        await self.flush()
+        self._cache.clear()
+        await self._table.remove_user_by_user_id(user_id)
+
+    async def flush(self) -> None:
+        """ Commit every queued update to the backend in one batch, the updates are queued again if the commit fails. """
+        async with self._flush_lock:
+            if not self._dirty:
+                return None
+            changes = self._dirty
+            self._dirty = dict()
+            try:
+                await self._table.update_many(changes)
+                self._logger.debug(f"Committed {len(changes)} user documents.")
+            except BaseException:
+                # keep newer updates queued meanwhile on top of the failed batch
+                for key, fields in self._dirty.items():
+                    changes.setdefault(key, dict()).update(fields)
+                self._dirty = changes
+                raise
+
+    def _queue(self, key: DiscordID, fields: dict) -> None:
+        self._dirty.setdefault(key, dict()).update(fields)
+        cached = self._cache.get(key)
+        if cached:
+            cached[1].update(fields)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_periodically())
+        if len(self._dirty) >= self._flush_threshold:
+            self._wakeup.set()
+
+    async def _flush_periodically(self) -> None:
+        while self._dirty:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self._logger.exception(f"Failed to commit queued user updates, exception: {e}")
+
+    def _get_current_timestamp(self) -> int:
+        return get_clock().timestamp()
+
+
+if __name__ == '__main__':
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(description="Migrate the user table from a TinyDB JSON storage into a SQLite database.")
+    parser.add_argument('source', help="path of the existing JSON storage")
+    parser.add_argument('destination', help=f"path of the SQLite database, ending with one of {SQLITE_SUFFIXES}")
+    args = parser.parse_args()
+    count = asyncio.run(SQLiteDatabase(args.destination).migrate_from_json(args.source))
+    print(f"Migrated {count} users from {args.source} into {args.destination}")
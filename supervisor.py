@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import asyncio
+import multiprocessing
+import time
+from contextlib import suppress
+from network import ConnectionPool, handler
+from event import BaseEventManager, EventPlan
+from storage import LOCAL_STORAGE, SQLITE_SUFFIXES
+
+__all__ = ('ShardSupervisor',)
+
+
+def _run_shard(manager_class: type[BaseEventManager], shard: tuple[int, int], plan: EventPlan, manager_kwargs: dict) -> None:
+    """ Entry point of a worker process, serving one shard of the user table with its own event manager. """
+    with suppress(KeyboardInterrupt):
+        asyncio.run(_serve_shard(manager_class, shard, plan, manager_kwargs))
+
+
+async def _serve_shard(manager_class: type[BaseEventManager], shard: tuple[int, int], plan: EventPlan, manager_kwargs: dict) -> None:
+    manager = manager_class(shard=shard, **manager_kwargs)
+    manager.apply_event_plan(plan)
+    await manager.run()
+
+
+class ShardSupervisor:
+    """
+    Run one event manager per worker process, each serving the users whose ``event.shard_of`` index matches the worker.
+
+    The event plan is compiled, or loaded from ``AssetCache``, once by the supervisor and handed to every worker. Since a
+    user's shard only depends on its Discord ID, users added to or removed from ``UserTable`` are picked up by the owning
+    worker on its next ``_maintain_users`` round. A worker which exits abnormally is started again after ``restart_delay`` seconds,
+    doubled on every consecutive crash. A worker which crashes more than ``max_restarts`` times in a row stops the supervisor,
+    a worker counts as recovered once it has been running for longer than the largest backoff.
+
+    NOTE: Workers write to the storage concurrently, which requires the SQLite backend.
+    """
+    _logger = logging.getLogger('ShardSupervisor')
+
+    def __init__(self, manager_class: type[BaseEventManager], workers=None, restart_delay=5, max_restarts=5, **manager_kwargs):
+        self._manager_class = manager_class
+        self._workers = workers or multiprocessing.cpu_count()
+        self._restart_delay = restart_delay
+        self._max_restarts = max_restarts
+        self._manager_kwargs = manager_kwargs
+        self._context = multiprocessing.get_context('spawn')
+        self._processes: dict[int, multiprocessing.Process] = dict()
+        # index -> monotonic start time, consecutive crashes and monotonic time of the pending restart
+        self._started: dict[int, float] = dict()
+        self._crashes: dict[int, int] = dict()
+        self._restarts: dict[int, float] = dict()
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            self._logger.addHandler(handler())
+
+    async def run(self) -> None:
+        filepath = self._manager_kwargs.get('filepath', LOCAL_STORAGE)
+        if self._workers > 1 and not filepath.endswith(SQLITE_SUFFIXES):
+            raise ValueError(f"Sharded event managers require a SQLite storage ending with one of {SQLITE_SUFFIXES}, got {filepath}")
+        manager = self._manager_class(**self._manager_kwargs)
+        try:
+            plan = await manager.load_event_plan()
+        finally:
+            await ConnectionPool.close()
+        if plan is None:
+            self._logger.error(f"There's no event of {manager.config} running right now, no worker has been started.")
+            return None
+        for index in range(self._workers):
+            self._start(index, plan)
+        try:
+            await self._monitor(plan)
+        finally:
+            self._stop()
+
+    def _start(self, index: int, plan: EventPlan) -> None:
+        shard = (index, self._workers)
+        process = self._context.Process(target=_run_shard, args=(self._manager_class, shard, plan, self._manager_kwargs), name=f"shard-{index}", daemon=True)
+        process.start()
+        self._processes.update({ index: process })
+        self._started.update({ index: time.monotonic() })
+        self._logger.info(f"Started worker {index + 1}/{self._workers} (PID: {process.pid})")
+
+    async def _monitor(self, plan: EventPlan) -> None:
+        """ Restart crashed workers with backoff until every worker has finished the event cleanly. """
+        while self._processes:
+            await asyncio.sleep(self._restart_delay)
+            now = time.monotonic()
+            for index, process in list(self._processes.items()):
+                if process.is_alive():
+                    continue
+                if index in self._restarts:
+                    if now >= self._restarts[index]:
+                        del self._restarts[index]
+                        self._start(index, plan)
+                    continue
+                if process.exitcode == 0:
+                    self._logger.info(f"Worker {index + 1}/{self._workers} has finished.")
+                    del self._processes[index]
+                    continue
+                delay = self._crashed(index, now - self._started[index])
+                self._restarts.update({ index: now + delay })
+                self._logger.error(f"Worker {index + 1}/{self._workers} exited with code {process.exitcode}, restarting in {delay} seconds ...")
+
+    def _crashed(self, index: int, uptime: float) -> float:
+        """ Count a crash of worker ``index`` after ``uptime`` seconds, return the seconds to wait before it is restarted. """
+        crashes = 1
+        # a worker which ran for longer than the largest backoff has recovered from its previous crashes
+        if uptime < self._restart_delay * 2 ** self._max_restarts:
+            crashes += self._crashes.get(index, 0)
+        self._crashes.update({ index: crashes })
+        if crashes > self._max_restarts:
+            raise RuntimeError(f"Worker {index + 1}/{self._workers} crashed {crashes} times in a row, giving up.")
+        return self._restart_delay * 2 ** (crashes - 1)
+
+    def _stop(self) -> None:
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes.values():
+            process.join()
+        self._processes.clear()
@@ -1,70 +1,750 @@
-#!/usr/bin/env python3
-from api import GameApi
-from NetworkManager import NetworkManager
-import unittest
-import json
-
-
-class TestGameApi(unittest.TestCase):
-    def test_network_request(self):
-    def test_api_name_all(self):
-        api = GameApi()
-        auth_url = api.auth_url
-        data_url = api.data_url
-        battle_url = api.battle_url
-        # Auth
-        self.assertEqual(f"{api.auth.login.game_account}", auth_url + '/api/auth/login/game_account')
-        self.assertEqual(f"{api.auth.login.user}", auth_url + '/api/auth/login/user?')
-        # User
-        self.assertEqual(f"{api.user.info}", data_url + '/api/user/info?')
-        self.assertEqual(f"{api.user.get_blacklist}", data_url + '/api/user/get-blacklist?')
-        self.assertEqual(f"{api.user.remove_blacklist}", data_url + '/api/user/remove-blacklist?')
-        self.assertEqual(f"{api.user.pet.info}", data_url + '/api/user/pet/info?')
-        self.assertEqual(f"{api.user.pet_team.info}", data_url + '/api/user/pet-team/info?')
-        self.assertEqual(f"{api.user.god.info}", data_url + '/api/user/god/info?')
-        self.assertEqual(f"{api.user.equipment.info}", data_url + '/api/user/equipment/info?')
-        self.assertEqual(f"{api.user.mail.get}", data_url + '/api/user/mail/get?')
-        self.assertEqual(f"{api.user.bundle_package.free}", data_url + '/api/user/bundle_package/free?')
-        self.assertEqual(f"{api.user.privilege.claim_daily_free_privilege_reward}", data_url + '/api/privilege/claim_daily_free_privilege_reward?')
-        self.assertEqual(f"{api.user.offline_reward.claim}", data_url + '/api/user/offline-reward/claim?')
-        self.assertEqual(f"{api.user.mall.purchase}", data_url + '/api/user/mall/purchase?')
-        self.assertEqual(f"{api.user.mall.festival.daily_claim}", data_url + '/api/mall/festival/daily-claim?')
-        self.assertEqual(f"{api.user.friend.search}", data_url + '/api/user/friend/search?')
-        self.assertEqual(f"{api.user.friend.list}", data_url + '/api/user/friend/list?')
-        self.assertEqual(f"{api.user.friend.collect_and_send_fp_all}", data_url + '/api/user/friend/collect-and-send-fp-all?')
-        self.assertEqual(f"{api.user.friend.requesting_list}", data_url + '/api/user/friend/requesting-list?')
-        self.assertEqual(f"{api.user.friend.suggest_list}", data_url + '/api/user/friend/suggest-list?')
-        self.assertEqual(f"{api.user.friend.remove_fd}", data_url + '/api/user/friend/remove-fd?')
-        self.assertEqual(f"{api.user.pet_team.info}", data_url + '/api/user/pet-team/info?')
-        self.assertEqual(f"{api.user.mail.get}", data_url + '/api/user/mail/get?')
-        # AccumulateTopUp
-        self.assertEqual(f"{api.accumulate_top_up.daily.records}", data_url + '/api/accumulate_top_up/daily/records?')
-        # Crystal
-        self.assertEqual(f"{api.crystal.record}", data_url + '/api/crystal/record?')
-        self.assertEqual(f"{api.crystal.place}", data_url + '/api/crystal/place?')
-        self.assertEqual(f"{api.crystal.remove}", data_url + '/api/crystal/remove?')
-        # Guild
-        self.assertEqual(f"{api.guild.get_guild_user_data}", data_url + '/api/guild/get_guild_user_data?')
-        self.assertEqual(f"{api.guild.get_guild_all_data}", data_url + '/api/guild/get_guild_all_data?')
-        self.assertEqual(f"{api.guild.get_guild_all_user}", data_url + '/api/guild/get_guild_all_user?')
-        self.assertEqual(f"{api.guild.join_guild}", data_url + '/api/guild/join_guild?')
-        self.assertEqual(f"{api.guild.accept_join}", data_url + '/api/guild/accpet_join?')
-        self.assertEqual(f"{api.guild.reject_join}", data_url + '/api/guild/reject_join?')
-        self.assertEqual(f"{api.guild.del_member}", data_url + '/api/guild/del_member?')
-        self.assertEqual(f"{api.guild.trigger_vice}", data_url + '/api/guild/trigger_vice?')
-        self.assertEqual(f"{api.guild.change_president}", data_url + '/api/guild/change_president?')
-        self.assertEqual(f"{api.guild.donation}", data_url + '/api/guild/donation?')
-        self.assertEqual(f"{api.guild.take_exp_reward}", data_url + '/api/guild/take_exp_reward?')
-        # GuildBoss
-        self.assertEqual(f"{api.guild_boss.records}", data_url + '/api/guild-boss/records?')
-        self.assertEqual(f"{api.guild_boss.guild_all_record}", data_url + '/api/guild-boss/guild-all-record?')
-        self.assertEqual(f"{api.guild_boss.battle.start}", data_url + '/api/guild-boss/battle/start?')
-        self.assertEqual(f"{api.guild_boss.battle.log}", battle_url + '/startGuildBossBattle?')
-        self.assertEqual(f"{api.guild_boss.battle.end}", data_url + '/api/guild-boss/battle/end?')
-
-
-
-        # Pvp3v3
-        self.assertEqual(f"{api.pvp_3v3.ranking}", data_url + '/api/pvp_3v3/ranking?')
-        self.assertEqual(f"{api.pvp_3v3.battle_log}", battle_url + '/startPVP3Battle?')
-        
+#!/usr/bin/env python3
+from api import GameAPI
+from assets import AssetCache, AssetManifest, SettingReader
+from clock import Clock, SimulatedClock, get_clock, set_clock
+from event import ActionPipeline, BaseConfig, Scheduler, shard_of
+from mock_server import MockGameServer
+from MultiverseDating import MultiverseDatingManager, plan_answers
+from network import AdaptiveLimiter, ConnectionPool, Credentials, NetworkManager, Response, SessionManager, CONNECT_ERROR_CODE, NETWORK_ERROR_CODE, RELOGIN
+from unittest import mock
+from storage import DiscordID, SQLiteDatabase, UserDocument, WriteBehindUserTable
+from supervisor import ShardSupervisor
+import aiohttp
+import network
+import asyncio
+import msgpack
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+class TestGameApi(unittest.TestCase):
+    def test_api_name_all(self):
+        api = GameAPI()
+        auth_url = api.auth_url
+        data_url = api.data_url
+        battle_url = api.battle_url
+        # Auth
+        self.assertEqual(f"{api.auth.login.game_account}", auth_url + '/api/auth/login/game_account')
+        self.assertEqual(f"{api.auth.login.user}", auth_url + '/api/auth/login/user?')
+        # User
+        self.assertEqual(f"{api.user.info}", data_url + '/api/user/info?')
+        self.assertEqual(f"{api.user.get_blacklist}", data_url + '/api/user/get-blacklist?')
+        self.assertEqual(f"{api.user.remove_blacklist}", data_url + '/api/user/remove-blacklist?')
+        self.assertEqual(f"{api.user.pet.info}", data_url + '/api/user/pet/info?')
+        self.assertEqual(f"{api.user.pet_team.info}", data_url + '/api/user/pet-team/info?')
+        self.assertEqual(f"{api.user.god.info}", data_url + '/api/user/god/info?')
+        self.assertEqual(f"{api.user.equipment.info}", data_url + '/api/user/equipment/info?')
+        self.assertEqual(f"{api.user.mail.get}", data_url + '/api/user/mail/get?')
+        self.assertEqual(f"{api.user.bundle_package.free}", data_url + '/api/user/bundle_package/free?')
+        self.assertEqual(f"{api.user.privilege.claim_daily_free_privilege_reward}", data_url + '/api/privilege/claim_daily_free_privilege_reward?')
+        self.assertEqual(f"{api.user.offline_reward.claim}", data_url + '/api/user/offline-reward/claim?')
+        self.assertEqual(f"{api.user.mall.purchase}", data_url + '/api/user/mall/purchase?')
+        self.assertEqual(f"{api.user.mall.festival.daily_claim}", data_url + '/api/mall/festival/daily-claim?')
+        self.assertEqual(f"{api.user.friend.search}", data_url + '/api/user/friend/search?')
+        self.assertEqual(f"{api.user.friend.list}", data_url + '/api/user/friend/list?')
+        self.assertEqual(f"{api.user.friend.collect_and_send_fp_all}", data_url + '/api/user/friend/collect-and-send-fp-all?')
+        self.assertEqual(f"{api.user.friend.requesting_list}", data_url + '/api/user/friend/requesting-list?')
+        self.assertEqual(f"{api.user.friend.suggest_list}", data_url + '/api/user/friend/suggest-list?')
+        self.assertEqual(f"{api.user.friend.remove_fd}", data_url + '/api/user/friend/remove-fd?')
+        self.assertEqual(f"{api.user.pet_team.info}", data_url + '/api/user/pet-team/info?')
+        self.assertEqual(f"{api.user.mail.get}", data_url + '/api/user/mail/get?')
+        # AccumulateTopUp
+        self.assertEqual(f"{api.accumulate_top_up.daily.records}", data_url + '/api/accumulate_top_up/daily/records?')
+        # Crystal
+        self.assertEqual(f"{api.crystal.record}", data_url + '/api/crystal/record?')
+        self.assertEqual(f"{api.crystal.place}", data_url + '/api/crystal/place?')
+        self.assertEqual(f"{api.crystal.remove}", data_url + '/api/crystal/remove?')
+        # Guild
+        self.assertEqual(f"{api.guild.get_guild_user_data}", data_url + '/api/guild/get_guild_user_data?')
+        self.assertEqual(f"{api.guild.get_guild_all_data}", data_url + '/api/guild/get_guild_all_data?')
+        self.assertEqual(f"{api.guild.get_guild_all_user}", data_url + '/api/guild/get_guild_all_user?')
+        self.assertEqual(f"{api.guild.join_guild}", data_url + '/api/guild/join_guild?')
+        self.assertEqual(f"{api.guild.accept_join}", data_url + '/api/guild/accpet_join?')
+        self.assertEqual(f"{api.guild.reject_join}", data_url + '/api/guild/reject_join?')
+        self.assertEqual(f"{api.guild.del_member}", data_url + '/api/guild/del_member?')
+        self.assertEqual(f"{api.guild.trigger_vice}", data_url + '/api/guild/trigger_vice?')
+        self.assertEqual(f"{api.guild.change_president}", data_url + '/api/guild/change_president?')
+        self.assertEqual(f"{api.guild.donation}", data_url + '/api/guild/donation?')
+        self.assertEqual(f"{api.guild.take_exp_reward}", data_url + '/api/guild/take_exp_reward?')
+        # GuildBoss
+        self.assertEqual(f"{api.guild_boss.records}", data_url + '/api/guild-boss/records?')
+        self.assertEqual(f"{api.guild_boss.guild_all_record}", data_url + '/api/guild-boss/guild-all-record?')
+        self.assertEqual(f"{api.guild_boss.battle.start}", data_url + '/api/guild-boss/battle/start?')
+        self.assertEqual(f"{api.guild_boss.battle.log}", battle_url + '/startGuildBossBattle?')
+        self.assertEqual(f"{api.guild_boss.battle.end}", data_url + '/api/guild-boss/battle/end?')
+
+
+
+        # Pvp3v3
+        self.assertEqual(f"{api.pvp_3v3.ranking}", data_url + '/api/pvp_3v3/ranking?')
+        self.assertEqual(f"{api.pvp_3v3.battle_log}", battle_url + '/startPVP3Battle?')
+        
+
+
+class TestSettingReader(unittest.TestCase):
+    def test_rows_by_event_id(self):
+        reader = SettingReader(msgpack.packb({ 't': [{ 'event_id': 1, 'a': 1 }, { 'event_id': 2, 'a': 2 }, { 'a': 3, 'event_id': 1 }], 'v': 7 }))
+        self.assertEqual(reader.rows('t', 1), [{ 'event_id': 1, 'a': 1 }, { 'a': 3, 'event_id': 1 }])
+        self.assertEqual(len(reader.rows('t')), 3)
+        self.assertEqual(reader.rows('v', 1), 7)
+
+    def test_rows_skip_values_which_are_not_rows(self):
+        reader = SettingReader(msgpack.packb({ 't': [{ 'event_id': 1, 'a': 1 }, 5, [1, 2], { 'event_id': 1, 'a': 2 }] }))
+        self.assertEqual(reader.rows('t', 1), [{ 'event_id': 1, 'a': 1 }, { 'event_id': 1, 'a': 2 }])
+
+
+class TestPlanAnswers(unittest.TestCase):
+    # two levels of two questions, answer (select_id, cost payload, energy cost)
+    ANSWERS = {
+        (1, 0): (0, 'c10', 10), (1, 1): (1, 'c11', 10),
+        (2, 0): (2, 'c20', 20), (2, 1): (0, 'c21', 20),
+    }
+
+    def test_moves_across_the_end_of_a_level(self):
+        self.assertEqual(plan_answers(self.ANSWERS, 1, 1, 30), [(1, 1, 1, 'c11'), (2, 0, 2, 'c20')])
+
+    def test_energy_equal_to_the_cost(self):
+        self.assertEqual(plan_answers(self.ANSWERS, 2, 0, 20), [(2, 0, 2, 'c20')])
+        self.assertEqual(plan_answers(self.ANSWERS, 2, 0, 19), [])
+
+    def test_stops_after_the_last_level(self):
+        self.assertEqual(plan_answers(self.ANSWERS, 1, 0, 1000), [(1, 0, 0, 'c10'), (1, 1, 1, 'c11'), (2, 0, 2, 'c20'), (2, 1, 0, 'c21')])
+        self.assertEqual(plan_answers(self.ANSWERS, 3, 0, 1000), [])
+
+    def test_level_zero(self):
+        # level 0 has no dialog in the event plan
+        self.assertEqual(plan_answers(self.ANSWERS, 0, 0, 1000), [])
+
+
+class TestActionPipeline(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.sent = list()
+
+    async def send(self, api_name, payload):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.sent.append(api_name)
+        # later actions are answered first
+        await asyncio.sleep(0.01 / (1 + payload['n']))
+        self.in_flight -= 1
+        return (api_name, payload['n'])
+
+    async def test_responses_in_submission_order(self):
+        pipeline = ActionPipeline(self.send, depth=4)
+        for n in range(6):
+            pipeline.add('meet', { 'n': n })
+        self.assertEqual(len(pipeline), 6)
+        self.assertEqual(await pipeline.run(), [('meet', n) for n in range(6)])
+        # the pipeline is empty after a run
+        self.assertEqual(len(pipeline), 0)
+        self.assertEqual(await pipeline.run(), [])
+
+    async def test_depth_bound(self):
+        pipeline = ActionPipeline(self.send, depth=3)
+        for n in range(10):
+            pipeline.add('meet', { 'n': n })
+        await pipeline.run()
+        self.assertEqual(self.max_in_flight, 3)
+
+    async def test_after(self):
+        pipeline = ActionPipeline(self.send, depth=4)
+        claim = pipeline.add('claim', { 'n': 0 })
+        pipeline.add('meet', { 'n': 1 })
+        pipeline.add('upgrade', { 'n': 2 }, after=(claim,))
+        self.assertEqual(await pipeline.run(), [('claim', 0), ('meet', 1), ('upgrade', 2)])
+        self.assertEqual(self.sent, ['claim', 'meet', 'upgrade'])
+        self.assertEqual(self.max_in_flight, 2)
+
+
+def free_ports(count: int) -> int:
+    """ First of ``count`` consecutive TCP ports which are free on the loopback interface. """
+    for port in range(18000, 19000, count):
+        try:
+            for offset in range(count):
+                with socket.socket() as sock:
+                    sock.bind(('127.0.0.1', port + offset))
+            return port
+        except OSError:
+            continue
+    raise RuntimeError("No free ports")
+
+
+class MockServerTestCase(unittest.IsolatedAsyncioTestCase):
+    """ Runs ``mock_server.py`` in process and points ``GameAPI`` and a fresh ``AssetManifest`` at it. """
+    server_kwargs = dict()
+
+    async def asyncSetUp(self):
+        self.urls = (GameAPI.auth_url, GameAPI.data_url, GameAPI.battle_url)
+        self.server = MockGameServer(**self.server_kwargs)
+        GameAPI.configure(*await self.server.start(port=free_ports(3)))
+        AssetManifest._shared = None
+
+    async def asyncTearDown(self):
+        await ConnectionPool.close()
+        await self.server.stop()
+        GameAPI.configure(*self.urls)
+        AssetManifest._shared = None
+
+
+class TestBaseConfig(MockServerTestCase):
+    server_kwargs = dict(latency=0.05)
+
+    async def test_get_dicts(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def on_start(session, context, params):
+            nonlocal in_flight, max_in_flight
+            if params.url.path.startswith('/assets/'):
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+
+        async def on_end(session, context, params):
+            nonlocal in_flight
+            if params.url.path.startswith('/assets/'):
+                in_flight -= 1
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(on_start)
+        trace.on_request_end.append(on_end)
+        ConnectionPool.trace_configs.append(trace)
+        try:
+            configs = ('MultiverseEventSetting.zip', 'SexualDatingSetting.zip')
+            settings = await BaseConfig.get_dicts(*configs, cache=AssetCache(''))
+        finally:
+            ConnectionPool.trace_configs.remove(trace)
+        self.assertEqual(list(settings), list(configs))
+        self.assertIn('multiverse_dating_settings', settings[configs[0]])
+        self.assertIn('sexual_dating_settings', settings[configs[1]])
+        self.assertEqual(self.server.stats['/api/system/assets'], 1)
+        self.assertEqual(sum(count for path, count in self.server.stats.items() if path.startswith('/assets/')), len(configs))
+        self.assertEqual(max_in_flight, len(configs))
+
+    async def test_plan_of_a_supplied_config_is_versioned(self):
+        config = 'MultiverseEventSetting.zip'
+        manager = MultiverseDatingManager(metrics_port=0, reload_interval=0)
+        setting = await BaseConfig(config, cache=AssetCache('')).get_dict()
+        plan = await manager.load_event_plan(setting)
+        self.assertIsNotNone(plan)
+        self.assertEqual(plan.version, await AssetManifest.shared().netpath(config))
+
+
+class TestSessionManager(MockServerTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.workdir = tempfile.TemporaryDirectory()
+        self.manager = NetworkManager(os.path.join(self.workdir.name, 'users.sqlite'), shared=False)
+        self.discord_id = DiscordID(100000000000000001)
+        await self.manager.db.user.create(self.discord_id, 1231234567890, 42)
+
+    async def asyncTearDown(self):
+        self.manager.db.close()
+        self.workdir.cleanup()
+        await super().asyncTearDown()
+
+    async def test_concurrent_relogins_share_one_login(self):
+        await asyncio.gather(*[self.manager.register(self.discord_id, force=True) for _ in range(10)])
+        self.assertEqual(self.server.stats['/api/auth/login/game_account'], 1)
+        self.assertEqual(self.server.stats['/api/auth/login/user'], 1)
+        user = await self.manager.db.user.get_user(self.discord_id)
+        self.assertEqual(user.get_session_id(), self.server.accounts[42].session_id)
+        # the next relogin is a new request
+        await self.manager.register(self.discord_id, force=True)
+        self.assertEqual(self.server.stats['/api/auth/login/game_account'], 2)
+
+    async def test_stale_generation_is_not_cached(self):
+        old = Credentials(1231234567890, 123, 'old')
+        new = Credentials(1231234567890, 123, 'new')
+        generation = SessionManager.generation(self.discord_id)
+        SessionManager.renew(self.discord_id)
+        SessionManager.remember(self.discord_id, new, SessionManager.generation(self.discord_id))
+        SessionManager.remember(self.discord_id, old, generation)
+        self.assertIs(SessionManager.credentials(self.discord_id), new)
+        SessionManager.invalidate(self.discord_id)
+        self.assertIsNone(SessionManager.credentials(self.discord_id))
+
+    async def test_credentials_read_across_a_renewal_are_not_cached(self):
+        SessionManager.renew(self.discord_id)
+        table = self.manager.db.user
+        get_user = table.get_user
+        reading = asyncio.Event()
+        renewed = asyncio.Event()
+
+        async def slow_get_user(key):
+            user = await get_user(key)
+            reading.set()
+            await renewed.wait()
+            return user
+
+        table.get_user = slow_get_user
+        await table.update_session_id(self.discord_id, 'old')
+        fetch = asyncio.create_task(self.manager._fetch_credentials(self.discord_id))
+        await reading.wait()
+        # a relogin commits a new session while the old one is being read
+        await table.update_session_id(self.discord_id, 'new')
+        SessionManager.renew(self.discord_id)
+        renewed.set()
+        self.assertEqual((await fetch).session_id, 'old')
+        self.assertIsNone(SessionManager.credentials(self.discord_id))
+        table.get_user = get_user
+        self.assertEqual((await self.manager._fetch_credentials(self.discord_id)).session_id, 'new')
+
+
+class TestSharding(unittest.TestCase):
+    # consecutive snowflakes of the same millisecond and worker, which only differ in their low bits
+    USERS = [DiscordID((1100000000000 << 22) + i) for i in range(8000)]
+
+    def test_shard_of_is_stable_across_processes(self):
+        expected = [shard_of(discord_id, 7) for discord_id in self.USERS[:100]]
+        script = f"from event import shard_of; print([shard_of(discord_id, 7) for discord_id in {[int(discord_id) for discord_id in self.USERS[:100]]}])"
+        for seed in ('1', '2'):
+            output = subprocess.run([sys.executable, '-c', script], env=dict(os.environ, PYTHONHASHSEED=seed), capture_output=True, text=True, check=True).stdout
+            self.assertEqual(output.strip(), str(expected))
+
+    def test_shard_of_spreads_users_evenly(self):
+        for shards in (2, 4, 8):
+            counts = [0] * shards
+            for discord_id in self.USERS:
+                counts[shard_of(discord_id, shards)] += 1
+            expected = len(self.USERS) / shards
+            for count in counts:
+                self.assertLess(abs(count - expected), 0.1 * expected)
+
+
+class TestShardSupervisor(unittest.TestCase):
+    def test_restart_backoff(self):
+        supervisor = ShardSupervisor(object, workers=2, restart_delay=5, max_restarts=3)
+        self.assertEqual([supervisor._crashed(0, 1) for _ in range(3)], [5, 10, 20])
+        # the crashes of a worker do not delay the others
+        self.assertEqual(supervisor._crashed(1, 1), 5)
+        with self.assertRaises(RuntimeError):
+            supervisor._crashed(0, 1)
+
+    def test_recovered_worker(self):
+        supervisor = ShardSupervisor(object, workers=1, restart_delay=5, max_restarts=3)
+        self.assertEqual([supervisor._crashed(0, 1) for _ in range(2)], [5, 10])
+        # running for longer than the largest backoff resets the count
+        self.assertEqual(supervisor._crashed(0, 5 * 2 ** 3), 5)
+        self.assertEqual(supervisor._crashed(0, 1), 10)
+
+
+class FakeEvent:
+    """ User instance which records the clock of every tick and returns the next due times given upfront. """
+    def __init__(self, name, ticks, next_times):
+        self.name = name
+        self.ticks = ticks
+        self.next_times = list(next_times)
+
+    def reset_retry_budget(self):
+        pass
+
+    async def tick(self):
+        self.ticks.append((self.name, get_clock().timestamp()))
+        next_ts = self.next_times.pop(0)
+        if isinstance(next_ts, Exception):
+            raise next_ts
+        return next_ts
+
+
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+    START = 1000
+
+    def setUp(self):
+        self.clock = SimulatedClock(start=self.START)
+        set_clock(self.clock)
+        self.ticks = list()
+
+    def tearDown(self):
+        set_clock(Clock())
+
+    async def run_scheduler(self, scheduler, seconds):
+        task = asyncio.create_task(scheduler.run())
+        await self.clock.sleep(seconds)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def test_due_order(self):
+        scheduler = Scheduler(workers=1)
+        scheduler.insert(1, FakeEvent('a', self.ticks, [None]), self.START + 30)
+        scheduler.insert(2, FakeEvent('b', self.ticks, [None]), self.START + 10)
+        scheduler.insert(3, FakeEvent('c', self.ticks, [None]), self.START + 20)
+        await self.run_scheduler(scheduler, 100)
+        self.assertEqual(self.ticks, [('b', self.START + 10), ('c', self.START + 20), ('a', self.START + 30)])
+
+    async def test_tick_reschedules_until_none(self):
+        scheduler = Scheduler()
+        scheduler.insert(1, FakeEvent('a', self.ticks, [self.START + 50, self.START + 60, None]), self.START)
+        await self.run_scheduler(scheduler, 100)
+        self.assertEqual(self.ticks, [('a', self.START), ('a', self.START + 50), ('a', self.START + 60)])
+        # a finished user stays registered without a due time
+        self.assertIn(1, scheduler)
+        self.assertEqual(scheduler.due, 0)
+
+    async def test_reschedule_skips_stale_entry(self):
+        scheduler = Scheduler()
+        scheduler.insert(1, FakeEvent('a', self.ticks, [None]), self.START + 10)
+        scheduler.reschedule(1, self.START + 40)
+        await self.run_scheduler(scheduler, 100)
+        self.assertEqual(self.ticks, [('a', self.START + 40)])
+
+    async def test_reschedule_unknown_user(self):
+        scheduler = Scheduler()
+        scheduler.reschedule(1, self.START)
+        self.assertNotIn(1, scheduler)
+        await self.run_scheduler(scheduler, 10)
+        self.assertEqual(self.ticks, [])
+
+    async def test_next_due(self):
+        scheduler = Scheduler()
+        self.assertIsNone(scheduler.next_due())
+        scheduler.insert(1, FakeEvent('a', self.ticks, [None]), self.START + 10)
+        scheduler.insert(2, FakeEvent('b', self.ticks, [None]), self.START + 20)
+        self.assertEqual(scheduler.next_due(), self.START + 10)
+        scheduler.reschedule(1, self.START + 30)
+        self.assertEqual(scheduler.next_due(), self.START + 20)
+        scheduler.cancel(2)
+        self.assertEqual(scheduler.next_due(), self.START + 30)
+        scheduler.cancel(1)
+        self.assertIsNone(scheduler.next_due())
+
+    async def test_cancel(self):
+        scheduler = Scheduler()
+        instance = FakeEvent('a', self.ticks, [None])
+        scheduler.insert(1, instance, self.START + 10)
+        self.assertIs(scheduler.cancel(1), instance)
+        self.assertNotIn(1, scheduler)
+        await self.run_scheduler(scheduler, 100)
+        self.assertEqual(self.ticks, [])
+
+    async def test_insert_replaces_instance(self):
+        scheduler = Scheduler()
+        scheduler.insert(1, FakeEvent('old', self.ticks, [None]), self.START + 10)
+        scheduler.insert(1, FakeEvent('new', self.ticks, [None]), self.START + 20)
+        await self.run_scheduler(scheduler, 100)
+        self.assertEqual(self.ticks, [('new', self.START + 20)])
+
+    async def test_cancel_during_tick(self):
+        scheduler = Scheduler()
+
+        class CancellingEvent(FakeEvent):
+            async def tick(self):
+                scheduler.cancel(1)
+                return await super().tick()
+
+        scheduler.insert(1, CancellingEvent('a', self.ticks, [self.START + 10]), self.START)
+        await self.run_scheduler(scheduler, 100)
+        self.assertEqual(self.ticks, [('a', self.START)])
+        self.assertNotIn(1, scheduler)
+
+    async def test_cancel_waits_for_running_ticks(self):
+        scheduler = Scheduler()
+        started = asyncio.Event()
+        finished = list()
+
+        class SlowEvent(FakeEvent):
+            async def tick(self):
+                started.set()
+                try:
+                    await asyncio.sleep(10)
+                finally:
+                    # e.g. a request in flight which still has to be released
+                    await asyncio.sleep(0.01)
+                    finished.append(self.name)
+
+        scheduler.insert(1, SlowEvent('a', self.ticks, []), self.START)
+        task = asyncio.create_task(scheduler.run())
+        await started.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertEqual(finished, ['a'])
+
+    async def test_failed_tick_retries(self):
+        scheduler = Scheduler(retry_delay=30)
+        scheduler.insert(1, FakeEvent('a', self.ticks, [RuntimeError("tick failed"), None]), self.START)
+        with self.assertLogs('Scheduler', 'ERROR'):
+            await self.run_scheduler(scheduler, 100)
+        self.assertEqual(self.ticks, [('a', self.START), ('a', self.START + 30)])
+
+
+class FakeUserTable:
+    """ Backend user table which keeps its documents in memory and records every batch committed by ``update_many``. """
+    def __init__(self, users):
+        self.users = { key: dict(fields) for key, fields in users.items() }
+        self.reads = 0
+        self.commits = list()
+        self.fail = False
+
+    async def get_user(self, key):
+        self.reads += 1
+        return UserDocument(dict(self.users[key]), key)
+
+    async def get_all_users(self):
+        return [UserDocument(dict(fields), key) for key, fields in self.users.items()]
+
+    async def update_many(self, changes):
+        if self.fail:
+            raise RuntimeError("commit failed")
+        self.commits.append({ key: dict(fields) for key, fields in changes.items() })
+        for key, fields in changes.items():
+            self.users[key].update(fields)
+
+
+class TestAdaptiveLimiter(unittest.IsolatedAsyncioTestCase):
+    def test_invalid_rate(self):
+        for rate in (0, -1, float('nan')):
+            with self.assertRaises(ValueError):
+                AdaptiveLimiter('test', rate, 4)
+        with self.assertRaises(ValueError):
+            AdaptiveLimiter('test', 10, 0)
+
+    async def test_token_refill(self):
+        limiter = AdaptiveLimiter('test', 10, 4)
+        for _ in range(10):
+            await limiter._take_token()
+        self.assertEqual(limiter.throttled, 0)
+        # the bucket is empty, the next token is refilled after 1 / rate seconds
+        await limiter._take_token()
+        self.assertAlmostEqual(limiter.throttled, 0.1, places=2)
+        # a second later the bucket is full again, but never holds more than a burst
+        limiter._updated -= 1.0
+        throttled = limiter.throttled
+        for _ in range(9):
+            await limiter._take_token()
+        self.assertEqual(limiter.throttled, throttled)
+        # 10 tokens refilled in 1.1 seconds, capped at the burst of 10
+        self.assertAlmostEqual(limiter._tokens, 1, places=1)
+
+    def test_additive_increase(self):
+        limiter = AdaptiveLimiter('test', 10, 4)
+        limiter.limit = 2.0
+        limiter._complete(0.01, False)
+        self.assertEqual(limiter.limit, 2.5)
+        limiter._complete(0.01, False)
+        self.assertEqual(limiter.limit, 2.9)
+        for _ in range(100):
+            limiter._complete(0.01, False)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveLimiter('test', 10, 8, latency_target=1.0)
+        limiter._complete(0.5, True)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.overloads, 1)
+        # requests of the same round trip do not shrink it again
+        limiter._complete(0.5, True)
+        self.assertEqual(limiter.limit, 4)
+        # neither does a slow request
+        limiter._last_decrease -= 10
+        limiter._complete(1.5, False)
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual(limiter.overloads, 2)
+        limiter._last_decrease -= 10
+        limiter._complete(0.5, True)
+        limiter._last_decrease -= 10
+        limiter._complete(0.5, True)
+        self.assertEqual(limiter.limit, 1)
+
+    async def test_timeout_decreases_the_limit(self):
+        limiter = AdaptiveLimiter('test', 10, 8)
+        with self.assertRaises(asyncio.TimeoutError):
+            async with limiter.request():
+                raise asyncio.TimeoutError()
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+
+class TestSendWithRetry(unittest.IsolatedAsyncioTestCase):
+    """ ``NetworkManager.get``/``post`` against a stubbed ``_request`` which answers with the queued error codes, then successes. """
+    SESSION_ERROR_CODE = 10003
+    THROTTLE_ERROR_CODE = 10500
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.manager = NetworkManager(os.path.join(self.workdir.name, 'users.sqlite'), shared=False)
+        self.manager.discord_user_id = 1
+        self.sent = list()
+        self.codes = list()
+        self.relogins = 0
+
+        async def request(method, api_name, uri, data=None):
+            self.sent.append(method)
+            if self.codes:
+                return Response.failure(self.codes.pop(0), "stubbed failure")
+            return Response({ 'success': True, 'error_code': 0, 'error_message': None, 'response': {} })
+
+        async def fetch_credentials(discord_user_id):
+            return Credentials(1234567890123, 123, 'session')
+
+        async def register(discord_user_id, session_id=None, force=False):
+            self.relogins += 1
+            SessionManager.renew(discord_user_id)
+
+        self.manager._request = request
+        self.manager._fetch_credentials = fetch_credentials
+        self.manager.register = register
+        patches = [
+            mock.patch.object(network, 'RETRY_BASE_DELAY', 0),
+            mock.patch.dict(network.ERROR_ACTIONS, { self.SESSION_ERROR_CODE: RELOGIN, self.THROTTLE_ERROR_CODE: network.RETRY }),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.manager.db.close()
+        self.workdir.cleanup()
+
+    async def test_retry_then_success(self):
+        self.codes = [NETWORK_ERROR_CODE, self.THROTTLE_ERROR_CODE]
+        resp = await self.manager.get(self.manager.api.user.info, 1)
+        self.assertTrue(resp.success())
+        self.assertEqual(self.sent, ['GET'] * 3)
+        self.assertEqual(self.manager.retry_budget, network.RETRY_BUDGET - 2)
+
+    async def test_relogin_on_session_error(self):
+        self.codes = [self.SESSION_ERROR_CODE, self.SESSION_ERROR_CODE]
+        with self.assertLogs('NetworkManager', 'INFO'):
+            resp = await self.manager.post(self.manager.api.multiverse_dating.meet, { 'event_id': 1 }, 1)
+        # the session is renewed once, the second session error is handed to the caller
+        self.assertEqual(resp.error_code(), self.SESSION_ERROR_CODE)
+        self.assertEqual(self.relogins, 1)
+        self.assertEqual(self.sent, ['POST'] * 2)
+
+    async def test_post_is_not_sent_again_after_a_network_error(self):
+        self.codes = [NETWORK_ERROR_CODE]
+        resp = await self.manager.post(self.manager.api.multiverse_dating.meet, { 'event_id': 1 }, 1)
+        self.assertEqual(resp.error_code(), NETWORK_ERROR_CODE)
+        self.assertEqual(self.sent, ['POST'])
+
+    async def test_post_is_sent_again_after_a_connect_error(self):
+        self.codes = [CONNECT_ERROR_CODE]
+        resp = await self.manager.post(self.manager.api.multiverse_dating.meet, { 'event_id': 1 }, 1)
+        self.assertTrue(resp.success())
+        self.assertEqual(self.sent, ['POST'] * 2)
+
+    async def test_login_is_sent_again_after_a_network_error(self):
+        self.codes = [NETWORK_ERROR_CODE]
+        resp = await self.manager.post(self.manager.api.auth.login.game_account, { 'login_id': 1 }, 1, require_login=False)
+        self.assertTrue(resp.success())
+        self.assertEqual(self.sent, ['POST'] * 2)
+
+    async def test_retries_stop_at_the_limit(self):
+        self.codes = [NETWORK_ERROR_CODE] * 10
+        resp = await self.manager.get(self.manager.api.user.info, 1)
+        self.assertEqual(resp.error_code(), NETWORK_ERROR_CODE)
+        self.assertEqual(len(self.sent), network.RETRY_ATTEMPTS + 1)
+
+    async def test_retries_stop_when_the_budget_is_spent(self):
+        self.manager.retry_budget = 1
+        self.codes = [NETWORK_ERROR_CODE] * 10
+        resp = await self.manager.get(self.manager.api.user.info, 1)
+        self.assertEqual(resp.error_code(), NETWORK_ERROR_CODE)
+        self.assertEqual(len(self.sent), 2)
+        self.manager.reset_retry_budget()
+        self.assertEqual(self.manager.retry_budget, network.RETRY_BUDGET)
+
+
+class TestSQLiteUserTable(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.db = SQLiteDatabase(os.path.join(self.workdir.name, 'users.sqlite'))
+        self.table = self.db.user
+
+    def tearDown(self):
+        self.db.close()
+        self.workdir.cleanup()
+
+    def document(self, key, user_id):
+        user = { 'user_id': user_id, 'premium': False, 'bot': False, 'create_time': 0, 'last_update': 0, 'last_session_update': 0, 'next_update': 0 }
+        return UserDocument(user, key)
+
+    async def test_insert_documents_is_atomic(self):
+        await self.table.insert_documents([self.document(1, 10)])
+        with self.assertRaises(sqlite3.IntegrityError):
+            # the last row collides with the existing document
+            await self.table.insert_documents([self.document(2, 20), self.document(3, 30), self.document(1, 11)], replace=False)
+        self.assertEqual([user.doc_id for user in await self.table.get_all_users()], [1])
+        self.assertEqual((await self.table.get_user(1))['user_id'], 10)
+
+    async def test_update_many_is_atomic(self):
+        await self.table.insert_documents([self.document(1, 10), self.document(2, 20)])
+        with self.assertRaises(sqlite3.OperationalError):
+            await self.table.update_many({ 1: { 'user_id': 11 }, 2: { 'no_such_field': 0 } })
+        self.assertEqual((await self.table.get_user(1))['user_id'], 10)
+        await self.table.update_many({ 1: { 'user_id': 11 }, 2: { 'user_id': 21 } })
+        self.assertEqual([user['user_id'] for user in await self.table.get_all_users()], [11, 21])
+
+
+class TestWriteBehindUserTable(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.backend = FakeUserTable({ 1: { 'user_id': 10, 'guild_id': 0 }, 2: { 'user_id': 20, 'guild_id': 0 } })
+
+    async def test_updates_are_coalesced(self):
+        table = WriteBehindUserTable(self.backend, flush_interval=60)
+        await table.update_guild_id(1, 100)
+        await table.update_user_id(1, 11)
+        await table.update_guild_id(1, 101)
+        self.assertEqual(self.backend.commits, [])
+        await table.flush()
+        self.assertEqual(len(self.backend.commits), 1)
+        self.assertEqual(list(self.backend.commits[0]), [1])
+        self.assertEqual(self.backend.users[1]['guild_id'], 101)
+        self.assertEqual(self.backend.users[1]['user_id'], 11)
+        # nothing left to commit
+        await table.flush()
+        self.assertEqual(len(self.backend.commits), 1)
+
+    async def test_get_user_observes_queued_updates(self):
+        table = WriteBehindUserTable(self.backend, flush_interval=60)
+        await table.update_guild_id(1, 100)
+        self.assertEqual((await table.get_user(1))['guild_id'], 100)
+        await table.update_guild_id(1, 101)
+        self.assertEqual((await table.get_user(1))['guild_id'], 101)
+        self.assertEqual(self.backend.reads, 1)
+        self.assertEqual(self.backend.users[1]['guild_id'], 0)
+        await table.flush()
+
+    async def test_flush_threshold(self):
+        table = WriteBehindUserTable(self.backend, flush_interval=60, flush_threshold=2)
+        await table.update_guild_id(1, 100)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.backend.commits, [])
+        await table.update_guild_id(2, 200)
+        await asyncio.sleep(0.01)
+        self.assertEqual([list(changes) for changes in self.backend.commits], [[1, 2]])
+
+    async def test_flush_interval(self):
+        table = WriteBehindUserTable(self.backend, flush_interval=0.01)
+        await table.update_guild_id(1, 100)
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.backend.commits), 1)
+        self.assertEqual(self.backend.users[1]['guild_id'], 100)
+
+    async def test_failed_flush_is_queued_again(self):
+        table = WriteBehindUserTable(self.backend, flush_interval=60)
+        await table.update_guild_id(1, 100)
+        self.backend.fail = True
+        with self.assertRaises(RuntimeError):
+            await table.flush()
+        self.backend.fail = False
+        await table.update_user_id(1, 11)
+        await table.flush()
+        self.assertEqual(self.backend.users[1]['guild_id'], 100)
+        self.assertEqual(self.backend.users[1]['user_id'], 11)
+
+    async def test_queries_flush_first(self):
+        table = WriteBehindUserTable(self.backend, flush_interval=60)
+        await table.update_guild_id(2, 200)
+        users = { user.doc_id: user for user in await table.get_all_users() }
+        self.assertEqual(users[2]['guild_id'], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()